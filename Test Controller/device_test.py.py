@@ -12,6 +12,11 @@ import general
 import device
 import time
 import sys
+import heapq
+try:
+    import binascii
+except ImportError:
+    binascii = None
 
 # Global variables
 running = True
@@ -28,6 +33,128 @@ NOTE_TEMPO_END = 73    # C#4 ends collection and applies tempo change
 channel_to_edit = 0
 step_to_edit = 0
 
+# Logging levels. Messages below log_level are skipped before they are
+# formatted; the rest are buffered and printed in one batch from OnIdle,
+# so the MIDI callbacks never wait on FL's script console.
+LOG_DEBUG = 10
+LOG_INFO = 20
+LOG_WARNING = 30
+LOG_ERROR = 40
+LOG_RING_SIZE = 200  # Buffered messages, the oldest are dropped first
+
+log_level = LOG_INFO
+log_ring = []
+log_dropped = 0
+
+# Control channel (must match trigger.py). Messages on it are commands, never notes.
+CONTROL_CHANNEL = 15         # MIDI channel 16
+CC_TRANSPORT = 20            # Value is one of the TRANSPORT_* commands
+TRANSPORT_STOP = 0
+TRANSPORT_PLAY = 1
+TRANSPORT_RECORD = 2         # Toggle record mode
+TRANSPORT_REWIND = 3         # Back to the start of the song
+TEMPO_MIN = 10               # BPM at pitch bend value 0
+TEMPO_STEPS_PER_BPM = 32     # Pitch bend steps per BPM
+
+# SysEx bulk transfer framing (must match trigger.py)
+# Every frame is F0 <manufacturer> <command> <seq (2 bytes, MSB first)> <payload...> F7
+SYSEX_MANUFACTURER_ID = 0x7D
+SYSEX_MELODY_BEGIN = 0x01     # Payload: session, flags, note format, PPQ (2 bytes), varint note count, varint chunk total
+SYSEX_MELODY_DATA = 0x02      # Payload: session, varint chunk index, encoded note values
+SYSEX_MELODY_END = 0x03       # Payload: session, record the collected notes
+SYSEX_GRID = 0x04             # Single frame: varint pattern, varint step count, varint channel count, channel grids
+SYSEX_METRICS_REQUEST = 0x05  # Single frame: reset flag, answered with SYSEX_METRICS before the ACK
+SYSEX_STATE_REQUEST = 0x06    # Single frame, no payload, answered with SYSEX_STATE before the ACK
+SYSEX_FLAG_FAST_RECORD = 0x01  # Record at FAST_RECORD_TEMPO, restoring the tempo afterwards
+SYSEX_ACK = 0x10              # Sent back with the seq of the last frame received in order
+SYSEX_METRICS = 0x11          # Sent back with the counters and histograms, see encode_metrics
+SYSEX_STATE = 0x12            # Sent whenever the project state changes, see encode_project_state
+SYSEX_NACK = 0x13             # Like SYSEX_ACK, with the seqs of missing frames as 2 values each
+SYSEX_NACK_MAX = 32           # Missing frames listed in one NACK
+SYSEX_CRC_SIZE = 3            # CRC-16/CCITT of command, seq and payload, in 3 values before F7
+SYSEX_STATUS_OK = 0           # Payload of the SYSEX_MELODY_END acknowledgement
+SYSEX_STATUS_PHRASE_MISSING = 1  # A replayed phrase isn't cached, nothing was recorded
+SYSEX_STATUS_ERROR = 2           # Applying the frame failed, see the log
+
+# Frames that start a new sequence at 0, and frames acknowledged with a status once handled
+SYSEX_FIRST_FRAMES = (SYSEX_MELODY_BEGIN, SYSEX_GRID, SYSEX_METRICS_REQUEST, SYSEX_STATE_REQUEST)
+SYSEX_FINAL_FRAMES = (SYSEX_MELODY_END, SYSEX_GRID, SYSEX_METRICS_REQUEST, SYSEX_STATE_REQUEST)
+SEQ_MODULO = 0x4000           # Sequence numbers are 14 bits
+SYSEX_REORDER_WINDOW = 512    # Frames held after a gap until it is filled (must match trigger.py)
+
+# Note formats named in the SYSEX_MELODY_BEGIN frame
+NOTE_FORMAT_LEGACY = 0  # 6 values per note, whole beats plus tenths
+NOTE_FORMAT_TICKS = 1   # note, velocity, varint delta ticks from previous note, varint length ticks
+NOTE_FORMAT_COMPRESSED = 2  # NOTE_FORMAT_TICKS with running state and repeat counts
+NOTE_FORMAT_PHRASES = 3     # Phrase definitions and replays of cached phrases
+NOTE_FORMAT_BATCH = 4       # Not notes but BATCH_* operations, run as one transaction
+NOTE_FORMAT_CHANNELS = 5    # Parts for several channels: varint channel + 1 (0 for the default),
+                            # note format, varint note count, varint value count, encoded notes
+
+# Operations in NOTE_FORMAT_BATCH data. Names are a varint length and ASCII characters.
+BATCH_SELECT_PATTERN = 0x01  # varint pattern number
+BATCH_NAME_PATTERN = 0x02    # varint pattern number, name
+BATCH_SELECT_CHANNEL = 0x03  # varint channel index, notes that follow record into it
+BATCH_NAME_CHANNEL = 0x04    # varint channel index, name
+BATCH_GRID = 0x05            # varint length, SYSEX_GRID payload
+BATCH_NOTES = 0x06           # flags, note format, varint note count, varint value count, encoded notes
+BATCH_TEMPO = 0x07           # tempo as 2 values, 14 bits in TEMPO_STEPS_PER_BPM steps from TEMPO_MIN
+
+# Flags leading each NOTE_FORMAT_COMPRESSED record
+NOTE_SAME_NOTE = 0x01      # Note number omitted, same as previous
+NOTE_SAME_VELOCITY = 0x02  # Velocity omitted, same as previous
+NOTE_SAME_LENGTH = 0x04    # Length omitted, same as previous
+NOTE_SAME_DELTA = 0x08     # Delta omitted, same spacing as previous
+NOTE_REPEAT = 0x10         # Varint count follows, note repeats that many more times at the same spacing
+
+# Operations in NOTE_FORMAT_PHRASES data
+PHRASE_DEFINE = 0x00  # key (4 values), varint note count, varint value count, NOTE_FORMAT_COMPRESSED values
+PHRASE_PLAY = 0x01    # key (4 values), varint start tick, transpose (added to every note)
+PHRASE_CACHE_SIZE = 256  # Phrases kept, least recently used dropped first (must match trigger.py)
+
+# Highest tempo used by fast recording (FL Studio tops out at 522 BPM)
+FAST_RECORD_TEMPO = 500
+
+# FL Studio calls OnIdle about every 20 ms. A recording waits inside OnIdle
+# for the next note when it is due within this many idle gaps, since the
+# next call would be late. It waits for one note per call at most.
+IDLE_GAP_INITIAL = 0.02
+RECORD_WAIT_GAPS = 2
+
+# While above 0, commit_pattern_changes only notes that a redraw is due
+ui_refresh_suspended = 0
+ui_refresh_pending = False
+
+# Phrase key -> notes relative to the phrase start, least recently used first
+phrase_cache = {}
+phrase_misses = 0
+
+# Project state mirrored by trigger.py, read from FL Studio on OnInit, when
+# OnRefresh reports a pattern or channel change and on OnTransport and
+# OnTempoChange. LED refreshes, which come with every transport change but
+# also far more often, only check the play and record state. Recordings
+# read the tempo and PPQ from here instead of asking FL Studio every time.
+STATE_PLAYING = 0x01    # Flags in SYSEX_STATE payloads
+STATE_RECORDING = 0x02
+STATE_REFRESH_FLAGS = midi.HW_Dirty_Patterns | midi.HW_Dirty_ChannelRackGroup
+project_state = {
+    "tempo": 120.0,
+    "ppq": 96,
+    "pattern": 1,
+    "pattern_count": 1,
+    "channel": 0,
+    "channel_count": 0,
+    "playing": False,
+    "recording": False,
+}
+
+# Metrics reported to trigger.py's get_metrics
+METRIC_COUNTER = 0    # name, varint value
+METRIC_HISTOGRAM = 1  # name, varint bucket count, varint count per bucket
+METRIC_BUCKETS = 28   # Bucket i counts durations under 2**i microseconds (the last one up to about 2 minutes and longer)
+metric_counters = {}
+metric_histograms = {}
+
 def midi_notes_to_int(midi_notes):
     """
     Convert an array of MIDI note values (7 bits each) into a single integer
@@ -49,10 +176,160 @@ def midi_notes_to_int(midi_notes):
         result = (result << 7) | note_value
     return result
 
+def log(level, message, *args):
+    """
+    Buffer a message for the script console if its level is enabled
+    
+    Args:
+        level (int): One of the LOG_* levels
+        message (str): Message, %-formatted with args only when enabled
+    """
+    global log_dropped
+    if level < log_level:
+        return
+    if args:
+        message = message % args
+    if len(log_ring) >= LOG_RING_SIZE:
+        del log_ring[0]
+        log_dropped += 1
+        count_metric("log_dropped")
+    log_ring.append(message)
+
+def flush_log():
+    """Print buffered log messages in a single console write"""
+    global log_dropped
+    if not log_ring:
+        return
+    if log_dropped:
+        log_ring.insert(0, f"({log_dropped} log messages dropped)")
+        log_dropped = 0
+    print("\n".join(log_ring))
+    del log_ring[:]
+
+def count_metric(name, amount=1):
+    """Add to one of the counters reported by get_metrics"""
+    metric_counters[name] = metric_counters.get(name, 0) + amount
+
+def time_metric(name, started):
+    """
+    Add the time since started to a histogram
+    
+    Args:
+        name (str): Histogram name
+        started (float): time.perf_counter() when the timed work began
+    """
+    add_metric_sample(name, time.perf_counter() - started)
+
+def add_metric_sample(name, seconds):
+    """Add one duration to a histogram of power-of-two microsecond buckets"""
+    buckets = metric_histograms.get(name)
+    if buckets is None:
+        buckets = metric_histograms[name] = [0] * METRIC_BUCKETS
+    microseconds = int(seconds * 1000000) if seconds > 0 else 0
+    buckets[min(METRIC_BUCKETS - 1, microseconds.bit_length())] += 1
+
+def encode_metrics():
+    """
+    Encode the counters and histograms as a SYSEX_METRICS payload
+    
+    Returns:
+        list: METRIC_COUNTER and METRIC_HISTOGRAM entries, 7-bit values
+    """
+    payload = []
+    for name, value in metric_counters.items():
+        payload.append(METRIC_COUNTER)
+        payload.extend(encode_name(name))
+        payload.extend(int_to_varint(value))
+    for name, buckets in metric_histograms.items():
+        # Trailing empty buckets carry no information
+        used = len(buckets)
+        while used and not buckets[used - 1]:
+            used -= 1
+        payload.append(METRIC_HISTOGRAM)
+        payload.extend(encode_name(name))
+        payload.extend(int_to_varint(used))
+        for count in buckets[:used]:
+            payload.extend(int_to_varint(count))
+    return payload
+
+def encode_name(name):
+    """Encode a name as a varint length and its ASCII characters"""
+    data = [ord(c) & 0x7F for c in name]
+    return int_to_varint(len(data)) + data
+
+def int_to_varint(value):
+    """
+    Encode a non-negative int like trigger.py's int_to_varint
+    
+    Returns:
+        list: 6 bits per value, MSB first, 0x40 set on all but the last
+    """
+    values = [value & 0x3F]
+    value >>= 6
+    while value:
+        values.append(0x40 | (value & 0x3F))
+        value >>= 6
+    values.reverse()
+    return values
+
+def crc16_table():
+    """Lookup table for CRC-16/CCITT (polynomial 0x1021), one entry per byte value"""
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return table
+
+CRC16_TABLE = crc16_table()
+
+def frame_crc(values):
+    """
+    Checksum a frame's command, seq and payload like trigger.py's frame_crc
+    
+    Uses binascii when FL Studio's Python has it, and a table otherwise.
+    
+    Returns:
+        list: CRC-16/CCITT (initial value 0xFFFF) as 3 values, top bits first
+    """
+    if binascii is not None:
+        crc = binascii.crc_hqx(bytes(values), 0xFFFF)
+    else:
+        crc = 0xFFFF
+        table = CRC16_TABLE
+        for byte in values:
+            crc = ((crc << 8) & 0xFF00) ^ table[(crc >> 8) ^ byte]
+    return [crc >> 14, (crc >> 7) & 0x7F, crc & 0x7F]
+
+def read_varint(values, index):
+    """
+    Read one varint written by trigger.py's int_to_varint
+    
+    Each byte carries 6 bits (MSB first) and bit 6 (0x40) marks that more
+    bytes follow.
+    
+    Args:
+        values (list): MIDI values (each 0-127)
+        index (int): Position of the first byte of the varint
+        
+    Returns:
+        tuple: (value, index of the byte after the varint)
+    """
+    result = 0
+    while True:
+        byte = values[index]
+        index += 1
+        result = (result << 6) | (byte & 0x3F)
+        if not byte & 0x40:
+            return result, index
+
 def OnInit():
     """Called when the script is loaded by FL Studio"""
-    print("FL Studio Terminal Beat Builder initialized")
-    print("Type 'help' for a list of commands")
+    note_decoder.reset()
+    sysex_decoder.reset()
+    refresh_project_state(force=True)
+    log(LOG_INFO, "FL Studio Terminal Beat Builder initialized")
     
     return
 
@@ -60,13 +337,102 @@ def OnDeInit():
     """Called when the script is unloaded by FL Studio"""
     global running
     running = False  # Signal the terminal thread to exit
-    print("FL Studio Terminal Beat Builder deinitialized")
+    
+    # Drop queued work and restore the transport and tempo
+    del recording_queue[:]
+    if active_recording is not None:
+        active_recording.cancel()
+    scheduler.clear()
+    flush_log()
+    log(LOG_INFO, "FL Studio Terminal Beat Builder deinitialized")
+    flush_log()
     return
 
+def OnIdle():
+    """Called periodically by FL Studio, runs scheduled actions that are due"""
+    started = time.perf_counter()
+    scheduler.run_due()
+    flush_log()
+    time_metric("idle", started)
+
 def OnRefresh(flags):
     """Called when FL Studio's state changes or when a refresh is needed"""
-    # Update terminal with current state if needed
-    return
+    if flags & STATE_REFRESH_FLAGS:
+        refresh_project_state()
+    elif flags & midi.HW_Dirty_LEDs:
+        refresh_transport_state()
+
+def OnDoFullRefresh():
+    """Called when FL Studio wants everything refreshed"""
+    refresh_project_state(force=True)
+
+def read_project_state():
+    """
+    Read the mirrored state from FL Studio
+    
+    Returns:
+        dict: Same keys as project_state
+    """
+    return {
+        "tempo": read_project_tempo(),
+        "ppq": general.getRecPPQ(),
+        "pattern": patterns.patternNumber(),
+        "pattern_count": patterns.patternCount(),
+        "channel": channels.selectedChannel(),
+        "channel_count": channels.channelCount(),
+        "playing": bool(transport.isPlaying()),
+        "recording": bool(transport.isRecording()),
+    }
+
+def refresh_project_state(force=False):
+    """
+    Update project_state from FL Studio and send it to trigger.py if it changed
+    
+    Args:
+        force (bool): Send it even if nothing changed
+    """
+    try:
+        state = read_project_state()
+    except Exception as e:
+        log(LOG_WARNING, "Could not read the project state: %s", e)
+        return
+    if state != project_state or force:
+        project_state.update(state)
+        send_sysex(SYSEX_STATE, 0, encode_project_state())
+
+def refresh_transport_state():
+    """Update only the play and record state, sending the state if either changed"""
+    playing = bool(transport.isPlaying())
+    recording = bool(transport.isRecording())
+    if playing != project_state["playing"] or recording != project_state["recording"]:
+        project_state["playing"] = playing
+        project_state["recording"] = recording
+        send_sysex(SYSEX_STATE, 0, encode_project_state())
+
+def encode_project_state():
+    """
+    Encode project_state as a SYSEX_STATE payload
+    
+    Returns:
+        list: Tempo as 2 values (14 bits in TEMPO_STEPS_PER_BPM steps from
+              TEMPO_MIN), PPQ as 2 values, varint pattern, varint pattern
+              count, varint channel, varint channel count, STATE_* flags
+    """
+    tempo = int(round((project_state["tempo"] - TEMPO_MIN) * TEMPO_STEPS_PER_BPM))
+    tempo = max(0, min(tempo, 0x3FFF))
+    ppq = project_state["ppq"] & 0x3FFF
+    payload = [tempo >> 7, tempo & 0x7F, ppq >> 7, ppq & 0x7F]
+    payload.extend(int_to_varint(project_state["pattern"]))
+    payload.extend(int_to_varint(project_state["pattern_count"]))
+    payload.extend(int_to_varint(max(0, project_state["channel"])))
+    payload.extend(int_to_varint(project_state["channel_count"]))
+    flags = 0
+    if project_state["playing"]:
+        flags |= STATE_PLAYING
+    if project_state["recording"]:
+        flags |= STATE_RECORDING
+    payload.append(flags)
+    return payload
 
 def OnMidiIn(event):
     """Called whenever the device sends a MIDI message to FL Studio"""
@@ -91,6 +457,81 @@ def change_tempo(bpm):
         tempo_value,
         midi.REC_Control | midi.REC_UpdateControl
     )
+    # Recordings read the tempo from the mirror, so it can't wait for OnTempoChange
+    project_state["tempo"] = tempo_value / 1000
+    send_sysex(SYSEX_STATE, 0, encode_project_state())
+
+def set_tempo(bpm):
+    """
+    Change the tempo, or once the current recording is done if one is running
+    
+    A recording schedules its notes for the tempo it started with, so the
+    new tempo is handed to it and applied where it restores the tempo.
+    """
+    if active_recording is not None:
+        active_recording.original_tempo = bpm
+        log(LOG_INFO, "Tempo %s BPM will be applied after the current recording", bpm)
+    else:
+        change_tempo(bpm)
+        log(LOG_INFO, "Tempo changed to %s BPM", bpm)
+
+def handle_control_message(event):
+    """
+    Handle a command on the control channel
+    
+    A pitch bend sets the tempo in 1/32 BPM steps, a CC_TRANSPORT controller
+    runs a TRANSPORT_* command. Everything on the channel is marked handled
+    so it never reaches an instrument.
+    """
+    event.handled = True
+    message_type = event.status & 0xF0
+    
+    if message_type == midi.MIDI_PITCHBEND:
+        value = (event.data2 << 7) | event.data1
+        set_tempo(TEMPO_MIN + value / TEMPO_STEPS_PER_BPM)
+    
+    elif message_type == midi.MIDI_CONTROLCHANGE and event.data1 == CC_TRANSPORT:
+        command = event.data2
+        if command == TRANSPORT_STOP:
+            if active_recording is not None:
+                log(LOG_INFO, "Stop requested, cancelling %d queued recordings", len(recording_queue) + 1)
+                del recording_queue[:]
+                active_recording.cancel()
+            else:
+                transport.stop()
+        elif active_recording is not None:
+            log(LOG_WARNING, "Ignoring transport command %d while recording", command)
+        elif command == TRANSPORT_PLAY:
+            if not transport.isPlaying():
+                transport.start()
+        elif command == TRANSPORT_RECORD:
+            transport.record()
+        elif command == TRANSPORT_REWIND:
+            transport.setSongPos(0, 2)  # 2 = SONGLENGTH_ABSTICKS
+        else:
+            log(LOG_WARNING, "Unknown transport command %d", command)
+
+def get_project_tempo():
+    """
+    Get the current project tempo from the mirrored project state
+    
+    Returns:
+        float: Tempo in beats per minute
+    """
+    return project_state["tempo"]
+
+def read_project_tempo():
+    """
+    Read the current project tempo from FL Studio
+    
+    Returns:
+        float: Tempo in beats per minute (120 if it can't be read)
+    """
+    try:
+        import mixer
+        return mixer.getCurrentTempo() / 1000
+    except (ImportError, AttributeError):
+        return 120
 
 def process_received_midi(note, velocity):
 
@@ -129,10 +570,10 @@ def process_received_midi(note, velocity):
         # Apply to the correct parameter
         if decimal_target == "length":
             current_length = (current_length or 0) + decimal_value
-            print(f"Set length decimal: {current_length:.2f}")
+            log(LOG_DEBUG, "Set length decimal: %.2f", current_length)
         elif decimal_target == "position":
             current_position = (current_position or 0) + decimal_value
-            print(f"Set position decimal: {current_position:.2f}")
+            log(LOG_DEBUG, "Set position decimal: %.2f", current_position)
             
         decimal_state = 0
         return False
@@ -141,10 +582,10 @@ def process_received_midi(note, velocity):
         # This is a whole number part for a specific parameter
         if decimal_target == "length":
             current_length = float(note)
-            print(f"Set length whole: {current_length:.2f}")
+            log(LOG_DEBUG, "Set length whole: %.2f", current_length)
         elif decimal_target == "position":
             current_position = float(note)
-            print(f"Set position whole: {current_position:.2f}")
+            log(LOG_DEBUG, "Set position whole: %.2f", current_position)
         return False
         
     else:
@@ -163,201 +604,734 @@ def process_received_midi(note, velocity):
             current_length = 1.0
         if current_position is None:
             current_position = 0.0
-        print(f"Started new note: {current_note}, velocity: {current_velocity}")
+        log(LOG_DEBUG, "Started new note: %d, velocity: %d", current_note, current_velocity)
         
         return add_note
 
 
 def OnMidiMsg(event, timestamp=0):
     """Called when a processed MIDI message is received"""
+    note_decoder.feed(event)
+
+class NoteDecoder:
+    """
+    Decoder for melodies sent one MIDI note per value
     
-    global receiving_mode, message_count, messages_received
-    global current_note, current_velocity, current_length, current_position
-    global decimal_state, decimal_target, midi_notes_array
-    
-    if 'receiving_mode' not in globals():
-        global receiving_mode
-        receiving_mode = False
-    
-    if 'note_count' not in globals():
-        global note_count
-        note_count = 0
-    
-    if 'values_received' not in globals():
-        global values_received
-        values_received = 0
-    
-    if 'midi_data' not in globals():
-        global midi_data
-        midi_data = []
-    
-    if 'midi_notes_array' not in globals():
-        global midi_notes_array
-        midi_notes_array = []
-    
-    # Only process Note On messages with velocity > 0
-    if event.status >= midi.MIDI_NOTEON and event.status < midi.MIDI_NOTEON + 16 and event.data2 > 0:
-        note_value = event.data1
-        
-        # Toggle receiving mode with note 0
-        if note_value == 0 and not receiving_mode:
-            receiving_mode = True
-            print("Started receiving MIDI notes")
-            midi_data = []
-            note_count = 0
-            values_received = 0
-            midi_notes_array = []
-            event.handled = True
+    Note 0 starts a transfer, the next note is the note count, and every
+    following note is one of the 6 NOTE_FORMAT_LEGACY values of a note. The
+    transfer ends after note_count notes, or early if a note's last value
+    is 127. Messages on the control channel go to handle_control_message in
+    any state.
+    
+    Each message costs one table lookup on (state, message kind). Values are
+    collected in a fixed 6-slot buffer that is turned into a note as soon as
+    it is full.
+    """
+    
+    __slots__ = ('state', 'note_count', 'values', 'value_index', 'notes', 'started')
+    
+    # States
+    IDLE = 0
+    COUNT = 1    # Waiting for the note count
+    VALUES = 2   # Collecting note values
+    
+    # Message kinds besides the MIDI status nibbles
+    KIND_CONTROL = 0x100
+    KIND_NOTE_ZERO = 0x101  # Note on with note number 0 while idle
+    
+    def __init__(self):
+        self.values = [0] * 6
+        self.reset()
+    
+    def reset(self):
+        """Drop any transfer in progress"""
+        self.state = NoteDecoder.IDLE
+        self.note_count = 0
+        self.value_index = 0
+        self.notes = []
+        self.started = 0.0
+    
+    def feed(self, event):
+        """Handle one MIDI message"""
+        status = event.status
+        if status & 0x0F == CONTROL_CHANNEL:
+            kind = NoteDecoder.KIND_CONTROL
+        else:
+            kind = status & 0xF0
+            if kind == midi.MIDI_NOTEON:
+                if event.data2 == 0:
+                    return
+                if event.data1 == 0 and self.state == NoteDecoder.IDLE:
+                    kind = NoteDecoder.KIND_NOTE_ZERO
+        
+        handler = NoteDecoder.DISPATCH.get((self.state, kind))
+        if handler is not None:
+            handler(self, event)
+    
+    def on_control(self, event):
+        handle_control_message(event)
+    
+    def on_start(self, event):
+        self.reset()
+        self.state = NoteDecoder.COUNT
+        self.started = time.perf_counter()
+        event.handled = True
+        log(LOG_INFO, "Started receiving MIDI notes")
+    
+    def on_count(self, event):
+        self.note_count = event.data1
+        self.state = NoteDecoder.VALUES
+        event.handled = True
+        log(LOG_INFO, "Expecting %d notes", self.note_count)
+    
+    def on_value(self, event):
+        event.handled = True
+        values = self.values
+        values[self.value_index] = event.data1
+        self.value_index += 1
+        if self.value_index < 6:
             return
         
-        # Only process further messages if in receiving mode
-        if not receiving_mode:
-            return
+        self.value_index = 0
+        note = (values[0], values[1], values[2] + values[3] / 10.0, values[4] + values[5] / 10.0)
+        self.notes.append(note)
+        log(LOG_DEBUG, "Added note %d: note=%d, velocity=%d, length=%.1f, position=%.1f",
+            len(self.notes), note[0], note[1], note[2], note[3])
+        
+        if len(self.notes) >= self.note_count or values[5] == 127:
+            notes = self.notes
+            log(LOG_INFO, "Received all %d notes or termination signal", len(notes))
+            # Timed per transfer, a timer per message would cost as much as decoding it
+            time_metric("midi_transfer", self.started)
+            self.reset()
+            record_notes_batch(notes)
+
+NoteDecoder.DISPATCH = {
+    (NoteDecoder.IDLE, NoteDecoder.KIND_CONTROL): NoteDecoder.on_control,
+    (NoteDecoder.COUNT, NoteDecoder.KIND_CONTROL): NoteDecoder.on_control,
+    (NoteDecoder.VALUES, NoteDecoder.KIND_CONTROL): NoteDecoder.on_control,
+    (NoteDecoder.IDLE, NoteDecoder.KIND_NOTE_ZERO): NoteDecoder.on_start,
+    (NoteDecoder.COUNT, midi.MIDI_NOTEON): NoteDecoder.on_count,
+    (NoteDecoder.VALUES, midi.MIDI_NOTEON): NoteDecoder.on_value,
+}
+
+note_decoder = NoteDecoder()
+
+def decode_note_values(values):
+    """
+    Decode a flat list of note values (6 per note) into note tuples
+    
+    Args:
+        values (list): Values in the order note, velocity, length whole,
+                       length decimal, position whole, position decimal
+                       
+    Returns:
+        list: Tuples of (note, velocity, length_beats, position_beats)
+    """
+    notes = []
+    for i in range(0, len(values) - 5, 6):
+        length = values[i+2] + (values[i+3] / 10.0)
+        position = values[i+4] + (values[i+5] / 10.0)
+        notes.append((values[i], values[i+1], length, position))
+    return notes
+
+def decode_note_ticks(values, ppq):
+    """
+    Decode values in NOTE_FORMAT_TICKS into note tuples
+    
+    Args:
+        values (list): Repeated note, velocity, varint delta ticks, varint length ticks
+        ppq (int): Ticks per beat used by the sender
         
-        # Second message is the note count
-        if note_count == 0:
-            note_count = note_value
-            print(f"Expecting {note_count} notes")
-            event.handled = True
-            return
+    Returns:
+        list: Tuples of (note, velocity, length_beats, position_beats)
+    """
+    notes = []
+    index = 0
+    tick = 0
+    try:
+        while index < len(values):
+            note = values[index]
+            velocity = values[index+1]
+            delta, index = read_varint(values, index + 2)
+            length, index = read_varint(values, index)
+            tick += delta
+            notes.append((note, velocity, length / ppq, tick / ppq))
+    except IndexError:
+        log(LOG_WARNING, "Note data ended mid-note after %d notes", len(notes))
+    return notes
+
+def decode_note_compressed(values, ppq):
+    """
+    Decode values in NOTE_FORMAT_COMPRESSED into note tuples
+    
+    Each record is a NOTE_* flags byte followed by the fields that changed
+    (note, velocity, varint delta ticks, varint length ticks) and, with
+    NOTE_REPEAT, a varint count of extra copies at the same spacing.
+    
+    Args:
+        values (list): Encoded records
+        ppq (int): Ticks per beat used by the sender
         
-        # All subsequent messages are MIDI values (6 per note)
-        midi_data.append(note_value)
-        values_received += 1
-        
-        # Process completed notes (every 6 values)
-        if len(midi_data) >= 6 and len(midi_data) % 6 == 0:
-            # Process the last complete note
-            i = len(midi_data) - 6
-            note = midi_data[i]
-            velocity = midi_data[i+1]
-            length_whole = midi_data[i+2]
-            length_decimal = midi_data[i+3]
-            position_whole = midi_data[i+4]
-            position_decimal = midi_data[i+5]
-            
-            # Calculate full values
-            length = length_whole + (length_decimal / 10.0)
-            position = position_whole + (position_decimal / 10.0)
+    Returns:
+        list: Tuples of (note, velocity, length_beats, position_beats)
+    """
+    notes = []
+    index = 0
+    tick = 0
+    note = velocity = length = delta = 0
+    try:
+        while index < len(values):
+            flags = values[index]
+            index += 1
+            if not flags & NOTE_SAME_NOTE:
+                note = values[index]
+                index += 1
+            if not flags & NOTE_SAME_VELOCITY:
+                velocity = values[index]
+                index += 1
+            if not flags & NOTE_SAME_DELTA:
+                delta, index = read_varint(values, index)
+            if not flags & NOTE_SAME_LENGTH:
+                length, index = read_varint(values, index)
+            repeats = 0
+            if flags & NOTE_REPEAT:
+                repeats, index = read_varint(values, index)
             
-            # Add to notes array
-            midi_notes_array.append((note, velocity, length, position))
-            print(f"Added note: note={note}, velocity={velocity}, length={length:.1f}, position={position:.1f}")
-            print(f"Current array size: {len(midi_notes_array)}")
-
-            if len(midi_notes_array) >= note_count or note_value == 127:
-                print(f"Received all {len(midi_notes_array)} notes or termination signal")
-                receiving_mode = False
-                
-                # Only process if we have actual notes
-                if midi_notes_array:
-                    # Print all collected notes
-                    print(f"Collected {len(midi_notes_array)} notes:")
-                    for i, (note, vel, length, pos) in enumerate(midi_notes_array):
-                        print(f"  Note {i+1}: note={note}, velocity={vel}, length={length:.1f}, position={pos:.1f}")
-                    
-                    print("\nFinal array:")
-                    print(midi_notes_array)
-                    
-                    # Process the notes using the record_notes_batch function
-                    record_notes_batch(midi_notes_array)
-                
-                event.handled = True
+            for _ in range(repeats + 1):
+                tick += delta
+                notes.append((note, velocity, length / ppq, tick / ppq))
+    except IndexError:
+        log(LOG_WARNING, "Note data ended mid-note after %d notes", len(notes))
+    return notes
+
+def use_phrase(key, notes=None):
+    """
+    Look up a cached phrase, or store one, marking it most recently used
+    
+    Returns:
+        list: The phrase's notes, or None if it isn't cached
+    """
+    if notes is None:
+        notes = phrase_cache.pop(key, None)
+        if notes is None:
+            return None
+    else:
+        phrase_cache.pop(key, None)
+    phrase_cache[key] = notes
+    while len(phrase_cache) > PHRASE_CACHE_SIZE:
+        del phrase_cache[next(iter(phrase_cache))]
+    return notes
+
+def decode_note_phrases(values, ppq):
+    """
+    Decode values in NOTE_FORMAT_PHRASES into note tuples
+    
+    PHRASE_DEFINE stores a phrase in the cache, PHRASE_PLAY adds a cached
+    phrase's notes at a start tick, transposed. Replays of phrases that
+    aren't cached are counted in phrase_misses.
+    
+    Args:
+        values (list): Encoded operations
+        ppq (int): Ticks per beat used by the sender
+        
+    Returns:
+        list: Tuples of (note, velocity, length_beats, position_beats)
+    """
+    global phrase_misses
+    phrase_misses = 0
+    notes = []
+    index = 0
+    try:
+        while index < len(values):
+            operation = values[index]
+            key = midi_notes_to_int(values[index + 1:index + 5])
+            index += 5
+            if operation == PHRASE_DEFINE:
+                note_count, index = read_varint(values, index)
+                value_count, index = read_varint(values, index)
+                phrase = decode_note_compressed(values[index:index + value_count], ppq)[:note_count]
+                index += value_count
+                use_phrase(key, phrase)
+            elif operation == PHRASE_PLAY:
+                start, index = read_varint(values, index)
+                transpose = values[index]
+                index += 1
+                phrase = use_phrase(key)
+                if phrase is None:
+                    phrase_misses += 1
+                    count_metric("phrase_misses")
+                    continue
+                start /= ppq
+                for note, velocity, length, position in phrase:
+                    notes.append((min(127, note + transpose), velocity, length, start + position))
+            else:
+                log(LOG_WARNING, "Unknown phrase operation %d", operation)
+                break
+    except IndexError:
+        log(LOG_WARNING, "Phrase data ended mid-operation after %d notes", len(notes))
+    return notes
+
+def decode_note_channels(values, ppq):
+    """
+    Decode values in NOTE_FORMAT_CHANNELS into note tuples with a channel
+    
+    Each part is decoded in its own format. phrase_misses counts the
+    replayed phrases that weren't cached across all parts.
+    
+    Args:
+        values (list): Encoded parts
+        ppq (int): Ticks per beat used by the sender
+        
+    Returns:
+        list: Tuples of (note, velocity, length_beats, position_beats, channel),
+              channel None for notes meant for the default channel
+    """
+    global phrase_misses
+    notes = []
+    misses = 0
+    index = 0
+    while index < len(values):
+        channel, index = read_varint(values, index)
+        note_format = values[index]
+        note_count, index = read_varint(values, index + 1)
+        value_count, index = read_varint(values, index)
+        part = decode_notes(values[index:index + value_count], note_format, ppq)[:note_count]
+        index += value_count
+        if note_format == NOTE_FORMAT_PHRASES:
+            misses += phrase_misses
+        channel = channel - 1 if channel else None
+        notes.extend((note, velocity, length, position, channel)
+                     for note, velocity, length, position in part)
+    phrase_misses = misses
+    return notes
+
+def decode_notes(values, note_format, ppq):
+    """
+    Decode transferred note values according to their NOTE_FORMAT_*
+    
+    Returns:
+        list: Tuples of (note, velocity, length_beats, position_beats), with
+              a channel added in NOTE_FORMAT_CHANNELS
+    """
+    if note_format == NOTE_FORMAT_CHANNELS:
+        return decode_note_channels(values, ppq)
+    if note_format == NOTE_FORMAT_COMPRESSED:
+        return decode_note_compressed(values, ppq)
+    if note_format == NOTE_FORMAT_PHRASES:
+        return decode_note_phrases(values, ppq)
+    if note_format == NOTE_FORMAT_TICKS:
+        return decode_note_ticks(values, ppq)
+    if note_format == NOTE_FORMAT_LEGACY:
+        return decode_note_values(values)
+    log(LOG_WARNING, "Unknown note format %d", note_format)
+    return []
+
+def send_sysex(command, seq=0, payload=()):
+    """
+    Send a SysEx frame back to trigger.py through the device's MIDI output
+    
+    Does nothing if no output port is assigned to the Test Controller.
+    """
+    if not device.isAssigned():
+        return
+    seq %= SEQ_MODULO
+    data = [0xF0, SYSEX_MANUFACTURER_ID, command, seq >> 7, seq & 0x7F]
+    data.extend(payload)
+    data.extend(frame_crc(data[2:]))
+    data.append(0xF7)
+    device.midiOutSysex(bytes(data))
+
+def OnSysEx(event):
+    """Called when a SysEx message is received"""
+    data = event.sysex
+    # F0 <manufacturer> <command> <seq> <seq> <payload...> <CRC x3> F7
+    if data is None or len(data) < 6 + SYSEX_CRC_SIZE or data[1] != SYSEX_MANUFACTURER_ID:
+        return
+    event.handled = True
+    started = time.perf_counter()
+    count_metric("sysex_frames")
+    sysex_decoder.feed(data)
+    time_metric("sysex_frame", started)
+
+class SysexDecoder:
+    """
+    Decoder for SysEx frames from trigger.py
+    
+    Frames are checked, put back in sequence order and handed to one handler
+    per command through a table, like NoteDecoder. A transfer session runs
+    from a SYSEX_MELODY_BEGIN frame through numbered data frames to a
+    SYSEX_MELODY_END frame, which records (or runs) what was collected. The
+    single-frame commands each start and end a sequence of their own.
+    
+    Each handler returns the status a final frame is acknowledged with.
+    """
+    
+    __slots__ = ('expected_seq', 'pending', 'last_status', 'first_frame', 'metrics_reply', 'receiving',
+                 'session', 'flags', 'note_format', 'ppq', 'note_count', 'chunk_total',
+                 'chunks_received', 'values')
+    
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        """Forget the sequence and drop any session in progress"""
+        self.expected_seq = 0
+        self.pending = {}      # seq -> (command, payload) for frames that arrived ahead of a gap
+        self.last_status = []  # Status the last frame was acknowledged with, empty unless it was final
+        self.first_frame = None  # (command, seq, payload) of the frame that started the sequence
+        self.metrics_reply = []  # SYSEX_METRICS payload sent for the last metrics request
+        self.receiving = False
+        self.session = 0
+        self.flags = 0
+        self.note_format = NOTE_FORMAT_LEGACY
+        self.ppq = 96
+        self.note_count = 0
+        self.chunk_total = 0
+        self.chunks_received = 0
+        self.values = []
+    
+    def feed(self, data):
+        """Handle one of our SysEx messages, F0 to F7"""
+        # A damaged frame can't be trusted for anything, not even its seq. Ask
+        # for the first frame still missing; a damaged later frame shows up as
+        # a gap once the frames after it arrive.
+        if list(frame_crc(data[2:-1 - SYSEX_CRC_SIZE])) != list(data[-1 - SYSEX_CRC_SIZE:-1]):
+            count_metric("sysex_frames_corrupt")
+            self.send_nack()
+            return
+        
+        command = data[2]
+        seq = (data[3] << 7) | data[4]
+        payload = data[5:-1 - SYSEX_CRC_SIZE]
+        
+        # Frames are handled in sequence order. trigger.py can spread a transfer
+        # over several ports, so a frame may overtake the one before it; it is
+        # held until the gap is filled and the missing frames are NACKed, which
+        # trigger.py ignores for frames it only just sent. Duplicates and frames
+        # too far ahead are dropped and the last frame handled acknowledged
+        # again, with its status if it was final, so the sender resends from
+        # there or learns the status its first acknowledgement carried.
+        if command in SYSEX_FIRST_FRAMES:
+            frame = (command, seq, bytes(payload))
+            if frame == self.first_frame:
+                # The frame that started this sequence, resent because its
+                # acknowledgement was lost. Running it again would record the
+                # transfer twice, so only repeat the replies.
+                count_metric("sysex_frames_dropped")
+                if command == SYSEX_METRICS_REQUEST:
+                    send_sysex(SYSEX_METRICS, seq, self.metrics_reply)
+                send_sysex(SYSEX_ACK, self.expected_seq - 1, self.last_status)
                 return
+            self.first_frame = frame
+            self.pending.clear()
+        elif seq != self.expected_seq:
+            if (seq - self.expected_seq) % SEQ_MODULO < SYSEX_REORDER_WINDOW:
+                self.pending[seq] = (command, payload)
+                count_metric("sysex_frames_reordered")
+                self.send_nack()
+            else:
+                count_metric("sysex_frames_dropped")
+                send_sysex(SYSEX_ACK, self.expected_seq - 1, self.last_status)
+            return
         
-        # Check if we've received all expected notes
-        # if len(midi_notes_array) >= note_count:
-        #     print(f"Received all {note_count} notes")
-        #     receiving_mode = False
-            
-        #     # Print all collected notes
-        #     print(f"Collected {len(midi_notes_array)} notes:")
-        #     for i, (note, vel, length, pos) in enumerate(midi_notes_array):
-        #         print(f"  Note {i+1}: note={note}, velocity={vel}, length={length:.1f}, position={pos:.1f}")
-            
-        #     print("\nFinal array:")
-        #     print(midi_notes_array)
+        self.handle_frame(command, seq, payload)
+        pending = self.pending
+        while self.expected_seq in pending:
+            seq = self.expected_seq
+            command, payload = pending.pop(seq)
+            self.handle_frame(command, seq, payload)
+    
+    def send_nack(self):
+        """
+        Acknowledge the frames handled so far and list the ones still missing
+        
+        The missing frames are the gaps between the next expected frame and the
+        newest one held in pending, at most SYSEX_NACK_MAX of them.
+        """
+        span = 1
+        for seq in self.pending:
+            span = max(span, (seq - self.expected_seq) % SEQ_MODULO + 1)
+        payload = []
+        for offset in range(span):
+            seq = (self.expected_seq + offset) % SEQ_MODULO
+            if seq not in self.pending:
+                payload.extend((seq >> 7, seq & 0x7F))
+                if len(payload) >= 2 * SYSEX_NACK_MAX:
+                    break
+        send_sysex(SYSEX_NACK, self.expected_seq - 1, payload)
+    
+    def handle_frame(self, command, seq, payload):
+        """
+        Act on a frame, called in sequence order by feed
+        
+        Args:
+            command (int): SYSEX_* command
+            seq (int): Sequence number of the frame
+            payload (bytes): Values between the sequence number and the CRC
+        """
+        self.expected_seq = (seq + 1) % SEQ_MODULO
+        # Final frames are acknowledged once they have been handled, with a status
+        final = command in SYSEX_FINAL_FRAMES
+        if not final:
+            self.last_status = []
+            send_sysex(SYSEX_ACK, seq)
+        
+        handler = SysexDecoder.DISPATCH.get(command)
+        status = handler(self, seq, payload) if handler is not None else SYSEX_STATUS_OK
+        
+        if final:
+            self.last_status = [status]
+            send_sysex(SYSEX_ACK, seq, self.last_status)
+    
+    def in_session(self, payload):
+        """Whether a data or end frame belongs to the session being received"""
+        # Frames left over from an abandoned session are ignored
+        return self.receiving and payload[0] == self.session
+    
+    def on_begin(self, seq, payload):
+        self.receiving = True
+        self.session = payload[0]
+        self.flags = payload[1]
+        self.note_format = payload[2]
+        self.ppq = midi_notes_to_int(payload[3:5])
+        self.note_count, index = read_varint(payload, 5)
+        self.chunk_total, index = read_varint(payload, index)
+        self.chunks_received = 0
+        self.values = []
+        log(LOG_INFO, "Started SysEx session %d, expecting %d notes in %d chunks",
+            self.session, self.note_count, self.chunk_total)
+        return SYSEX_STATUS_OK
+    
+    def on_data(self, seq, payload):
+        if not self.in_session(payload):
+            return SYSEX_STATUS_OK
+        chunk_index, index = read_varint(payload, 1)
+        if chunk_index != self.chunks_received:
+            log(LOG_WARNING, "Expected chunk %d, got %d", self.chunks_received, chunk_index)
+        self.chunks_received += 1
+        self.values.extend(payload[index:])
+        return SYSEX_STATUS_OK
+    
+    def on_end(self, seq, payload):
+        if not self.in_session(payload):
+            return SYSEX_STATUS_OK
+        self.receiving = False
+        if self.chunks_received != self.chunk_total:
+            log(LOG_WARNING, "Received %d of %d chunks", self.chunks_received, self.chunk_total)
+        values = self.values
+        self.values = []
+        if self.note_format == NOTE_FORMAT_BATCH:
+            return run_batch(values, self.ppq)
+        
+        decode_started = time.perf_counter()
+        notes = decode_notes(values, self.note_format, self.ppq)[:self.note_count]
+        time_metric("decode", decode_started)
+        log(LOG_INFO, "Received %d of %d notes in session %d", len(notes), self.note_count, self.session)
+        if self.note_format in (NOTE_FORMAT_PHRASES, NOTE_FORMAT_CHANNELS) and phrase_misses:
+            # trigger.py resends the transfer with every phrase defined
+            log(LOG_INFO, "%d replayed phrases not cached, waiting for them to be resent", phrase_misses)
+            return SYSEX_STATUS_PHRASE_MISSING
+        if notes:
+            record_notes_batch(notes, fast=bool(self.flags & SYSEX_FLAG_FAST_RECORD))
+        return SYSEX_STATUS_OK
+    
+    def on_grid(self, seq, payload):
+        try:
+            apply_grid(payload)
+        except Exception as e:
+            log(LOG_ERROR, "Error applying grid: %s", e)
+            return SYSEX_STATUS_ERROR
+        return SYSEX_STATUS_OK
+    
+    def on_state_request(self, seq, payload):
+        refresh_project_state(force=True)
+        return SYSEX_STATUS_OK
+    
+    def on_metrics_request(self, seq, payload):
+        self.metrics_reply = encode_metrics()
+        send_sysex(SYSEX_METRICS, seq, self.metrics_reply)
+        if payload and payload[0]:
+            metric_counters.clear()
+            metric_histograms.clear()
+        return SYSEX_STATUS_OK
 
-        #     record_notes_batch(midi_notes_array)
-            
-        #     # Process the notes here if needed
-        #     # record_notes_batch(midi_notes_array)
+SysexDecoder.DISPATCH = {
+    SYSEX_MELODY_BEGIN: SysexDecoder.on_begin,
+    SYSEX_MELODY_DATA: SysexDecoder.on_data,
+    SYSEX_MELODY_END: SysexDecoder.on_end,
+    SYSEX_GRID: SysexDecoder.on_grid,
+    SYSEX_STATE_REQUEST: SysexDecoder.on_state_request,
+    SYSEX_METRICS_REQUEST: SysexDecoder.on_metrics_request,
+}
+
+sysex_decoder = SysexDecoder()
+
+def apply_grid(values):
+    """
+    Write the step grids of a SYSEX_GRID frame and redraw once
+    
+    Every step of each listed channel is set, so steps left off in the grid
+    are cleared. Steps that are on also get their velocity.
+    
+    Args:
+        values (list): Frame payload, varint pattern (0 for the current one),
+                       varint step count, varint channel count, then per
+                       channel a varint index, a bitmap of 7 steps per value
+                       and one velocity per step that is on
+    """
+    pattern, index = read_varint(values, 0)
+    step_count, index = read_varint(values, index)
+    channel_count, index = read_varint(values, index)
+    if pattern:
+        patterns.jumpToPattern(pattern)
+    else:
+        pattern = patterns.patternNumber()
+    bitmap_size = (step_count + 6) // 7
+    
+    for _ in range(channel_count):
+        channel, index = read_varint(values, index)
+        bitmap = values[index:index + bitmap_size]
+        index += bitmap_size
+        for step in range(step_count):
+            enabled = bool((bitmap[step // 7] >> (step % 7)) & 1)
+            channels.setGridBit(channel, step, enabled)
+            if enabled:
+                channels.setStepParameterByIndex(channel, pattern, step, midi.pVelocity, values[index])
+                index += 1
+    
+    commit_pattern_changes(pattern)
+    log(LOG_INFO, "Wrote %d steps on %d channels of pattern %d", step_count, channel_count, pattern)
+
+def read_name(values, index):
+    """
+    Read a varint length followed by that many ASCII characters
+    
+    Returns:
+        tuple: (name, index after it)
+    """
+    length, index = read_varint(values, index)
+    if index + length > len(values):
+        raise IndexError("name runs past the end of the data")
+    return ''.join(chr(v) for v in values[index:index + length]), index + length
+
+def decode_batch(values, ppq):
+    """
+    Decode NOTE_FORMAT_BATCH data into a list of operations
+    
+    Everything is decoded before anything runs, so a damaged batch changes
+    nothing in the project.
+    
+    Returns:
+        list: Tuples of (BATCH_* operation, arguments...)
         
-        # event.handled = True
+    Raises:
+        IndexError, ValueError: If the data is damaged
+    """
+    operations = []
+    index = 0
+    while index < len(values):
+        operation = values[index]
+        index += 1
+        if operation in (BATCH_SELECT_PATTERN, BATCH_SELECT_CHANNEL):
+            number, index = read_varint(values, index)
+            operations.append((operation, number))
+        elif operation in (BATCH_NAME_PATTERN, BATCH_NAME_CHANNEL):
+            number, index = read_varint(values, index)
+            name, index = read_name(values, index)
+            operations.append((operation, number, name))
+        elif operation == BATCH_GRID:
+            length, index = read_varint(values, index)
+            operations.append((operation, values[index:index + length]))
+            index += length
+        elif operation == BATCH_NOTES:
+            flags = values[index]
+            note_format = values[index + 1]
+            note_count, index = read_varint(values, index + 2)
+            value_count, index = read_varint(values, index)
+            notes = decode_notes(values[index:index + value_count], note_format, ppq)[:note_count]
+            index += value_count
+            operations.append((operation, notes, bool(flags & SYSEX_FLAG_FAST_RECORD)))
+        elif operation == BATCH_TEMPO:
+            value = midi_notes_to_int(values[index:index + 2])
+            index += 2
+            operations.append((operation, TEMPO_MIN + value / TEMPO_STEPS_PER_BPM))
+        else:
+            raise ValueError("unknown batch operation %d" % operation)
+    if index > len(values):
+        raise IndexError("batch data ended mid-operation")
+    return operations
+
+def run_batch(values, ppq):
+    """
+    Run a batch of operations as one transaction with a single redraw
+    
+    Args:
+        values (list): NOTE_FORMAT_BATCH data
+        ppq (int): Ticks per beat of the note operations
         
+    Returns:
+        int: SYSEX_STATUS_OK, or SYSEX_STATUS_ERROR if the batch was damaged
+             (nothing ran) or an operation failed (the ones before it ran)
+    """
+    try:
+        operations = decode_batch(values, ppq)
+    except (IndexError, ValueError) as e:
+        log(LOG_ERROR, "Damaged batch, nothing changed: %s", e)
+        return SYSEX_STATUS_ERROR
+    
+    channel = channels.selectedChannel()
+    pattern = patterns.patternNumber()
+    suspend_ui_refresh()
+    try:
+        for operation in operations:
+            kind = operation[0]
+            if kind == BATCH_SELECT_PATTERN:
+                pattern = operation[1]
+                patterns.jumpToPattern(pattern)
+            elif kind == BATCH_NAME_PATTERN:
+                patterns.setPatternName(operation[1], operation[2])
+            elif kind == BATCH_SELECT_CHANNEL:
+                channel = operation[1]
+                channels.selectOneChannel(channel)
+            elif kind == BATCH_NAME_CHANNEL:
+                channels.setChannelName(operation[1], operation[2])
+            elif kind == BATCH_GRID:
+                apply_grid(operation[1])
+            elif kind == BATCH_NOTES:
+                record_notes_batch(operation[1], fast=operation[2], channel=channel,
+                                   pattern=pattern)
+            elif kind == BATCH_TEMPO:
+                set_tempo(operation[1])
+        log(LOG_INFO, "Ran a batch of %d operations", len(operations))
+        return SYSEX_STATUS_OK
+    except Exception as e:
+        log(LOG_ERROR, "Batch stopped at an operation that failed: %s", e)
+        return SYSEX_STATUS_ERROR
+    finally:
+        resume_ui_refresh()
 
+def suspend_ui_refresh():
+    """Hold back commit_pattern_changes redraws until resume_ui_refresh"""
+    global ui_refresh_suspended
+    ui_refresh_suspended += 1
 
-    # elif note == 72:
-    #         collecting_tempo_notes = True
-    #         tempo_note_array = []
-    #         print("Started collecting notes for tempo change")
-    #         event.handled = True
-            
-    #     # End collection and apply tempo change
-    # elif note == 73:
-    #         if collecting_tempo_notes and tempo_note_array:
-    #             bpm = change_tempo_from_notes(tempo_note_array)
-    #             print(f"Tempo changed to {bpm} BPM from collected notes: {tempo_note_array}")
-    #             collecting_tempo_notes = False
-    #             tempo_note_array = []
-    #         else:
-    #             print("No tempo notes collected, tempo unchanged")
-    #         event.handled = True
-            
-    #     # Collect notes for tempo if in collection mode
-    # elif collecting_tempo_notes:
-    #         tempo_note_array.append(note)
-    #         print(f"Added note {note} to tempo collection, current array: {tempo_note_array}")
-    #         event.handled = True
-    
-    # Handle Control Change messages
-    # elif event.status >= midi.MIDI_CONTROLCHANGE and event.status < midi.MIDI_CONTROLCHANGE + 16:
-    #     # CC 100: Select channel to edit
-    #     if event.data1 == 100:
-    #         channel_to_edit = event.data2
-    #         channels.selectOneChannel(channel_to_edit)
-    #         print(f"Selected channel {channel_to_edit} for grid editing")
-    #         event.handled = True
-            
-    #     # CC 110: Select step to edit
-    #     elif event.data1 == 110:
-    #         step_to_edit = event.data2
-    #         print(f"Selected step {step_to_edit} for grid editing")
-    #         event.handled = True
-            
-    #     # CC 111: Toggle step on/off
-    #     elif event.data1 == 111:
-    #         enabled = event.data2 > 0
-    #         channels.setGridBit(channel_to_edit, step_to_edit, enabled)
-    #         print(f"Set grid bit for channel {channel_to_edit}, step {step_to_edit} to {enabled}")
-    #         commit_pattern_changes()  # Force UI update
-    #         event.handled = True
-            
-    #     # CC 112: Set step velocity/level
-    #     elif event.data1 == 112:
-    #         velocity = event.data2
-    #         channels.setStepLevel(channel_to_edit, step_to_edit, velocity)
-    #         print(f"Set step level for channel {channel_to_edit}, step {step_to_edit} to {velocity}")
-    #         commit_pattern_changes()  # Force UI update
-    #         event.handled = True
-        
-    #     # Process other CC messages
-    #     else:
-    #         # Handle other CC messages with your existing code...
-    #         pass
-    
-    # # Handle other MIDI message types if needed
-    # else:
-    #     # Process other MIDI message types
-    #     pass
-    
-    # Handle Note On messages with your existing code...
-    # [rest of your existing OnMidiMsg function]
-    #record_notes_batch(midi_notes_array)
+def resume_ui_refresh():
+    """Allow redraws again, doing the one that was held back if any"""
+    global ui_refresh_suspended, ui_refresh_pending
+    ui_refresh_suspended -= 1
+    if ui_refresh_suspended == 0 and ui_refresh_pending:
+        ui_refresh_pending = False
+        commit_pattern_changes()
 
 # Make sure your commit_pattern_changes function is defined:
 def commit_pattern_changes(pattern_num=None):
     """Force FL Studio to update the pattern data visually"""
+    global ui_refresh_pending
+    if ui_refresh_suspended:
+        ui_refresh_pending = True
+        return
+    
     if pattern_num is None:
         pattern_num = patterns.patternNumber()
     
@@ -371,13 +1345,13 @@ def commit_pattern_changes(pattern_num=None):
     playlist.refresh()
 def OnTransport(isPlaying):
     """Called when the transport state changes (play/stop)"""
-    print(f"Transport state changed: {'Playing' if isPlaying else 'Stopped'}")
-    return
+    log(LOG_DEBUG, "Transport state changed: %s", 'Playing' if isPlaying else 'Stopped')
+    refresh_project_state()
 
 def OnTempoChange(tempo):
     """Called when the tempo changes"""
-    print(f"Tempo changed to: {tempo} BPM")
-    return
+    log(LOG_DEBUG, "Tempo changed to: %s BPM", tempo)
+    refresh_project_state()
 
 
 # # Terminal interface functions
@@ -418,79 +1392,17 @@ def record_note(note=60, velocity=100, length_beats=1.0, position_beats=0.0, qua
         position_beats (float): Position to place note in beats from start
         quantize (bool): Whether to quantize the recording afterward
     """
-    # Make sure transport is stopped first
-    if transport.isPlaying():
-        transport.stop()
-    
-    # Get the current channel
-    channel = channels.selectedChannel()
-    
-    # Get the project's PPQ (pulses per quarter note)
-    ppq = general.getRecPPQ()
-    
-    # Calculate ticks based on beats
-    length_ticks = int(length_beats * ppq)
-    position_ticks = int(position_beats * ppq)
+    log(LOG_INFO, "Recording note %d to channel %d", note, channels.selectedChannel())
+    log(LOG_DEBUG, "Position: %s beats, Length: %s beats", position_beats, length_beats)
     
-    # Set playback position
-    transport.setSongPos(position_ticks, 2)  # 2 = SONGLENGTH_ABSTICKS
+    def finished():
+        # Quantize if requested
+        if quantize:
+            channels.quickQuantize(channels.selectedChannel())
+            log(LOG_INFO, "Recording quantized")
+        log(LOG_INFO, "Note %d recorded to piano roll", note)
     
-    # Toggle recording mode if needed
-    if not transport.isRecording():
-        transport.record()
-    
-    print(f"Recording note {note} to channel {channel}")
-    print(f"Position: {position_beats} beats, Length: {length_beats} beats")
-    
-    # Calculate the exact tick positions where we need to place note and note-off
-    start_tick = position_ticks
-    end_tick = start_tick + length_ticks
-    
-    # Start playback to begin recording
-    transport.start()
-    
-    # Record the note at the exact start position
-    channels.midiNoteOn(channel, note, velocity)
-    
-    # Get the current tempo (BPM)
-    tempo = 120  # Default fallback
-    
-    # Try to get actual tempo from the project
-    try:
-        import mixer
-        tempo = mixer.getCurrentTempo()
-        tempo = tempo/1000
-        print(f"Using project tempo: {tempo} BPM")
-    except (ImportError, AttributeError):
-        print("Using default tempo: 120 BPM")
-    
-    # Calculate the time to wait in seconds
-    seconds_to_wait = (length_beats * 60) / tempo
-    
-    print(f"Waiting for {seconds_to_wait:.2f} seconds...")
-    
-    # Wait the calculated time
-    time.sleep(seconds_to_wait)
-    
-    # Send note-off event
-    channels.midiNoteOn(channel, note, 0)
-    
-    # Stop playback
-    transport.stop()
-    
-    # Exit recording mode if it was active
-    if transport.isRecording():
-        transport.record()
-    
-    # Quantize if requested
-    if quantize:
-        channels.quickQuantize(channel)
-        print("Recording quantized")
-    
-    print(f"Note {note} recorded to piano roll")
-    
-    # Return to beginning
-    transport.setSongPos(0, 2)
+    record_notes_batch([(note, velocity, length_beats, position_beats)], on_complete=finished)
 
 def rec_hihat_pattern():
     """
@@ -498,13 +1410,7 @@ def rec_hihat_pattern():
     
     This creates a 4-bar hi-hat pattern with variations in velocity, rhythm, and types of hats
     """
-    # Stop playback and rewind to beginning first
-    if transport.isPlaying():
-        transport.stop()
-    
-    transport.setSongPos(0, 2)  # Go to the beginning
-    
-    print("Recording hi-hat pattern...")
+    log(LOG_INFO, "Recording hi-hat pattern...")
     
     # Common hi-hat MIDI notes:
     # 42 = Closed hi-hat
@@ -579,111 +1485,340 @@ def rec_hihat_pattern():
         (46, 120, 0.25, 15.875),# Open hat - final accent
     ]
     
-    # Record the hi-hat pattern using the batch recording function
-    record_notes_batch(hihat_pattern)
-    
-    print("Hi-hat pattern recording complete!")
-    
-    # Quantize the hi-hat pattern
-    channel = channels.selectedChannel()
-    channels.quickQuantize(channel)
+    def finished():
+        log(LOG_INFO, "Hi-hat pattern recording complete!")
+        
+        # Quantize the hi-hat pattern
+        channel = channels.selectedChannel()
+        channels.quickQuantize(channel)
     
-    # Return to beginning
-    transport.setSongPos(0, 2)
+    # Record the hi-hat pattern using the batch recording function
+    record_notes_batch(hihat_pattern, on_complete=finished)
 
-def record_notes_batch(notes_array):
+class Scheduler:
     """
-    Records a batch of notes to FL Studio, handling simultaneous notes properly
+    Cooperative queue of timed actions, driven by FL Studio's OnIdle callback
     
-    Args:
-        notes_array: List of tuples, each containing (note, velocity, length_beats, position_beats)
+    MIDI callbacks schedule work here and return immediately instead of
+    sleeping, so the script keeps decoding incoming messages while a
+    recording is running. It also tracks how far apart the OnIdle calls are,
+    so actions can tell whether the next call will come in time.
     """
-    # Sort notes by their starting position
-    sorted_notes = sorted(notes_array, key=lambda x: x[3])
     
-    # Group notes by their starting positions
-    position_groups = {}
-    for note in sorted_notes:
-        position = note[3]  # position_beats is the 4th element (index 3)
-        if position not in position_groups:
-            position_groups[position] = []
-        position_groups[position].append(note)
+    def __init__(self):
+        self.queue = []  # Heap of (due_time, order, action, args)
+        self.order = 0
+        self.idle_gap = IDLE_GAP_INITIAL  # Smoothed time between one OnIdle returning and the next
+        self.idle_ended = None
+    
+    def schedule_at(self, due_time, action, *args):
+        """Run action(*args) once time.perf_counter() reaches due_time"""
+        self.order += 1
+        heapq.heappush(self.queue, (due_time, self.order, action, args))
+    
+    def schedule(self, delay, action, *args):
+        """Run action(*args) after delay seconds"""
+        self.schedule_at(time.perf_counter() + delay, action, *args)
+    
+    def run_due(self):
+        """Run every action that is due, called from OnIdle"""
+        now = time.perf_counter()
+        if self.idle_ended is not None:
+            self.idle_gap += (now - self.idle_ended - self.idle_gap) / 8
+        while self.queue and self.queue[0][0] <= now:
+            _, _, action, args = heapq.heappop(self.queue)
+            try:
+                action(*args)
+            except Exception as e:
+                log(LOG_ERROR, "Error in scheduled action %s: %s", getattr(action, '__name__', action), e)
+        self.idle_ended = time.perf_counter()
+    
+    def clear(self):
+        """Drop every pending action"""
+        self.queue = []
+    
+    def __len__(self):
+        return len(self.queue)
+
+class RecordingJob:
+    """
+    A batch of notes recorded in one transport pass by the scheduler
+    
+    start() prepares the transport and schedules step(), which fires every
+    timeline event that is due and reschedules itself for the next one.
+    finish() stops the transport and restores the tempo and pattern, and
+    always runs, even if an event fails.
+    
+    Events are timed from the song position, not from when the transport
+    started. OnIdle only runs every 20 ms or so, so an event due before the
+    next call is waited for inside the current one and fires on its tick.
+    Each call waits for at most one event, so no callback blocks for more
+    than RECORD_WAIT_GAPS idle gaps; events closer together than that are
+    left to the next call.
+    """
     
-    # Process each position group
-    positions = sorted(position_groups.keys())
-    for position in positions:
-        notes_at_position = position_groups[position]
-        
-        # Find the longest note in this group to determine recording length
-        max_length = max(note[2] for note in notes_at_position)
-        
-        # Make sure transport is stopped first
-        if transport.isPlaying():
-            transport.stop()
-        
-        # Get the current channel
-        channel = channels.selectedChannel()
-        
-        # Get the project's PPQ (pulses per quarter note)
-        ppq = general.getRecPPQ()
+    def __init__(self, notes_array, fast=False, on_complete=None, channel=None, pattern=None):
+        self.notes_array = notes_array
+        self.fast = fast
+        self.on_complete = on_complete
+        self.channel = channel
+        self.pattern = pattern
+        self.restore_pattern = None
+        self.timeline = []
+        self.index = 0
+        self.started = 0.0
+        self.seconds_per_tick = 0.0
+        self.original_tempo = 120
+        self.tempo = 120
+        self.finished = False
+    
+    def start(self):
+        """Set up the transport and schedule the first step"""
+        self.original_tempo = get_project_tempo()
+        self.tempo = self.original_tempo
         
-        # Calculate ticks based on beats
-        position_ticks = int(position * ppq)
-        
-        # Set playback position
-        transport.setSongPos(position_ticks, 2)  # 2 = SONGLENGTH_ABSTICKS
-        
-        # Toggle recording mode if needed
-        if not transport.isRecording():
-            transport.record()
-        
-        print(f"Recording {len(notes_at_position)} simultaneous notes at position {position}")
-        
-        # Start playback to begin recording
-        transport.start()
-        
-        # Record all notes at this position simultaneously
-        for note, velocity, length, _ in notes_at_position:
-            channels.midiNoteOn(channel, note, velocity)
-        
-        # Get the current tempo
         try:
-            import mixer
-            tempo = mixer.getCurrentTempo()
-            tempo = tempo/1000
-        except (ImportError, AttributeError):
-            tempo = 120  # Default fallback
+            # Make sure transport is stopped first
+            if transport.isPlaying():
+                transport.stop()
             
-        print(f"Using tempo: {tempo} BPM")
-        
-        # Calculate the time to wait in seconds based on the longest note
-        seconds_to_wait = (max_length * 60) / tempo
-        
-        print(f"Waiting for {seconds_to_wait:.2f} seconds...")
-        
-        # Wait the calculated time
-        time.sleep(seconds_to_wait)
-        
-        # Send note-off events for all notes
-        for note, _, _, _ in notes_at_position:
-            channels.midiNoteOn(channel, note, 0)
+            # Record into the selected channel unless one was given
+            if self.channel is None:
+                self.channel = channels.selectedChannel()
+            if self.pattern is None:
+                self.pattern = patterns.patternNumber()
+            
+            # The project's PPQ (pulses per quarter note)
+            ppq = project_state["ppq"]
+            
+            self.timeline = build_note_timeline(self.notes_array, ppq, self.channel)
+            channel_count = channels.channelCount()
+            missing = set(event[3] for event in self.timeline if event[3] >= channel_count)
+            if missing:
+                log(LOG_WARNING, "Skipping notes for channels %s, the project has %d channels",
+                    sorted(missing), channel_count)
+                self.timeline = [event for event in self.timeline if event[3] < channel_count]
+                if not self.timeline:
+                    raise ValueError("No notes left to record")
+            
+            if self.fast:
+                fast_tempo = min(FAST_RECORD_TEMPO, self.fastest_exact_tempo(ppq))
+                if fast_tempo > self.original_tempo:
+                    self.tempo = fast_tempo
+                    log(LOG_INFO, "Fast recording at %s BPM (project tempo %s BPM)", self.tempo, self.original_tempo)
+                    change_tempo(self.tempo)
+            
+            start_tick = self.timeline[0][0]
+            self.seconds_per_tick = 60.0 / (self.tempo * ppq)
+            
+            log(LOG_INFO, "Recording %d notes in one pass from tick %d to %d at %s BPM",
+                len(self.notes_array), start_tick, self.timeline[-1][0], self.tempo)
+            
+            # Set playback position
+            transport.setSongPos(start_tick, 2)  # 2 = SONGLENGTH_ABSTICKS
+            
+            # Toggle recording mode if needed
+            if not transport.isRecording():
+                transport.record()
+            
+        except Exception:
+            self.finish()
+            raise
         
-        # Stop playback
-        transport.stop()
+        # Playback starts from OnIdle, so the MIDI callback that queued this
+        # recording returns right away
+        scheduler.schedule(0, self.step)
+    
+    def step(self):
+        """Fire the events that are due, waiting for at most one, then schedule the next step"""
+        if self.finished:
+            return
         
-        # Exit recording mode if it was active
-        if transport.isRecording():
-            transport.record()
+        try:
+            if not self.started:
+                # Start playback to begin recording
+                transport.start()
+                self.started = time.perf_counter()
+            
+            # A batch may select another pattern while this one records, so
+            # hold ours until the recording is done
+            current_pattern = patterns.patternNumber()
+            if current_pattern != self.pattern:
+                if self.restore_pattern is None:
+                    self.restore_pattern = current_pattern
+                patterns.jumpToPattern(self.pattern)
+            
+            read_at = time.perf_counter()
+            position = transport.getSongPos(2)  # 2 = SONGLENGTH_ABSTICKS
+            waited = False
+            while self.index < len(self.timeline):
+                tick, note, velocity, channel = self.timeline[self.index]
+                due = read_at + (tick - position) * self.seconds_per_tick
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    lead = scheduler.idle_gap * RECORD_WAIT_GAPS
+                    if waited or wait > lead:
+                        # After a wait this runs on the next OnIdle at the earliest
+                        scheduler.schedule_at(max(due - lead, time.perf_counter()), self.step)
+                        return
+                    time.sleep(wait)
+                    waited = True
+                channels.midiNoteOn(channel, note, velocity)
+                if velocity:
+                    add_metric_sample("note_lateness", time.perf_counter() - due)
+                    count_metric("notes_recorded")
+                self.index += 1
+        except Exception:
+            self.finish()
+            raise
+        
+        self.finish()
+    
+    def fastest_exact_tempo(self, ppq):
+        """
+        Highest tempo at which every event still fires on its tick
+        
+        step() waits for one event per call, so the event after it has to be
+        RECORD_WAIT_GAPS idle gaps away for the next OnIdle to catch it.
+        """
+        closest = min((b[0] - a[0] for a, b in zip(self.timeline, self.timeline[1:]) if b[0] > a[0]),
+                      default=None)
+        if closest is None:
+            return FAST_RECORD_TEMPO
+        return int(60.0 * closest / (ppq * scheduler.idle_gap * RECORD_WAIT_GAPS))
+    
+    def finish(self):
+        """Stop the transport, restore the tempo and pattern and start the next queued job"""
+        if self.finished:
+            return
+        self.finished = True
         
-        # Small pause between recordings to avoid potential issues
-        time.sleep(0.2)
+        try:
+            # Release anything still sounding if we stopped early
+            for tick, note, velocity, channel in self.timeline[self.index:]:
+                if velocity == 0:
+                    channels.midiNoteOn(channel, note, 0)
+            
+            # Stop playback
+            transport.stop()
+            
+            # Exit recording mode if it was active
+            if transport.isRecording():
+                transport.record()
+        finally:
+            if self.tempo != self.original_tempo:
+                change_tempo(self.original_tempo)
+                log(LOG_INFO, "Restored tempo to %s BPM", self.original_tempo)
+            
+            log(LOG_INFO, "All notes recorded successfully")
+            if self.started:
+                time_metric("record", self.started)
+            
+            # Return to beginning
+            transport.setSongPos(0, 2)
+            
+            # Go back to the pattern selected while we held ours
+            if self.restore_pattern is not None:
+                patterns.jumpToPattern(self.restore_pattern)
+            
+            _recording_finished(self)
+    
+    def cancel(self):
+        """Abort the recording, keeping whatever was recorded so far"""
+        self.on_complete = None
+        self.finish()
+
+# Scheduler driven by OnIdle, and recordings waiting for the transport
+scheduler = Scheduler()
+recording_queue = []
+active_recording = None
+
+def record_notes_batch(notes_array, fast=False, on_complete=None, channel=None, pattern=None):
+    """
+    Records a batch of notes to FL Studio, handling simultaneous notes properly
+    
+    Recording runs in the background from OnIdle, so this returns immediately.
+    Batches submitted while another one is recording wait for it to finish.
     
-    print("All notes recorded successfully")
+    Args:
+        notes_array: List of tuples, each containing (note, velocity, length_beats, position_beats),
+                     optionally followed by the channel to record that note into
+        fast (bool): Temporarily raise the project tempo, up to FAST_RECORD_TEMPO as far
+                     as the closest notes allow, so the recording takes less wall-clock
+                     time. Notes still land on the same ticks and the original tempo is
+                     restored afterwards, even on error.
+        on_complete (callable): Called without arguments once the batch is recorded
+        channel (int): Channel to record notes without a channel of their own
+                       into, the channel selected when recording starts if None
+        pattern (int): Pattern to record into, the pattern selected when recording
+                       starts if None
+        
+    Returns:
+        RecordingJob: The queued recording, or None if there was nothing to record
+    """
+    if not notes_array:
+        return None
+    
+    job = RecordingJob(notes_array, fast, on_complete, channel, pattern)
+    recording_queue.append(job)
+    if active_recording is None:
+        _start_next_recording()
+    return job
+
+def _start_next_recording():
+    """Start the next queued recording if the transport is free"""
+    global active_recording
     
-    # Return to beginning
-    transport.setSongPos(0, 2)
+    while recording_queue and active_recording is None:
+        active_recording = recording_queue.pop(0)
+        try:
+            active_recording.start()
+        except Exception as e:
+            log(LOG_ERROR, "Error starting recording: %s", e)
 
+def _recording_finished(job):
+    """Hand the transport to the next queued recording"""
+    global active_recording
+    
+    if active_recording is job:
+        active_recording = None
+    
+    if job.on_complete is not None:
+        try:
+            job.on_complete()
+        except Exception as e:
+            log(LOG_ERROR, "Error in recording callback: %s", e)
+    
+    # Start from OnIdle so a long chain of jobs never recurses
+    scheduler.schedule(0, _start_next_recording)
 
+def build_note_timeline(notes_array, ppq, channel=0):
+    """
+    Build one sorted list of note-on and note-off events for a batch of notes
+    
+    Note-offs sort before note-ons on the same tick so a repeated pitch is
+    released before it is triggered again. Notes for several channels share
+    the one timeline, so they are all recorded in the same pass.
+    
+    Args:
+        notes_array: List of tuples, each containing (note, velocity, length_beats, position_beats),
+                     optionally followed by a channel
+        ppq (int): Project pulses per quarter note
+        channel (int): Channel for notes without one (or with None)
+        
+    Returns:
+        list: Tuples of (tick, note, velocity, channel), velocity 0 being a note-off
+    """
+    events = []
+    for item in notes_array:
+        note, velocity, length, position = item[:4]
+        target = item[4] if len(item) > 4 and item[4] is not None else channel
+        start_tick = int(round(position * ppq))
+        end_tick = start_tick + max(1, int(round(length * ppq)))
+        events.append((start_tick, 1, target, note, velocity))
+        events.append((end_tick, 0, target, note, 0))
+    events.sort()
+    return [(tick, note, velocity, target) for tick, _, target, note, velocity in events]
 
 def rec_melody():
     """
@@ -691,13 +1826,7 @@ def rec_melody():
     
     The melody is a robust 4-bar composition with melody notes and chord accompaniment
     """
-    # Stop playback and rewind to beginning first
-    if transport.isPlaying():
-        transport.stop()
-    
-    transport.setSongPos(0, 2)  # Go to the beginning
-    
-    print("Recording melody...")
+    log(LOG_INFO, "Recording melody...")
     
     # Define the melody as a list of notes
     # Each tuple contains (note, velocity, length_beats, position_beats)
@@ -823,9 +1952,7 @@ def rec_melody():
     ]
     
     # Record the melody using the batch recording function
-    record_notes_batch(melody)
-    
-    print("Melody recording complete!")
+    record_notes_batch(melody, on_complete=lambda: log(LOG_INFO, "Melody recording complete!"))
     
 def change_tempo_from_notes(note_array):
     """
@@ -847,7 +1974,7 @@ def change_tempo_from_notes(note_array):
         bpm_value = 999  # Maximum reasonable tempo
     
     # Change the tempo
-    print(f"Changing tempo to {bpm_value} BPM from note array {note_array}")
+    log(LOG_INFO, "Changing tempo to %d BPM from note array %s", bpm_value, note_array)
     change_tempo(bpm_value)
     
     return bpm_value
@@ -0,0 +1,187 @@
+"""
+Throughput and latency benchmark for the trigger.py -> Test Controller link
+
+Runs trigger.py's sender against the Test Controller's decoder in one process.
+The script runs inside the flsim simulator, a fake mido port hands every
+message straight to OnSysEx / OnMidiMsg, and the device's replies come back
+through a fake input port, so no loopMIDI or FL Studio is needed. Recording is replaced by a capture of the decoded notes.
+
+Usage:
+    python benchmarks/bench_transfer.py [--sizes 10,127,1000,10000] [--encoding auto]
+                                        [--repeat 3] [--no-ack]
+
+Needs the packages trigger.py imports (mido, mcp) and fl-studio-api-stubs so
+the Test Controller script can be imported.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEVICE_SCRIPT = os.path.join(ROOT, 'Test Controller', 'device_test.py.py')
+
+sys.path.insert(0, ROOT)
+
+import mido
+import trigger
+from flsim import Simulator
+
+class FakeMidiBridge:
+    """
+    In-process stand-in for the loopMIDI ports on both sides
+    
+    trigger.py sends through it as its output port and reads the device's
+    replies from it as its input port.
+    """
+    
+    STATUS = {'note_off': 0x80, 'note_on': 0x90, 'control_change': 0xB0, 'pitchwheel': 0xE0}
+    
+    def __init__(self, sim):
+        self.sim = sim
+        self.messages = 0
+        self.bytes = 0
+    
+    def send(self, message):
+        self.messages += 1
+        raw = message.bytes()
+        self.bytes += len(raw)
+        
+        if message.type == 'sysex':
+            self.sim.send_sysex(raw)
+        elif message.type == 'pitchwheel':
+            value = message.pitch + 8192
+            self.sim.send_midi(self.STATUS['pitchwheel'] | message.channel, value & 0x7F, value >> 7)
+        elif message.type in self.STATUS:
+            self.sim.send_midi(self.STATUS[message.type] | message.channel, raw[1], raw[2])
+    
+    def iter_pending(self):
+        for reply in self.sim.take_midi_out():
+            yield mido.Message.from_bytes(list(reply))
+    
+    def close(self):
+        pass
+    
+    def reset_counters(self):
+        self.messages = 0
+        self.bytes = 0
+
+def make_melody(count, seed=1):
+    """
+    Generate a mix of drum-like and melodic material
+    
+    Returns:
+        list: Tuples of (note, velocity, length_beats, position_beats)
+    """
+    rng = random.Random(seed)
+    notes = []
+    position = 0.0
+    for i in range(count):
+        if i % 4 == 0:
+            # Steady closed hat, the most repetitive case
+            notes.append((42, 90, 0.125, position))
+        else:
+            notes.append((rng.randint(36, 84), rng.randint(60, 120),
+                          rng.choice((0.25, 0.5, 1.0)), position))
+        position += rng.choice((0.0, 0.25, 0.25, 0.5))
+    return notes
+
+def quantize(notes, ppq=trigger.WIRE_PPQ):
+    """Notes as the device should decode them, rounded to wire ticks"""
+    return sorted(((note, velocity, round(length * ppq) / ppq, round(position * ppq) / ppq)
+                   for note, velocity, length, position in notes), key=lambda n: n[3])
+
+def percentile(values, fraction):
+    """Value at the given fraction (0-1) of the sorted values"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+async def run_transfer(notes_data, encoding):
+    """Send one melody through the MCP tool and wait for the job to finish"""
+    reply = await trigger.send_melody(notes_data, encoding=encoding)
+    job_id = int(reply.split('job ')[1].split(':')[0])
+    return await trigger.wait_job(job_id, timeout=600)
+
+def bench(size, encoding, repeat, bridge, captured):
+    """
+    Benchmark one melody size
+    
+    Returns:
+        dict: Averaged results for the size
+    """
+    notes = make_melody(size)
+    notes_data = '\n'.join(f"{n},{v},{l},{p}" for n, v, l, p in notes)
+    expected = quantize(notes)
+    
+    latencies = []
+    messages = 0
+    total_bytes = 0
+    correct = True
+    
+    for _ in range(repeat):
+        bridge.reset_counters()
+        del captured[:]
+        
+        started = time.perf_counter()
+        report = asyncio.run(run_transfer(notes_data, encoding))
+        if not captured:
+            raise RuntimeError(f"No notes decoded for {size} notes: {report}")
+        latencies.append(captured[0][0] - started)
+        
+        messages += bridge.messages
+        total_bytes += bridge.bytes
+        decoded = sorted(captured[0][1], key=lambda n: n[3])
+        correct = correct and decoded == expected
+    
+    seconds = sum(latencies)
+    return {
+        'notes': size,
+        'messages': messages // repeat,
+        'messages_per_second': messages / seconds,
+        'notes_per_second': size * repeat / seconds,
+        'bytes_per_note': total_bytes / (size * repeat),
+        'latency_p50_ms': percentile(latencies, 0.5) * 1000,
+        'latency_max_ms': max(latencies) * 1000,
+        'correct': correct,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='10,127,1000,10000',
+                        help='comma separated melody sizes in notes')
+    parser.add_argument('--encoding', default='auto', choices=('auto', 'compressed', 'ticks'))
+    parser.add_argument('--repeat', type=int, default=3, help='transfers per size')
+    parser.add_argument('--no-ack', action='store_true',
+                        help='send without the return channel (fixed pacing)')
+    args = parser.parse_args()
+    
+    sim = Simulator()
+    device_module = sim.load_script(DEVICE_SCRIPT)
+    bridge = FakeMidiBridge(sim)
+    
+    captured = []
+    def capture(notes_array, *args, **kwargs):
+        captured.append((time.perf_counter(), list(notes_array)))
+    device_module.record_notes_batch = capture
+    
+    trigger.ports.output_port = bridge
+    trigger.ports.input_port = None if args.no_ack else bridge
+    trigger.ports.input_name = None if args.no_ack else 'bench'
+    
+    print(f"encoding={args.encoding} repeat={args.repeat} ack={'off' if args.no_ack else 'on'}")
+    header = ('notes', 'msgs', 'msgs/s', 'notes/s', 'bytes/note', 'p50 ms', 'max ms', 'ok')
+    print('%8s %8s %12s %12s %10s %10s %10s %4s' % header)
+    
+    for size in (int(s) for s in args.sizes.split(',')):
+        result = bench(size, args.encoding, args.repeat, bridge, captured)
+        print('%8d %8d %12.0f %12.0f %10.2f %10.2f %10.2f %4s' % (
+            result['notes'], result['messages'], result['messages_per_second'],
+            result['notes_per_second'], result['bytes_per_note'],
+            result['latency_p50_ms'], result['latency_max_ms'],
+            'yes' if result['correct'] else 'NO'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,14 @@
+"""
+flsim: a simulated FL Studio runtime for exercising the Test Controller
+
+Builds on fl-studio-api-stubs. Transport position, record state, tempo,
+PPQ, channel note capture and pattern grids are simulated on a virtual clock,
+so a recording that takes minutes in FL Studio runs in milliseconds and the
+captured ticks are exact.
+"""
+
+from .clock import VirtualClock
+from .runtime import FLRuntime, SimNote
+from .simulator import MidiEvent, Simulator
+
+__all__ = ['FLRuntime', 'MidiEvent', 'SimNote', 'Simulator', 'VirtualClock']
@@ -0,0 +1,41 @@
+"""Virtual clock standing in for the time module"""
+
+import time as _time
+
+class VirtualClock:
+    """
+    A time module replacement whose clock only moves when told to
+    
+    sleep() returns immediately after moving the clock forward, so code
+    that waits in real time runs as fast as the CPU allows while still
+    seeing consistent timestamps. Anything else is taken from the real
+    time module.
+    """
+    
+    def __init__(self, start=1000.0):
+        self.now = float(start)
+    
+    def perf_counter(self):
+        return self.now
+    
+    def monotonic(self):
+        return self.now
+    
+    def time(self):
+        return self.now
+    
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.now += seconds
+    
+    def advance(self, seconds):
+        """Move the clock forward by the given number of seconds"""
+        self.sleep(seconds)
+    
+    def advance_to(self, when):
+        """Move the clock forward to the given time, never backwards"""
+        if when > self.now:
+            self.now = when
+    
+    def __getattr__(self, name):
+        return getattr(_time, name)
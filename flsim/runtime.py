@@ -0,0 +1,288 @@
+"""Simulated FL Studio state and the API modules that expose it"""
+
+import importlib
+import sys
+import types
+
+# Modules the Test Controller imports from FL Studio
+FL_MODULES = ('transport', 'channels', 'general', 'mixer', 'ui', 'playlist',
+              'patterns', 'arrangement', 'device')
+
+# transport.setSongPos / getSongPos modes
+SONGLENGTH_FRACTION = -1  # Fraction of the song length, FL Studio's default
+SONGLENGTH_MS = 0
+SONGLENGTH_S = 1
+SONGLENGTH_ABSTICKS = 2
+
+# OnRefresh flags (midi.HW_Dirty_*) for the changes flsim reports
+HW_DIRTY_LEDS = 256
+HW_DIRTY_PATTERNS = 1024
+HW_DIRTY_NAMES = 16384
+HW_DIRTY_CHANNEL_RACK_GROUP = 32768
+
+class SimNote:
+    """A note captured while the simulated transport was recording"""
+    
+    def __init__(self, channel, note, velocity, start_tick, pattern=1):
+        self.channel = channel
+        self.note = note
+        self.velocity = velocity
+        self.start_tick = start_tick
+        self.end_tick = None
+        self.pattern = pattern
+    
+    @property
+    def length_ticks(self):
+        """Length in ticks, or None while the note is still held"""
+        if self.end_tick is None:
+            return None
+        return self.end_tick - self.start_tick
+    
+    def as_tuple(self):
+        """(channel, note, velocity, start_tick, length_ticks)"""
+        return (self.channel, self.note, self.velocity, self.start_tick, self.length_ticks)
+    
+    def __repr__(self):
+        return "SimNote(channel=%d, note=%d, velocity=%d, start_tick=%d, length_ticks=%s)" % (
+            self.channel, self.note, self.velocity, self.start_tick, self.length_ticks)
+
+class FLRuntime:
+    """
+    The parts of an FL Studio project the Test Controller touches
+    
+    Song position follows the virtual clock and tempo while the transport is
+    playing, and like FL Studio reports the tick it is in, not the nearest
+    one. Notes sent with channels.midiNoteOn while playing and recording
+    are captured with the tick and pattern they landed on. Changes the script should hear
+    about are collected in refresh_flags and tempo_changed until the
+    simulator delivers them, like FL Studio does between callbacks.
+    """
+    
+    def __init__(self, clock, tempo=120.0, ppq=96, channel_count=8, pattern_count=1, song_bars=4):
+        self.clock = clock
+        self.tempo = float(tempo)
+        self.ppq = ppq
+        self.song_length = song_bars * 4 * ppq  # Ticks, what fractional song positions are relative to
+        
+        self.playing = False
+        self.recording = False
+        self.position = 0            # Song position in ticks while stopped
+        self.play_start_tick = 0     # Where the current playback started
+        self.play_started_at = 0.0   # Clock time the current tempo segment started
+        self.segment_start = 0.0     # Song position in ticks when the current tempo segment started
+        
+        self.channel_names = ['Channel %d' % (i + 1) for i in range(channel_count)]
+        self.selected_channel = 0
+        self.pattern = 1
+        self.pattern_names = {i + 1: 'Pattern %d' % (i + 1) for i in range(pattern_count)}
+        self.grid = {}               # (pattern, channel, step) -> bool
+        self.step_params = {}        # (pattern, channel, step, param) -> value
+        
+        self.notes = []              # Every SimNote recorded, in order
+        self.held = {}               # (channel, note) -> SimNote not yet released
+        self.midi_out = []           # Messages sent with device.midiOutSysex / midiOutMsg
+        self.calls = []              # (function, args) for calls with no simulated effect
+        self.refresh_flags = 0       # HW_DIRTY_* flags for the next OnRefresh
+        self.tempo_changed = False   # OnTempoChange is due
+    
+    # Transport
+    
+    def song_position(self):
+        """Current song position in ticks, with the fraction of the current tick"""
+        if not self.playing:
+            return float(self.position)
+        elapsed = self.clock.perf_counter() - self.play_started_at
+        return self.segment_start + elapsed * self.tempo / 60 * self.ppq
+    
+    def song_tick(self):
+        """Current song position in whole ticks"""
+        # The tolerance keeps float error from reporting the tick before
+        return int(self.song_position() + 1e-6)
+    
+    def refresh(self, flags):
+        """Queue an OnRefresh for the script"""
+        self.refresh_flags |= flags
+    
+    def start(self):
+        if self.playing:
+            return
+        self.refresh(HW_DIRTY_LEDS)
+        self.playing = True
+        self.play_start_tick = self.position
+        self.segment_start = float(self.position)
+        self.play_started_at = self.clock.perf_counter()
+    
+    def stop(self):
+        if self.playing:
+            self.release_all(self.song_tick())
+            self.playing = False
+            self.refresh(HW_DIRTY_LEDS)
+        # Like FL Studio, stopping returns to where playback started
+        self.position = self.play_start_tick
+    
+    def set_song_pos(self, value, mode=SONGLENGTH_FRACTION):
+        tick = self.to_ticks(value, mode)
+        self.position = tick
+        self.play_start_tick = tick
+        if self.playing:
+            self.segment_start = float(tick)
+            self.play_started_at = self.clock.perf_counter()
+    
+    def get_song_pos(self, mode=SONGLENGTH_FRACTION):
+        tick = self.song_tick()
+        if mode == SONGLENGTH_ABSTICKS:
+            return tick
+        if mode == SONGLENGTH_FRACTION:
+            return tick / self.song_length
+        seconds = tick / self.ppq * 60 / self.tempo
+        if mode == SONGLENGTH_S:
+            return seconds
+        if mode == SONGLENGTH_MS:
+            return seconds * 1000
+        raise ValueError("Unknown song position mode %r" % (mode,))
+    
+    def to_ticks(self, value, mode):
+        if mode == SONGLENGTH_ABSTICKS:
+            return int(value)
+        if mode == SONGLENGTH_FRACTION:
+            return int(round(value * self.song_length))
+        if mode == SONGLENGTH_S:
+            return int(round(value * self.tempo / 60 * self.ppq))
+        if mode == SONGLENGTH_MS:
+            return int(round(value / 1000 * self.tempo / 60 * self.ppq))
+        raise ValueError("Unknown song position mode %r" % (mode,))
+    
+    def set_tempo(self, bpm):
+        # Start a new segment so the position so far keeps the old tempo
+        if self.playing:
+            self.segment_start = self.song_position()
+            self.play_started_at = self.clock.perf_counter()
+        if float(bpm) != self.tempo:
+            self.tempo_changed = True
+        self.tempo = float(bpm)
+    
+    # Notes
+    
+    def note_on(self, channel, note, velocity):
+        tick = self.song_tick()
+        self.release(channel, note, tick)
+        if velocity > 0 and self.playing and self.recording:
+            sim_note = SimNote(channel, note, velocity, tick, self.pattern)
+            self.notes.append(sim_note)
+            self.held[(channel, note)] = sim_note
+    
+    def release(self, channel, note, tick):
+        sim_note = self.held.pop((channel, note), None)
+        if sim_note is not None:
+            sim_note.end_tick = tick
+    
+    def release_all(self, tick):
+        for channel, note in list(self.held):
+            self.release(channel, note, tick)
+    
+    def recorded(self, channel=None):
+        """Captured notes as (channel, note, velocity, start_tick, length_ticks), sorted"""
+        return sorted(n.as_tuple() for n in self.notes if channel is None or n.channel == channel)
+    
+    # Modules
+    
+    def build_modules(self):
+        """
+        Build the FL Studio API modules backed by this runtime
+        
+        Each module starts as a copy of its fl-studio-api-stubs counterpart,
+        so every documented function exists, and the functions the Test
+        Controller relies on are replaced with simulated ones.
+        
+        Returns:
+            dict: Module name -> module
+        """
+        midi = importlib.import_module('midi')
+        fl = self
+        modules = {name: stub_copy(name) for name in FL_MODULES}
+        
+        transport = modules['transport']
+        transport.start = lambda: fl.start()
+        transport.stop = lambda: fl.stop()
+        def record():
+            fl.recording = not fl.recording
+            fl.refresh(HW_DIRTY_LEDS)
+        transport.record = record
+        transport.isPlaying = lambda: fl.playing
+        transport.isRecording = lambda: fl.recording
+        transport.setSongPos = lambda value, mode=SONGLENGTH_FRACTION: fl.set_song_pos(value, mode)
+        transport.getSongPos = lambda mode=SONGLENGTH_FRACTION: fl.get_song_pos(mode)
+        
+        channels = modules['channels']
+        channels.channelCount = lambda *args: len(fl.channel_names)
+        channels.selectedChannel = lambda *args: fl.selected_channel
+        def select_one_channel(index):
+            fl.selected_channel = index
+            fl.refresh(HW_DIRTY_CHANNEL_RACK_GROUP)
+        channels.selectOneChannel = select_one_channel
+        channels.getChannelName = lambda index, *args: fl.channel_names[index]
+        def set_channel_name(index, name, *args):
+            fl.channel_names[index] = name
+            fl.refresh(HW_DIRTY_NAMES)
+        channels.setChannelName = set_channel_name
+        channels.midiNoteOn = lambda index, note, velocity, *args: fl.note_on(index, note, velocity)
+        channels.quickQuantize = lambda index, *args: fl.calls.append(('quickQuantize', (index,)))
+        channels.getGridBit = lambda index, position, *args: fl.grid.get((fl.pattern, index, position), False)
+        channels.setGridBit = lambda index, position, value, *args: fl.grid.__setitem__(
+            (fl.pattern, index, position), bool(value))
+        channels.setStepParameterByIndex = lambda index, pattern, step, param, value, *args: \
+            fl.step_params.__setitem__((pattern, index, step, param), value)
+        
+        general = modules['general']
+        general.getRecPPQ = lambda: fl.ppq
+        def process_rec_event(event_id, value, flags=0):
+            if event_id == midi.REC_Tempo:
+                fl.set_tempo(value / 1000)
+            return value
+        general.processRECEvent = process_rec_event
+        
+        mixer = modules['mixer']
+        mixer.getCurrentTempo = lambda asInt=False: int(round(fl.tempo * 1000))
+        
+        patterns = modules['patterns']
+        patterns.patternNumber = lambda: fl.pattern
+        patterns.patternCount = lambda: len(fl.pattern_names)
+        def jump_to_pattern(index):
+            fl.pattern = index
+            fl.refresh(HW_DIRTY_PATTERNS)
+        patterns.jumpToPattern = jump_to_pattern
+        patterns.getPatternName = lambda index: fl.pattern_names.get(index, '')
+        def set_pattern_name(index, name):
+            fl.pattern_names[index] = name
+            fl.refresh(HW_DIRTY_NAMES)
+        patterns.setPatternName = set_pattern_name
+        
+        for name, functions in (('ui', ('crDisplayRect', 'setFocused')), ('playlist', ('refresh',))):
+            for function in functions:
+                setattr(modules[name], function, recorder(fl, '%s.%s' % (name, function)))
+        
+        device = modules['device']
+        device.isAssigned = lambda: True
+        device.midiOutSysex = lambda message: fl.midi_out.append(bytes(message))
+        device.midiOutMsg = lambda *args: fl.midi_out.append(args)
+        
+        return modules
+
+def stub_copy(name):
+    """A fresh module holding everything fl-studio-api-stubs defines for name"""
+    module = types.ModuleType(name)
+    current = sys.modules.get(name)
+    stub = getattr(current, '__flsim_stub__', None) if current is not None else None
+    if stub is None:
+        try:
+            stub = current if current is not None else importlib.import_module(name)
+        except ImportError:
+            stub = None
+    if stub is not None:
+        module.__dict__.update((k, v) for k, v in vars(stub).items() if not k.startswith('__'))
+    module.__flsim_stub__ = stub
+    return module
+
+def recorder(fl, name):
+    """A function that only records that it was called"""
+    return lambda *args: fl.calls.append((name, args))
@@ -0,0 +1,183 @@
+"""Loads the Test Controller against the simulated FL Studio runtime"""
+
+import importlib.util
+import random
+import sys
+
+from .clock import VirtualClock
+from .runtime import FLRuntime, FL_MODULES
+
+class MidiEvent:
+    """The parts of FL Studio's eventData a controller script reads"""
+    
+    def __init__(self, status=0, data1=0, data2=0, sysex=None):
+        self.status = status
+        self.data1 = data1
+        self.data2 = data2
+        self.sysex = sysex
+        self.handled = False
+        self.midiId = status & 0xF0
+        self.midiChan = status & 0x0F
+
+class Simulator:
+    """
+    Runs a controller script against a simulated FL Studio on a virtual clock
+    
+    Example:
+        with Simulator(tempo=90) as sim:
+            script = sim.load_script('Test Controller/device_test.py.py')
+            script.record_notes_batch(notes)
+            sim.run_until_idle()
+            assert sim.fl.recorded()[0][3] == 0
+    
+    The FL Studio modules are installed in sys.modules while the simulator is
+    active and the previous ones are put back afterwards.
+    
+    OnIdle is called about every idle_interval seconds, each gap off by up to
+    idle_jitter of it either way, like FL Studio's idle loop. The jitter comes
+    from a generator seeded with seed, so a run is repeatable.
+    """
+    
+    def __init__(self, tempo=120.0, ppq=96, channel_count=8, idle_interval=0.02, idle_jitter=0.5, seed=0):
+        self.clock = VirtualClock()
+        self.fl = FLRuntime(self.clock, tempo, ppq, channel_count)
+        self.idle_interval = idle_interval
+        self.idle_jitter = idle_jitter
+        self.random = random.Random(seed)
+        self.script = None
+        self.saved_modules = None
+    
+    def install(self):
+        """Put the simulated FL Studio modules in sys.modules"""
+        if self.saved_modules is not None:
+            return
+        modules = self.fl.build_modules()
+        self.saved_modules = {name: sys.modules.get(name) for name in FL_MODULES}
+        sys.modules.update(modules)
+    
+    def uninstall(self):
+        """Restore whatever was in sys.modules before install()"""
+        if self.saved_modules is None:
+            return
+        for name, module in self.saved_modules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+        self.saved_modules = None
+    
+    def __enter__(self):
+        self.install()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.uninstall()
+    
+    def load_script(self, path, name='device_test', init=True):
+        """
+        Import a controller script against the simulated modules
+        
+        The script's time module is replaced with the virtual clock.
+        
+        Args:
+            path (str): Path to the script file
+            name (str): Module name to load it under
+            init (bool): Call the script's OnInit after loading
+            
+        Returns:
+            module: The loaded script
+        """
+        self.install()
+        spec = importlib.util.spec_from_file_location(name, path)
+        script = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(script)
+        script.time = self.clock
+        self.script = script
+        if init and hasattr(script, 'OnInit'):
+            script.OnInit()
+        return script
+    
+    # Input
+    
+    def send_midi(self, status, data1, data2):
+        """Deliver a short MIDI message to the script's OnMidiMsg"""
+        event = MidiEvent(status, data1, data2)
+        self.script.OnMidiMsg(event)
+        return event
+    
+    def send_sysex(self, data):
+        """Deliver a SysEx message (including F0 and F7) to the script's OnSysEx"""
+        event = MidiEvent(0xF0, sysex=bytes(data))
+        self.script.OnSysEx(event)
+        return event
+    
+    def take_midi_out(self):
+        """Return and clear everything the script sent to its MIDI output"""
+        messages = self.fl.midi_out[:]
+        del self.fl.midi_out[:]
+        return messages
+    
+    # Time
+    
+    def idle(self):
+        """Call the script's OnIdle once, delivering pending callbacks around it"""
+        self.deliver_callbacks()
+        if hasattr(self.script, 'OnIdle'):
+            self.script.OnIdle()
+        self.deliver_callbacks()
+    
+    def deliver_callbacks(self):
+        """Call the script's OnTempoChange and OnRefresh for changes since the last delivery"""
+        fl = self.fl
+        if fl.tempo_changed:
+            fl.tempo_changed = False
+            if hasattr(self.script, 'OnTempoChange'):
+                self.script.OnTempoChange(fl.tempo)
+        if fl.refresh_flags:
+            flags, fl.refresh_flags = fl.refresh_flags, 0
+            if hasattr(self.script, 'OnRefresh'):
+                self.script.OnRefresh(flags)
+    
+    def idle_gap(self):
+        """Seconds until the next OnIdle"""
+        return self.idle_interval * (1 + self.idle_jitter * self.random.uniform(-1, 1))
+    
+    def next_due(self):
+        """Time of the script's next scheduled action, or None"""
+        scheduler = getattr(self.script, 'scheduler', None)
+        queue = getattr(scheduler, 'queue', None)
+        return queue[0][0] if queue else None
+    
+    def run_for(self, seconds):
+        """Advance the clock, calling OnIdle about every idle_interval like FL Studio does"""
+        end = self.clock.perf_counter() + seconds
+        while self.clock.perf_counter() < end:
+            self.clock.advance(min(self.idle_gap(), end - self.clock.perf_counter()))
+            self.idle()
+    
+    def run_until_idle(self, exact=False, timeout=24 * 3600):
+        """
+        Advance the clock until the script has nothing left scheduled
+        
+        Args:
+            exact (bool): Jump straight to each scheduled action instead of
+                          calling OnIdle at FL Studio's jittery intervals.
+                          Faster, but hides timing that depends on OnIdle.
+            timeout (float): Virtual seconds after which to give up
+            
+        Returns:
+            float: Virtual seconds that passed
+        """
+        started = self.clock.perf_counter()
+        self.idle()
+        while True:
+            due = self.next_due()
+            if due is None:
+                return self.clock.perf_counter() - started
+            if self.clock.perf_counter() - started > timeout:
+                raise TimeoutError("Script still busy after %s virtual seconds" % timeout)
+            if exact:
+                self.clock.advance_to(due)
+            else:
+                self.clock.advance(self.idle_gap())
+            self.idle()
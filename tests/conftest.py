@@ -0,0 +1,55 @@
+"""
+Shared fixtures: the Test Controller loaded into flsim, and SysEx framing helpers
+
+The tests need fl-studio-api-stubs, which flsim builds on. Tests that also
+drive trigger.py need the packages it imports (mido, mcp).
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEVICE_SCRIPT = os.path.join(ROOT, 'Test Controller', 'device_test.py.py')
+
+sys.path.insert(0, ROOT)
+
+pytest.importorskip('midi', reason='flsim needs fl-studio-api-stubs')
+
+from flsim import Simulator
+
+@pytest.fixture
+def sim():
+    """A fresh simulator, uninstalled after the test"""
+    with Simulator() as simulator:
+        yield simulator
+
+@pytest.fixture
+def script(sim):
+    """The Test Controller loaded into sim, with its replies from OnInit cleared"""
+    module = sim.load_script(DEVICE_SCRIPT)
+    sim.take_midi_out()
+    return module
+
+@pytest.fixture
+def recorded(script, monkeypatch):
+    """Note lists the Test Controller hands to record_notes_batch, which is not run"""
+    batches = []
+    monkeypatch.setattr(script, 'record_notes_batch', lambda notes, *args, **kwargs: batches.append(list(notes)))
+    return batches
+
+def make_frame(script, command, seq=0, payload=()):
+    """A SysEx frame from trigger.py, F0 to F7, with its CRC"""
+    body = [command, (seq >> 7) & 0x7F, seq & 0x7F]
+    body.extend(payload)
+    return bytes([0xF0, script.SYSEX_MANUFACTURER_ID] + body + list(script.frame_crc(body)) + [0xF7])
+
+def read_replies(sim):
+    """
+    Frames the device sent back since the last call
+
+    Returns:
+        list: Tuples of (command, seq, payload)
+    """
+    return [(data[2], (data[3] << 7) | data[4], list(data[5:-4])) for data in sim.take_midi_out()]
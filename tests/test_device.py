@@ -0,0 +1,377 @@
+"""Test Controller tests, driven through flsim with hand-built SysEx frames"""
+
+import pytest
+
+from conftest import make_frame, read_replies
+
+def encode_values(notes):
+    """Encode (note, velocity, length, position) as the 6 values per note trigger.py sends"""
+    values = []
+    for note, velocity, length, position in notes:
+        values.extend((note, velocity, int(length), round(length % 1 * 10), int(position), round(position % 1 * 10)))
+    return values
+
+def varint(value):
+    """value as a varint, 6 bits per byte, MSB first"""
+    values = [value & 0x3F]
+    value >>= 6
+    while value:
+        values.insert(0, 0x40 | (value & 0x3F))
+        value >>= 6
+    return values
+
+def encode_ticks(notes, ppq=96):
+    """Encode (note, velocity, length_beats, position_beats) in NOTE_FORMAT_TICKS"""
+    values = []
+    previous = 0
+    for note, velocity, length, position in sorted(notes, key=lambda n: n[3]):
+        values.extend((note, velocity))
+        values.extend(varint(round(position * ppq) - previous))
+        values.extend(varint(round(length * ppq)))
+        previous = round(position * ppq)
+    return values
+
+def transfer_frames(script, values, note_count, note_format=0, chunk_size=40, flags=0, ppq=96, session=1):
+    """The frames of one transfer session, numbered from 0"""
+    chunks = [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+    begin = [session, flags, note_format, ppq >> 7, ppq & 0x7F] + varint(note_count) + varint(len(chunks))
+    frames = [make_frame(script, script.SYSEX_MELODY_BEGIN, 0, begin)]
+    for index, chunk in enumerate(chunks):
+        frames.append(make_frame(script, script.SYSEX_MELODY_DATA, index + 1, [session] + varint(index) + chunk))
+    frames.append(make_frame(script, script.SYSEX_MELODY_END, len(chunks) + 1, [session]))
+    return frames
+
+def melody(count=60):
+    """(note, velocity, length_beats, position_beats) for a run of eighth notes"""
+    return [(48 + i % 24, 60 + i % 60, 0.4, i * 0.5) for i in range(count)]
+
+def test_transfer_is_decoded_and_recorded(sim, script, recorded):
+    notes = melody()
+    # Chunks of 40 values split notes across data frames
+    for frame in transfer_frames(script, encode_values(notes), len(notes)):
+        assert sim.send_sysex(frame).handled
+    assert recorded == [notes]
+
+def test_tick_format_is_exact_past_127_beats(sim, script, recorded):
+    notes = [(60, 100, 1 / 3, 200 + i / 3) for i in range(30)] + [(62, 90, 0.125, 1000.0625)]
+    frames = transfer_frames(script, encode_ticks(notes, 480), len(notes), script.NOTE_FORMAT_TICKS, ppq=480)
+    for frame in frames:
+        sim.send_sysex(frame)
+    assert [(n, v, round(l * 480), round(p * 480)) for n, v, l, p in recorded[0]] == \
+           [(n, v, round(l * 480), round(p * 480)) for n, v, l, p in notes]
+
+def test_values_past_the_note_count_are_ignored(sim, script, recorded):
+    notes = melody(4)
+    values = encode_values(notes)
+    for frame in transfer_frames(script, values + values[:12], len(notes)):
+        sim.send_sysex(frame)
+    assert recorded == [notes]
+
+def test_frames_outside_a_transfer_are_ignored(sim, script, recorded):
+    sim.send_sysex(make_frame(script, script.SYSEX_MELODY_DATA, 0, [1, 0] + encode_values(melody(2))))
+    sim.send_sysex(make_frame(script, script.SYSEX_MELODY_END, 1, [1]))
+    # Another manufacturer's SysEx is left for FL Studio
+    assert not sim.send_sysex([0xF0, 0x41, script.SYSEX_MELODY_BEGIN, 0, 0, 0, 1, 0xF7]).handled
+    assert recorded == []
+
+def test_frames_of_an_abandoned_session_are_ignored(sim, script, recorded):
+    old = transfer_frames(script, encode_values(melody(30)), 30, session=5)
+    notes = melody(10)
+    new = transfer_frames(script, encode_values(notes), len(notes), session=6)
+    sim.send_sysex(old[0])
+    sim.send_sysex(old[1])
+    for frame in new:
+        sim.send_sysex(frame)
+    assert recorded == [notes]
+
+    # A late end frame of the old session, even in sequence, records nothing
+    sim.send_sysex(make_frame(script, script.SYSEX_MELODY_END, len(new), [5]))
+    assert recorded == [notes]
+
+def test_frames_are_acknowledged_in_order(script, recorded, sim):
+    notes = melody()
+    frames = transfer_frames(script, encode_values(notes), len(notes))
+    for frame in frames:
+        sim.send_sysex(frame)
+    # The end frame is acknowledged with the outcome of the transfer
+    acks = [(script.SYSEX_ACK, seq, []) for seq in range(len(frames) - 1)]
+    assert read_replies(sim) == acks + [(script.SYSEX_ACK, len(frames) - 1, [script.SYSEX_STATUS_OK])]
+    assert recorded == [notes]
+
+def test_frames_are_reordered_and_gaps_nacked(script, recorded, sim):
+    notes = melody()
+    frames = transfer_frames(script, encode_values(notes), len(notes))
+    assert len(frames) > 4
+    sim.send_sysex(frames[0])
+    read_replies(sim)
+
+    # Frames 3 and 2 overtake frame 1
+    sim.send_sysex(frames[3])
+    assert read_replies(sim) == [(script.SYSEX_NACK, 0, [0, 1, 0, 2])]
+    sim.send_sysex(frames[2])
+    assert read_replies(sim) == [(script.SYSEX_NACK, 0, [0, 1])]
+    sim.send_sysex(frames[1])
+    assert [seq for _, seq, _ in read_replies(sim)] == [1, 2, 3]
+
+    # A resent copy of a frame already handled is dropped
+    sim.send_sysex(frames[2])
+    for frame in frames[4:]:
+        sim.send_sysex(frame)
+    assert recorded == [notes]
+
+def test_damaged_frame_is_nacked_and_accepted_when_resent(script, recorded, sim):
+    notes = melody()
+    frames = transfer_frames(script, encode_values(notes), len(notes))
+    damaged = bytearray(frames[1])
+    damaged[8] ^= 0x01
+
+    sim.send_sysex(frames[0])
+    read_replies(sim)
+    sim.send_sysex(bytes(damaged))
+    assert read_replies(sim) == [(script.SYSEX_NACK, 0, [0, 1])]
+    assert script.metric_counters["sysex_frames_corrupt"] == 1
+
+    for frame in frames[1:]:
+        sim.send_sysex(frame)
+    assert recorded == [notes]
+
+def test_frame_beyond_reorder_window_is_dropped(script, sim):
+    notes = melody()
+    frames = transfer_frames(script, encode_values(notes), len(notes))
+    sim.send_sysex(frames[0])
+    read_replies(sim)
+
+    sim.send_sysex(make_frame(script, script.SYSEX_MELODY_DATA, 1 + script.SYSEX_REORDER_WINDOW, [1, 0]))
+    assert read_replies(sim) == [(script.SYSEX_ACK, 0, [])]
+    assert script.metric_counters["sysex_frames_dropped"] == 1
+    assert not script.sysex_decoder.pending
+
+def test_reload_drops_the_transfer_in_progress(script, recorded, sim):
+    notes = melody()
+    frames = transfer_frames(script, encode_values(notes), len(notes))
+    for frame in frames[:3]:
+        sim.send_sysex(frame)
+    script.OnInit()
+    assert not script.sysex_decoder.pending
+
+    for frame in frames[3:]:
+        sim.send_sysex(frame)
+    assert recorded == []
+
+def test_duplicate_end_frame_repeats_its_status(sim, script):
+    # Replay a phrase the device never cached
+    values = [script.PHRASE_PLAY, 0, 0, 0, 1, 0, 0]
+    frames = transfer_frames(script, values, 4, note_format=script.NOTE_FORMAT_PHRASES)
+    for frame in frames:
+        sim.send_sysex(frame)
+    missing = (script.SYSEX_ACK, len(frames) - 1, [script.SYSEX_STATUS_PHRASE_MISSING])
+    assert read_replies(sim)[-1] == missing
+
+    # The status ACK was lost and trigger.py resends the end frame
+    sim.send_sysex(frames[-1])
+    assert read_replies(sim) == [missing]
+    sim.run_until_idle()
+    assert sim.fl.recorded() == []
+
+def test_resent_transfer_is_acknowledged_but_not_run_again(sim, script, recorded):
+    frames = transfer_frames(script, encode_values(melody(4)), 4)
+    for frame in frames:
+        sim.send_sysex(frame)
+    done = (script.SYSEX_ACK, len(frames) - 1, [script.SYSEX_STATUS_OK])
+    assert read_replies(sim)[-1] == done
+
+    # Every ACK was lost and trigger.py resends from the begin frame
+    for frame in frames:
+        sim.send_sysex(frame)
+    assert read_replies(sim) == [done] * len(frames)
+    assert len(recorded) == 1
+
+def test_fast_flag_reaches_the_recorder(sim, script, monkeypatch):
+    calls = []
+    monkeypatch.setattr(script, 'record_notes_batch', lambda notes, fast=False: calls.append(fast))
+    for flags in (0, script.SYSEX_FLAG_FAST_RECORD):
+        for frame in transfer_frames(script, encode_values(melody(2)), 2, flags=flags):
+            sim.send_sysex(frame)
+    assert calls == [False, True]
+
+def test_fast_recording_restores_the_tempo_on_error(sim, script, monkeypatch):
+    def fail(channel, note, velocity):
+        raise RuntimeError("recording failed")
+    monkeypatch.setattr(script.channels, 'midiNoteOn', fail)
+
+    job = script.record_notes_batch(melody(2), fast=True)
+    sim.run_until_idle()
+    assert job.finished
+    assert sim.fl.tempo == 120
+
+def test_timeline_releases_a_pitch_before_retriggering_it(script):
+    notes = [(60, 100, 0.5, 0.0), (60, 90, 0.5, 0.5), (64, 80, 0.0, 0.5)]
+    assert script.build_note_timeline(notes, 96) == [
+        (0, 60, 100, 0), (48, 60, 0, 0), (48, 60, 90, 0), (48, 64, 80, 0), (49, 64, 0, 0), (96, 60, 0, 0)]
+
+def test_batch_is_recorded_in_one_pass(sim, script, monkeypatch):
+    starts = []
+    start = script.transport.start
+    monkeypatch.setattr(script.transport, 'start', lambda: (starts.append(sim.fl.song_tick()), start()))
+
+    script.record_notes_batch([(60, 100, 1.0, 1.0), (62, 90, 0.5, 1.5), (64, 80, 0.5, 1.0)])
+    sim.run_until_idle()
+    assert sim.fl.recorded() == [(0, 60, 100, 96, 96), (0, 62, 90, 144, 48), (0, 64, 80, 96, 48)]
+    assert starts == [96]
+
+def test_recording_runs_from_on_idle(sim, script):
+    notes = [(60 + i, 100, 0.25, i * 0.5) for i in range(8)]
+    job = script.record_notes_batch(notes)
+    # Even the first note waits for OnIdle
+    assert not sim.fl.playing and sim.fl.notes == []
+
+    # OnIdle comes every 10 to 30 ms, 2 to 6 ticks at 120 BPM, and the
+    # notes still land on their ticks
+    sim.run_for(3)
+    assert job.finished
+    assert sim.fl.recorded() == [(0, note, velocity, round(position * 96), 24)
+                                 for note, velocity, _, position in notes]
+
+def test_batches_wait_for_the_recording_in_progress(sim, script):
+    first = script.record_notes_batch([(60, 100, 1.0, 0.0)])
+    second = script.record_notes_batch([(72, 100, 1.0, 0.0)])
+    sim.run_for(0.4)
+    assert [note.note for note in sim.fl.notes] == [60]
+
+    sim.run_until_idle()
+    assert first.finished and second.finished
+    assert sim.fl.recorded() == [(0, 60, 100, 0, 96), (0, 72, 100, 0, 96)]
+
+@pytest.mark.parametrize('fast', [False, True])
+@pytest.mark.parametrize('tempo', [120, 87.5])
+@pytest.mark.parametrize('exact', [False, True])
+def test_recording_lands_on_exact_ticks(sim, script, fast, tempo, exact):
+    sim.fl.set_tempo(tempo)
+    sim.deliver_callbacks()
+    # Off-grid starts and lengths, no two notes of a pitch overlapping
+    notes = [(40 + i % 40, 1 + i % 127, (0.25, 0.3, 0.2)[i % 3], i * 0.5 + (0, 1 / 12, 1 / 7)[i % 3])
+             for i in range(200)]
+    script.record_notes_batch(notes, fast=fast)
+    sim.run_until_idle(exact=exact)
+
+    expected = sorted((0, note, velocity, round(position * 96), round(length * 96))
+                      for note, velocity, length, position in notes)
+    assert sim.fl.recorded() == expected
+    assert sim.fl.tempo == tempo
+
+def send_notes(sim, values):
+    """Note ons, one per value, each followed by its note off"""
+    events = []
+    for value in values:
+        events.append(sim.send_midi(0x90, value, 100))
+        sim.send_midi(0x80, value, 0)
+    return events
+
+def test_note_by_note_transfer_is_recorded(sim, script, recorded):
+    notes = [(60, 100, 1.0, 0.0), (64, 90, 0.5, 1.5)]
+    events = send_notes(sim, [0, 2] + encode_values(notes))
+    assert recorded == [notes]
+    # None of the values reach the selected instrument
+    assert all(event.handled for event in events)
+    assert script.note_decoder.state == script.NoteDecoder.IDLE
+
+def test_note_by_note_transfer_ends_on_the_termination_value(sim, script, recorded):
+    send_notes(sim, [0, 5, 60, 100, 1, 0, 0, 127])
+    assert recorded == [[(60, 100, 1.0, 12.7)]]
+    assert not sim.send_midi(0x90, 60, 100).handled
+
+def pitch_bend(script, bpm):
+    value = int((bpm - script.TEMPO_MIN) * script.TEMPO_STEPS_PER_BPM)
+    return (0xE0 | script.CONTROL_CHANNEL, value & 0x7F, value >> 7)
+
+def test_tempo_change_waits_for_the_recording(sim, script):
+    notes = [(60 + i % 12, 100, 0.5, i / 2) for i in range(16)]
+    script.record_notes_batch(notes)
+    assert sim.send_midi(*pitch_bend(script, 140)).handled
+    assert sim.fl.tempo == 120
+
+    sim.run_until_idle()
+    assert sim.fl.tempo == 140
+    assert sorted(note[3] for note in sim.fl.recorded()) == [i * 48 for i in range(16)]
+
+def test_stop_cancels_the_recordings(sim, script):
+    first = script.record_notes_batch([(60, 100, 0.5, i) for i in range(8)])
+    second = script.record_notes_batch([(72, 100, 0.5, 0)])
+    sim.run_for(1.2)
+    sim.send_midi(0xB0 | script.CONTROL_CHANNEL, script.CC_TRANSPORT, script.TRANSPORT_STOP)
+    sim.run_until_idle()
+
+    assert first.finished and not sim.fl.playing
+    assert [note[1] for note in sim.fl.recorded()] == [60, 60, 60]
+    assert script.active_recording is None and not second.finished
+
+def test_device_sends_its_state_only_on_changes(sim, script):
+    sim.idle()
+    assert sim.take_midi_out() == []
+    sim.fl.set_tempo(100)
+    sim.idle()
+    assert [data[2] for data in sim.take_midi_out()] == [script.SYSEX_STATE]
+
+def test_led_refresh_only_reads_the_transport(sim, script, monkeypatch):
+    reads = []
+    pattern_count = script.patterns.patternCount
+    monkeypatch.setattr(script.patterns, 'patternCount', lambda: reads.append('patternCount') or pattern_count())
+    script.OnRefresh(script.midi.HW_Dirty_LEDs)
+    assert reads == [] and sim.take_midi_out() == []
+
+    sim.fl.start()
+    sim.idle()
+    assert reads == []
+    assert [data[2] for data in sim.take_midi_out()] == [script.SYSEX_STATE]
+
+    script.OnRefresh(script.midi.HW_Dirty_Patterns)
+    assert reads == ['patternCount']
+
+def test_dense_recording_never_blocks_a_callback(sim, script, monkeypatch):
+    sim.fl.set_tempo(170)
+    sim.deliver_callbacks()
+    # 32nd notes, legato and staccato
+    notes = [(48 + i % 24, 100, (0.125, 0.0625)[i // 64 % 2], i * 0.125) for i in range(512)]
+    frames = transfer_frames(script, encode_ticks(notes), len(notes), script.NOTE_FORMAT_TICKS)
+
+    started = sim.clock.perf_counter()
+    for frame in frames:
+        sim.send_sysex(frame)
+    # The end frame queues the recording and is acknowledged right away
+    assert sim.clock.perf_counter() == started
+    assert read_replies(sim)[-1] == (script.SYSEX_ACK, len(frames) - 1, [script.SYSEX_STATUS_OK])
+
+    durations = []
+    on_idle = script.OnIdle
+    def timed_on_idle():
+        called = sim.clock.perf_counter()
+        on_idle()
+        durations.append(sim.clock.perf_counter() - called)
+    monkeypatch.setattr(script, 'OnIdle', timed_on_idle)
+    sim.run_until_idle(exact=False)
+
+    assert len(sim.fl.recorded()) == len(notes)
+    # One wait of at most two idle gaps, and idle gaps are 30 ms at most
+    assert max(durations) <= script.RECORD_WAIT_GAPS * 0.03
+
+def test_log_messages_wait_for_on_idle(script, capsys):
+    script.flush_log()
+    capsys.readouterr()
+    # Below the level the arguments are never formatted
+    script.log(script.LOG_DEBUG, "%d", object())
+    script.log(script.LOG_INFO, "Received %d notes", 3)
+    script.log(script.LOG_WARNING, "Expected chunk %d, got %d", 1, 2)
+    assert capsys.readouterr().out == ''
+
+    script.OnIdle()
+    assert capsys.readouterr().out == "Received 3 notes\nExpected chunk 1, got 2\n"
+
+def test_log_ring_drops_the_oldest_messages(script, capsys):
+    script.flush_log()
+    capsys.readouterr()
+    for i in range(script.LOG_RING_SIZE + 5):
+        script.log(script.LOG_INFO, "message %d", i)
+    script.flush_log()
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[:2] == ["(5 log messages dropped)", "message 5"]
+    assert len(lines) == script.LOG_RING_SIZE + 1
@@ -0,0 +1,64 @@
+"""flsim on its own: the virtual clock and the simulated transport"""
+
+import sys
+
+import pytest
+
+from flsim import Simulator
+
+def fl_transport():
+    """The simulated transport module, installed by the sim fixture"""
+    return sys.modules['transport']
+
+def test_sleep_advances_the_virtual_clock(sim):
+    start = sim.clock.perf_counter()
+    sim.clock.sleep(2.5)
+    assert sim.clock.perf_counter() - start == 2.5
+
+def test_song_position_follows_the_tempo(sim):
+    sim.fl.start()
+    sim.clock.advance(1.0)
+    # 120 BPM at 96 PPQ is 192 ticks a second
+    assert sim.fl.song_tick() == 192
+
+    sim.fl.set_tempo(60)
+    assert sim.fl.song_tick() == 192
+    sim.clock.advance(1.0)
+    assert sim.fl.song_tick() == 288
+
+def test_song_position_reports_the_tick_it_is_in(sim):
+    sim.fl.start()
+    # 1.9 ticks in
+    sim.clock.advance(1.9 / 192)
+    assert sim.fl.song_tick() == 1
+    sim.clock.advance(0.1 / 192)
+    assert sim.fl.song_tick() == 2
+
+def test_idle_gaps_are_jittered_and_repeatable():
+    gaps = [Simulator(seed=3).idle_gap() for _ in range(2)]
+    assert gaps[0] == gaps[1]
+
+    sim = Simulator()
+    samples = [sim.idle_gap() for _ in range(200)]
+    assert min(samples) >= sim.idle_interval * (1 - sim.idle_jitter)
+    assert max(samples) <= sim.idle_interval * (1 + sim.idle_jitter)
+    assert max(samples) - min(samples) > sim.idle_interval / 2
+
+def test_song_position_defaults_to_a_fraction_of_the_song(sim):
+    transport = fl_transport()
+    transport.setSongPos(0.5)
+    assert sim.fl.song_tick() == sim.fl.song_length // 2
+    assert transport.getSongPos() == 0.5
+    assert transport.getSongPos(2) == sim.fl.song_length // 2
+
+def test_unknown_song_position_mode_is_rejected(sim):
+    with pytest.raises(ValueError):
+        fl_transport().getSongPos(7)
+    with pytest.raises(ValueError):
+        fl_transport().setSongPos(1, 7)
+
+def test_uninstall_restores_the_modules():
+    before = sys.modules.get('transport')
+    with Simulator():
+        assert sys.modules['transport'] is not before
+    assert sys.modules.get('transport') is before
@@ -0,0 +1,691 @@
+"""trigger.py against the Test Controller, through an in-process MIDI link"""
+
+import asyncio
+import collections
+import logging
+import os
+import random
+import sys
+import time
+
+import pytest
+
+mido = pytest.importorskip('mido')
+pytest.importorskip('mcp', reason='trigger.py needs the MCP SDK')
+
+import trigger
+from conftest import ROOT
+
+class Link:
+    """
+    Stands in for the loopMIDI ports in both directions
+
+    drop(direction, data) decides whether a message is lost on the way,
+    direction being 'out' to FL Studio or 'in' back from it. It may also
+    return replacement bytes to deliver a damaged message. SysEx frames to
+    FL Studio arrive latency seconds after they were sent, once trigger.py
+    next polls for replies.
+    """
+
+    def __init__(self, sim, drop=None, latency=0.0):
+        self.sim = sim
+        self.drop = drop or (lambda direction, data: False)
+        self.latency = latency
+        self.in_flight = collections.deque()
+        self.sent = []
+
+    def deliver(self, direction, data):
+        verdict = self.drop(direction, data)
+        if verdict is True:
+            return None
+        return verdict or data
+
+    def send(self, message):
+        self.sent.append(message)
+        data = self.deliver('out', bytes(message.bytes()))
+        if data is None:
+            return
+        if message.type != 'sysex':
+            self.sim.send_midi(*data)
+        elif self.latency:
+            self.in_flight.append((time.perf_counter() + self.latency, data))
+        else:
+            self.sim.send_sysex(data)
+
+    def iter_pending(self):
+        now = time.perf_counter()
+        while self.in_flight and self.in_flight[0][0] <= now:
+            self.sim.send_sysex(self.in_flight.popleft()[1])
+        for reply in self.sim.take_midi_out():
+            data = self.deliver('in', bytes(reply))
+            if data is not None:
+                yield mido.Message.from_bytes(list(data))
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def link(sim, script, monkeypatch):
+    """trigger.py wired to the loaded Test Controller, with fresh sender state"""
+    link = Link(sim)
+    ports = trigger.MidiPortManager('test out', 'test in')
+    ports.output_port = link
+    ports.input_port = link
+    monkeypatch.setattr(trigger, 'ports', ports)
+    # Sequence numbers from 0, so tests can pick frames by their index
+    sender = trigger.FrameSender()
+    sender.first_seq = 0
+    monkeypatch.setattr(trigger, 'frame_sender', sender)
+    monkeypatch.setattr(trigger, 'metrics', trigger.Metrics())
+    monkeypatch.setattr(trigger, 'phrase_cache', collections.OrderedDict())
+    monkeypatch.setattr(trigger, 'project_state', {})
+    monkeypatch.setattr(trigger, 'project_state_at', None)
+    # Every test runs its own event loop, and with it its own sender task
+    monkeypatch.setattr(trigger, 'transfer_worker', None)
+    return link
+
+def frame_seq(data):
+    """Sequence number of a frame, F0 to F7"""
+    return (data[3] << 7) | data[4]
+
+def ticks(notes, ppq=96):
+    """Notes as (note, velocity, length_ticks, start_tick), in order"""
+    return [(n, v, round(l * ppq), round(p * ppq)) for n, v, l, p in sorted(notes, key=lambda n: n[3])]
+
+def notes_data(notes):
+    """notes in send_melody's text format"""
+    return '\n'.join(','.join(str(field) for field in note) for note in notes)
+
+def send_melody(notes, **kwargs):
+    """Send notes with the send_melody tool and wait for the job, returning its report"""
+    async def run():
+        reply = await trigger.send_melody(notes_data(notes), **kwargs)
+        return await trigger.wait_job(int(reply.split('job ')[1].split(':')[0]))
+    return asyncio.run(run())
+
+def test_frame_crc_matches_the_device(script, monkeypatch):
+    rng = random.Random(5)
+    bodies = [[rng.randrange(128) for _ in range(rng.randrange(1, 300))] for _ in range(50)]
+    expected = [list(trigger.frame_crc(body)) for body in bodies]
+    assert [list(script.frame_crc(body)) for body in bodies] == expected
+    # FL Studio's Python may lack binascii
+    monkeypatch.setattr(script, 'binascii', None)
+    assert [list(script.frame_crc(body)) for body in bodies] == expected
+
+def test_melody_is_sent_in_a_few_frames(link, recorded):
+    # Triplets, 32nd notes and positions past 127 beats are all exact
+    notes = [(60 + i % 12, 100, 0.5, i / 3) for i in range(300)] + [(48, 90, 0.125, 400.03125)]
+    assert send_melody(notes, encoding='ticks')['status'] == 'done'
+
+    # Begin, 1206 values in frames of 240, end
+    assert len(link.sent) == 8
+    assert all(message.type == 'sysex' for message in link.sent)
+    assert [ticks(batch) for batch in recorded] == [ticks(notes)]
+
+@pytest.mark.parametrize('encoding', ['ticks', 'compressed', 'auto'])
+def test_every_encoding_is_recorded_exactly(link, recorded, encoding):
+    hats = [(42, 90, 0.125, i * 0.25) for i in range(64)]
+    lead = [(60 + i * 7 % 12, 70 + i, 0.5 + i % 3 / 3, i * 1.5 + 1 / 12) for i in range(20)]
+    assert send_melody(hats + lead, encoding=encoding)['status'] == 'done'
+    assert [ticks(batch) for batch in recorded] == [ticks(hats + lead)]
+
+def test_steady_line_compresses_to_two_records(script):
+    hats = [(42, 90, 0.125, i * 0.25) for i in range(64)]
+    values = trigger.encode_notes_compressed(hats)
+    # The first hat in full, then the other 63 as a spacing and a repeat count
+    assert len(values) == 8
+    assert ticks(script.decode_note_compressed(values, 96)) == ticks(hats)
+
+def test_numpy_encoders_match_the_sequential_ones():
+    pytest.importorskip('numpy')
+    # Runs, triplets, out of order and zero length notes
+    notes = [(42, 90, 0.125, i * 0.25) for i in range(300)]
+    notes += [(60 + i % 7, 60 + i % 3, 1 / 3, 80 - i / 3) for i in range(200)]
+    notes += [(127, 0, 0.5, 3.0), (60, 100, 0, 400.03125)]
+    array = trigger.as_note_array(notes)
+    assert bytes(trigger.encode_notes_ticks_array(array)) == bytes(trigger.encode_notes_ticks(notes))
+    assert bytes(trigger.encode_notes_compressed_array(array)) == bytes(trigger.encode_notes_compressed(notes))
+
+def test_large_blocks_parse_like_small_ones(monkeypatch):
+    pytest.importorskip('numpy')
+    data = notes_data([(36 + i % 100, 140 - i % 150, 0.25, i / 4) for i in range(trigger.VECTORIZE_MIN_NOTES)])
+    array = trigger.parse_notes(data)
+    assert len(array) == trigger.VECTORIZE_MIN_NOTES
+
+    monkeypatch.setattr(trigger, 'np', None)
+    assert [tuple(note) for note in array.tolist()] == trigger.parse_notes(data)
+
+def test_bulk_parse_checks_fields_per_line():
+    pytest.importorskip('numpy')
+    lines = ['60,100,1,%d' % i for i in range(trigger.VECTORIZE_MIN_NOTES)]
+    # A short line next to a long one has the right total field count
+    notes = trigger.parse_notes('\n'.join(lines + ['61,90,1', '62,80,1,2,5']))
+    assert len(notes) == len(lines) + 1
+    assert tuple(notes[-1]) == (62, 80, 1.0, 2.0, 5)
+    assert tuple(notes[-2]) == (60, 100, 1.0, float(len(lines) - 1))
+
+def test_lost_frame_is_resent(link, recorded):
+    lost = []
+    def drop(direction, data):
+        if direction == 'out' and frame_seq(data) == 2 and not lost:
+            lost.append(data)
+            return True
+        return False
+    link.drop = drop
+
+    notes = [(60 + i % 12, 100, 0.5, i / 4) for i in range(400)]
+    assert send_melody(notes, encoding='ticks')['status'] == 'done'
+    assert lost
+    assert [ticks(batch) for batch in recorded] == [ticks(notes)]
+
+class SlowPort:
+    """A stripe port whose frames reach FL Studio only after the next frame on the main output"""
+
+    def __init__(self, link):
+        self.link = link
+        self.held = []
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+        self.held.append(message)
+
+    def deliver(self):
+        for message in self.held:
+            self.link.sim.send_sysex(message.bytes())
+        del self.held[:]
+
+    def close(self):
+        pass
+
+def test_striped_frames_are_put_back_in_order(link, recorded):
+    stripe = SlowPort(link)
+    trigger.ports.stripe_names = ['stripe']
+    trigger.ports.stripe_ports = [stripe]
+    send = link.send
+    def send_then_deliver(message):
+        send(message)
+        stripe.deliver()
+    link.send = send_then_deliver
+    iter_pending = link.iter_pending
+    def deliver_then_read():
+        stripe.deliver()
+        return iter_pending()
+    link.iter_pending = deliver_then_read
+
+    notes = [(36 + i % 48, 100, 0.25, i / 4) for i in range(3000)]
+    assert send_melody(notes, encoding='ticks')['status'] == 'done'
+    assert len(stripe.sent) >= len(link.sent) - 2
+    assert [ticks(batch) for batch in recorded] == [ticks(notes)]
+
+def test_lost_frames_are_nacked_and_resent(link, recorded):
+    # Far enough in for frames sent after them to still be arriving, and
+    # NACKing them, once the round trip has passed
+    lost = {30, 60}
+    def drop(direction, data):
+        if direction == 'out' and frame_seq(data) in lost:
+            lost.discard(frame_seq(data))
+            return True
+        return False
+    link.drop = drop
+    link.latency = 0.002
+
+    notes = [(36 + i % 48, 100, 0.25, i / 4) for i in range(8000)]
+    assert send_melody(notes, encoding='ticks')['status'] == 'done'
+    assert [ticks(batch) for batch in recorded] == [ticks(notes)]
+    assert trigger.metrics.counters['sysex_frames_nacked'] == 2
+    assert not trigger.metrics.counters['ack_timeouts']
+
+def test_resent_frames_give_no_round_trip_sample(link):
+    lost = []
+    def drop(direction, data):
+        if direction == 'out' and not lost:
+            lost.append(data)
+            return True
+        return False
+    link.drop = drop
+
+    sender = trigger.frame_sender
+    round_trip = sender.round_trip
+    payload = trigger.encode_grid({0: [100, 0, 0, 0]})
+    assert sender.send_frames([(trigger.SYSEX_GRID, payload)]) == [trigger.SYSEX_STATUS_OK]
+    assert lost
+    assert trigger.metrics.counters['ack_timeouts'] == 1
+    assert sender.round_trip == round_trip
+    assert not trigger.metrics.stages.get('ack_round_trip')
+
+def test_damaged_frames_are_recovered(link, recorded):
+    damaged = {'out': 2, 'in': 1}
+    def drop(direction, data):
+        if damaged[direction] and frame_seq(data) == 4:
+            damaged[direction] -= 1
+            data = bytearray(data)
+            data[6] ^= 0x01
+            return bytes(data)
+        return False
+    link.drop = drop
+
+    notes = [(36 + i % 48, 100, 0.25, i / 4) for i in range(2000)]
+    assert send_melody(notes, encoding='ticks')['status'] == 'done'
+    assert [ticks(batch) for batch in recorded] == [ticks(notes)]
+    assert trigger.metrics.counters['sysex_replies_corrupt'] == 1
+
+def test_transfer_fails_when_fl_stops_answering(link, recorded, monkeypatch):
+    monkeypatch.setattr(trigger, 'ACK_MAX_RETRIES', 2)
+    monkeypatch.setattr(mido, 'open_input', lambda name: link)
+    link.drop = lambda direction, data: direction == 'in'
+    report = send_melody([(60, 100, 1, 0)])
+    assert report['status'] == 'failed'
+    assert report['error'].startswith('FL Studio stopped acknowledging')
+
+def test_transfer_survives_fl_stalling_for_a_second(link, recorded):
+    # Busy FL Studio: after the begin frame nothing comes back for a second
+    stall = []
+    def drop(direction, data):
+        if direction == 'out':
+            return False
+        if not stall:
+            stall.append(time.perf_counter() + 1.0)
+            return False
+        return time.perf_counter() < stall[0]
+    link.drop = drop
+    notes = [(60, 100, 1, i) for i in range(50)]
+    assert send_melody(notes)['status'] == 'done'
+    assert [ticks(batch) for batch in recorded] == [ticks(notes)]
+    # The wait doubled each time, so it took a few resends, not one per 50 ms
+    assert trigger.metrics.counters['ack_timeouts'] <= 6
+
+def test_transfer_is_recorded_once_when_its_acknowledgements_are_lost(link, recorded):
+    stalled_until = time.perf_counter() + 0.3
+    link.drop = lambda direction, data: direction == 'in' and time.perf_counter() < stalled_until
+    notes = [(60, 100, 1, i) for i in range(50)]
+    assert send_melody(notes)['status'] == 'done'
+    assert trigger.metrics.counters['ack_timeouts']
+    assert [ticks(batch) for batch in recorded] == [ticks(notes)]
+
+def riff(bars, transpose=0):
+    """A one bar bass and hat figure repeated for some bars"""
+    figure = [(36, 110, 0.5, 0), (36, 90, 0.25, 1.5), (43, 100, 0.5, 2), (41, 100, 1, 3)]
+    figure += [(42, 70, 0.125, i / 2) for i in range(8)]
+    return [(n + transpose, v, l, bar * 4 + p) for bar in range(bars) for n, v, l, p in figure]
+
+def begin_frames(link):
+    return [m for m in link.sent if m.data[1] == trigger.SYSEX_MELODY_BEGIN]
+
+def test_repeated_bars_are_replayed_from_the_cache(link, recorded):
+    notes = riff(16)
+    assert send_melody(notes, encoding='phrases')['status'] == 'done'
+    first = sum(len(m.data) for m in link.sent)
+    link.sent.clear()
+    # The device has the bar already, even transposed
+    assert send_melody(riff(16, transpose=5), encoding='phrases')['status'] == 'done'
+    assert sum(len(m.data) for m in link.sent) < first
+    assert [ticks(batch) for batch in recorded] == [ticks(notes), ticks(riff(16, transpose=5))]
+
+def test_phrases_the_device_lost_are_resent(link, script, recorded):
+    assert send_melody(riff(8), encoding='phrases')['status'] == 'done'
+    # FL Studio restarted and the script was reloaded
+    script.phrase_cache.clear()
+    link.sent.clear()
+
+    assert send_melody(riff(8, transpose=2), encoding='phrases')['status'] == 'done'
+    assert len(begin_frames(link)) == 2
+    assert [ticks(batch) for batch in recorded] == [ticks(riff(8)), ticks(riff(8, transpose=2))]
+
+def test_phrases_for_several_channels_are_resent_in_their_encoding(link, script, recorded, monkeypatch):
+    def song(transpose=0):
+        return [note + (1,) for note in riff(8, transpose)] + [note + (2,) for note in riff(8, transpose + 12)]
+    assert send_melody(song(), encoding='phrases')['status'] == 'done'
+    script.phrase_cache.clear()
+
+    encodings = []
+    encode_melody = trigger.encode_melody
+    def spy(notes, encoding="auto", *args, **kwargs):
+        encodings.append(encoding)
+        return encode_melody(notes, encoding, *args, **kwargs)
+    monkeypatch.setattr(trigger, 'encode_melody', spy)
+    assert send_melody(song(2), encoding='phrases')['status'] == 'done'
+    assert len(begin_frames(link)) == 3
+    assert set(encodings) == {'phrases'}
+
+def test_lost_status_ack_is_asked_for_again(link, script):
+    # trigger.py's cache mirror believes the phrases were sent, the device never got them
+    notes = riff(16)
+    trigger.encode_notes_phrases(notes, trigger.WIRE_PPQ, trigger.phrase_cache)
+    replays = trigger.encode_notes_phrases(notes, trigger.WIRE_PPQ, trigger.phrase_cache)
+
+    lost = []
+    def drop(direction, data):
+        if direction == 'in' and data[2] == script.SYSEX_ACK and len(data) > 9 and not lost:
+            lost.append(data)
+            return True
+        return False
+    link.drop = drop
+
+    status = trigger.send_melody_sysex(len(notes), replays, 0, trigger.NOTE_FORMAT_PHRASES)
+    assert lost
+    assert status == trigger.SYSEX_STATUS_PHRASE_MISSING
+
+def test_melody_has_no_note_limit(link, recorded):
+    notes = [(36 + i % 48, 100, 0.25, i / 4) for i in range(20000)]
+    assert send_melody(notes, encoding='ticks')['status'] == 'done'
+    assert [ticks(batch) for batch in recorded] == [ticks(notes)]
+
+def test_send_melody_returns_before_the_transfer_runs(link, recorded):
+    notes = [(60 + i % 12, 100, 0.25, i / 4) for i in range(2000)]
+
+    async def run():
+        reply = await trigger.send_melody(notes_data(notes), encoding='ticks')
+        job_id = int(reply.split('job ')[1].split(':')[0])
+        assert trigger.job_status(job_id)['status'] == 'queued'
+        assert recorded == []
+        return await trigger.wait_job(job_id)
+
+    report = asyncio.run(run())
+    assert report['status'] == 'done'
+    assert report['frames_acked'] == report['frames_total'] == len(link.sent)
+    assert report['notes_acked'] == len(notes)
+    assert report['estimated_seconds_left'] == 0.0
+    assert [ticks(batch) for batch in recorded] == [ticks(notes)]
+
+def test_unknown_job():
+    assert trigger.job_status(12345) == {'job_id': 12345, 'status': 'unknown'}
+
+def write_midi_file(path, file_type, tracks):
+    """Write tracks of (name, [(channel, note, velocity, start_tick, end_tick)]) at 480 PPQ"""
+    midi_file = mido.MidiFile(type=file_type, ticks_per_beat=480)
+    for name, notes in tracks:
+        events = []
+        for channel, note, velocity, start, end in notes:
+            events.append((start, 1, mido.Message('note_on', channel=channel, note=note, velocity=velocity)))
+            events.append((end, 0, mido.Message('note_off', channel=channel, note=note)))
+        track = mido.MidiTrack([mido.MetaMessage('track_name', name=name)])
+        tick = 0
+        for at, _, message in sorted(events, key=lambda event: event[:2]):
+            track.append(message.copy(time=at - tick))
+            tick = at
+        midi_file.tracks.append(track)
+    midi_file.save(str(path))
+    return str(path)
+
+def test_midi_file_tracks_become_separate_jobs(link, recorded, tmp_path):
+    bass = [(0, 36 + i % 5, 100, i * 480, i * 480 + 240) for i in range(16)]
+    lead = [(1, 72, 80, i * 160, i * 160 + 160) for i in range(24)]
+    path = write_midi_file(tmp_path / 'song.mid', 1, [('Bass', bass), ('Empty', []), ('Lead', lead)])
+
+    description = trigger.describe_midi_file(path)
+    assert "0: 'Bass' 16 notes, 15.5 beats" in description
+    assert "1: 'Empty' no notes" in description
+
+    async def run():
+        reply = await trigger.import_midi_file(path, tracks='lead, 0')
+        job_ids = [int(line.split('job ')[1].split(',')[0]) for line in reply.splitlines() if ': job ' in line]
+        return [await trigger.wait_job(job_id) for job_id in job_ids]
+
+    assert [report['status'] for report in asyncio.run(run())] == ['done', 'done']
+    # Triplet eighths in the lead are exact on the wire
+    assert [ticks(batch) for batch in recorded] == [
+        [(72, 80, 32, i * 32) for i in range(24)],
+        [(36 + i % 5, 100, 48, i * 96) for i in range(16)]]
+
+def test_notes_for_several_channels_are_recorded_in_one_pass(link, sim, monkeypatch):
+    starts = []
+    start = sim.fl.start
+    monkeypatch.setattr(sim.fl, 'start', lambda: (starts.append(sim.fl.song_tick()), start()))
+    bass = [(36 + i % 3, 100, 0.5, i) for i in range(8)]
+    hats = [(42, 80, 0.125, i / 2, 3) for i in range(16)]
+    assert send_melody(bass + hats, encoding='auto')['status'] == 'done'
+    sim.run_until_idle()
+
+    assert starts == [0]
+    assert sim.fl.recorded(3) == [(3, 42, 80, i * 48, 12) for i in range(16)]
+    # Notes without a channel go to the selected one
+    assert sim.fl.recorded(0) == sorted((0, n, v, p * 96, 48) for n, v, _, p in bass)
+
+def test_midi_file_tracks_go_to_their_channels(link, sim, tmp_path):
+    bass = [(0, 36, 100, i * 480, i * 480 + 240) for i in range(4)]
+    lead = [(1, 72, 80, i * 240, i * 240 + 120) for i in range(8)]
+    path = write_midi_file(tmp_path / 'song.mid', 1, [('Bass', bass), ('Lead', lead)])
+    reply = asyncio.run(trigger.import_midi_file(path, channels='2,5'))
+    assert "recorded in one pass" in reply
+    assert asyncio.run(trigger.wait_job(int(reply.split('job ')[1].split(',')[0])))['status'] == 'done'
+    sim.run_until_idle()
+
+    assert sim.fl.recorded(2) == [(2, 36, 100, i * 96, 48) for i in range(4)]
+    assert sim.fl.recorded(5) == [(5, 72, 80, i * 48, 24) for i in range(8)]
+    assert asyncio.run(trigger.import_midi_file(path, channels='2')).startswith("Give one channel index per track")
+
+def test_type_0_midi_file_is_split_per_channel(tmp_path):
+    notes = [(0, 36, 100, 0, 480), (9, 42, 90, 240, 360)]
+    path = write_midi_file(tmp_path / 'song.mid', 0, [('Song', notes)])
+    assert trigger.read_midi_file(path)[1] == [
+        ('Song channel 1', [(36, 100, 1.0, 0.0)]), ('Song channel 10', [(42, 90, 0.25, 0.5)])]
+
+def test_unknown_midi_track_is_reported(tmp_path):
+    path = write_midi_file(tmp_path / 'song.mid', 1, [('Bass', [(0, 36, 100, 0, 480)])])
+    assert asyncio.run(trigger.import_midi_file(path, tracks='drums')).startswith("No track 'drums'")
+
+def test_tempo_is_one_pitch_bend(link, sim):
+    assert trigger.change_tempo(87.53) == "Tempo set to 87.5312 BPM"
+    assert [message.type for message in link.sent] == ['pitchwheel']
+    assert sim.fl.tempo == pytest.approx(87.53125, abs=0.001)
+
+    trigger.change_tempo(1000)
+    assert sim.fl.tempo == pytest.approx(trigger.TEMPO_MAX, abs=0.001)
+
+def test_transport_commands_are_single_messages(link, sim):
+    trigger.play()
+    assert sim.fl.playing
+    sim.run_for(1.0)
+    trigger.stop()
+    trigger.rewind()
+    assert not sim.fl.playing
+    assert sim.fl.song_tick() == 0
+    assert len(link.sent) == 3
+
+def test_drum_grid_is_written_in_one_frame(link, sim):
+    grid = "0,x...x...x...x...\n2,....X.......X..o\n3," + "x." * 32
+    assert asyncio.run(trigger.set_drum_grid(grid)) == "Sent grid for 3 channels"
+    assert len(link.sent) == 1
+
+    on = lambda channel: sorted(step for (_, c, step), value in sim.fl.grid.items() if c == channel and value)
+    assert on(0) == [0, 4, 8, 12]
+    assert on(2) == [4, 12, 15]
+    assert on(3) == list(range(0, 64, 2))
+    velocities = {step: value for (_, c, step, _), value in sim.fl.step_params.items() if c == 2}
+    assert velocities == {4: trigger.GRID_ACCENT, 12: trigger.GRID_ACCENT, 15: trigger.GRID_GHOST}
+
+def test_malformed_grid_is_reported(link):
+    assert asyncio.run(trigger.set_drum_grid("0,x..?")).startswith("Unknown step")
+    assert link.sent == []
+
+def test_batch_runs_every_operation(link, sim):
+    operations = [
+        {"op": "pattern", "number": 1, "name": "Verse"},
+        {"op": "channel", "index": 2, "name": "Bass"},
+        {"op": "grid", "grid": "0,x...x...x...x..."},
+        {"op": "notes", "notes": notes_data([(36, 100, 0.5, 0), (43, 90, 0.5, 1.5)])},
+        {"op": "tempo", "bpm": 95},
+    ]
+    assert asyncio.run(trigger.run_batch(operations)).startswith("Sent batch of 7 operations")
+    sim.run_until_idle()
+
+    assert sim.fl.pattern_names[1] == 'Verse'
+    assert sim.fl.channel_names[2] == 'Bass'
+    assert sorted(step for (_, c, step), on in sim.fl.grid.items() if c == 0 and on) == [0, 4, 8, 12]
+    assert sim.fl.recorded() == [(2, 36, 100, 0, 48), (2, 43, 90, 144, 48)]
+    assert sim.fl.tempo == 95
+
+def test_batch_records_notes_into_the_pattern_selected_before_them(link, sim):
+    operations = [
+        {"op": "pattern", "number": 1},
+        {"op": "notes", "notes": notes_data([(60, 100, 0.5, i) for i in range(4)])},
+        {"op": "pattern", "number": 2},
+        {"op": "notes", "notes": notes_data([(72, 100, 0.5, i) for i in range(4)])},
+    ]
+    assert asyncio.run(trigger.run_batch(operations)).startswith("Sent batch")
+    sim.run_until_idle()
+
+    assert [(note.note, note.pattern) for note in sim.fl.notes] == [(60, 1)] * 4 + [(72, 2)] * 4
+    assert sim.fl.pattern == 2
+
+def test_batch_with_an_unknown_operation_sends_nothing(link):
+    reply = asyncio.run(trigger.run_batch([{"op": "tempo", "bpm": 90}, {"op": "mixer"}]))
+    assert reply.startswith("Unknown operation 'mixer'")
+    assert link.sent == []
+
+def test_metrics_cover_both_sides(link, sim, recorded):
+    assert send_melody([(60, 100, 1, i) for i in range(50)])['status'] == 'done'
+    report = asyncio.run(trigger.get_metrics(reset=True))
+
+    server = report['server']
+    assert {'parse', 'encode', 'queue_wait', 'transfer', 'ack_round_trip'} <= set(server['stages'])
+    assert server['stages']['transfer']['count'] == 1
+    assert server['counters']['sysex_frames'] == 3
+    fl_studio = report['fl_studio']
+    assert fl_studio['stages']['sysex_frame']['count'] == 3
+    assert fl_studio['stages']['decode']['count'] == 1
+
+    # Both sides started over, apart from the request that asked
+    report = asyncio.run(trigger.get_metrics())
+    assert 'transfer' not in report['server']['stages']
+    assert 'decode' not in report['fl_studio']['stages']
+
+def test_metrics_survive_a_lost_acknowledgement(link, recorded):
+    assert send_melody([(60, 100, 1, i) for i in range(50)])['status'] == 'done'
+    # The request is resent and the device answers it again after resetting
+    lost = [True]
+    def drop(direction, data):
+        if direction == 'in' and data[2] == trigger.SYSEX_ACK and lost:
+            return lost.pop()
+        return False
+    link.drop = drop
+    report = asyncio.run(trigger.get_metrics(reset=True))
+    assert not lost
+    assert report['fl_studio']['stages']['decode']['count'] == 1
+
+def test_metrics_without_the_return_port(link):
+    trigger.ports.input_port = None
+    trigger.ports.input_name = None
+    report = asyncio.run(trigger.get_metrics())
+    assert report['fl_studio'].startswith("Needs the return MIDI port")
+
+def test_project_state_follows_fl_studio(link, sim):
+    # Nothing mirrored yet, so the state is requested
+    state = asyncio.run(trigger.get_project_state())
+    assert (state['tempo'], state['ppq'], state['playing']) == (120, 96, False)
+    assert len(link.sent) == 1
+
+    sim.fl.set_tempo(92.5)
+    sim.fl.start()
+    sim.idle()
+    state = asyncio.run(trigger.get_project_state())
+    assert (state['tempo'], state['playing']) == (92.5, True)
+    assert len(link.sent) == 1
+
+def test_batch_with_an_empty_grid_is_rejected(link):
+    reply = asyncio.run(trigger.run_batch([{"op": "tempo", "bpm": 100}, {"op": "grid", "grid": " \n"}]))
+    assert reply.startswith("No channels found in grid")
+    assert link.sent == []
+
+class Port:
+    """An output port, dead once its loopMIDI instance went away"""
+
+    def __init__(self, dead=False):
+        self.dead = dead
+        self.sent = []
+
+    def send(self, message):
+        if self.dead:
+            raise OSError("port closed")
+        self.sent.append(message)
+
+    def close(self):
+        pass
+
+def test_failed_send_reopens_the_output(monkeypatch):
+    opened = []
+    def open_output(name):
+        opened.append(Port(dead=not opened))
+        return opened[-1]
+    monkeypatch.setattr(mido, 'open_output', open_output)
+
+    ports = trigger.MidiPortManager('out')
+    assert opened == []
+    message = mido.Message('note_on', note=60)
+    ports.send(message)
+    assert len(opened) == 2
+    assert opened[1].sent == [message]
+
+def test_missing_input_port_is_looked_for_again_later(monkeypatch):
+    attempts = []
+    def open_input(name):
+        attempts.append(name)
+        raise OSError("no such port")
+    monkeypatch.setattr(mido, 'open_input', open_input)
+
+    ports = trigger.MidiPortManager('out', 'in')
+    assert ports.input() is None
+    assert ports.input() is None
+    assert attempts == ['in']
+    ports.input_failed_at -= trigger.INPUT_RETRY_INTERVAL + 1
+    assert ports.input() is None
+    assert attempts == ['in', 'in']
+
+class SilentPort:
+    """An input port still open after its loopMIDI instance went away"""
+
+    def __init__(self):
+        self.closed = False
+
+    def iter_pending(self):
+        return iter(())
+
+    def close(self):
+        self.closed = True
+
+def test_silent_input_is_reopened(link, recorded, monkeypatch):
+    monkeypatch.setattr(trigger, 'ACK_MAX_RETRIES', 2)
+    silent = SilentPort()
+    trigger.ports.input_port = silent
+    monkeypatch.setattr(mido, 'open_input', lambda name: link)
+
+    notes = [(60, 100, 1, i) for i in range(50)]
+    assert send_melody(notes)['status'] == 'done'
+    assert silent.closed and trigger.ports.input_port is link
+    assert [ticks(batch) for batch in recorded] == [ticks(notes)]
+
+def test_transfer_writes_nothing_to_stdout(link, recorded, capsys):
+    # stdout carries the MCP protocol
+    assert send_melody([(60, 100, 1, i) for i in range(100)])['status'] == 'done'
+    assert capsys.readouterr().out == ''
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+def test_log_ring_reports_dropped_records():
+    target = ListHandler()
+    handler = trigger.RingBufferHandler(target, capacity=3)
+    for i in range(5):
+        handler.emit(logging.makeLogRecord({'msg': 'record %d', 'args': (i,), 'levelno': logging.INFO}))
+    assert target.messages == []
+
+    handler.emit(logging.makeLogRecord({'msg': 'failed', 'levelno': logging.WARNING}))
+    assert target.messages == ['3 log records dropped', 'record 3', 'record 4', 'failed']
+
+def test_benchmark_reports_every_size(monkeypatch, capsys):
+    monkeypatch.syspath_prepend(os.path.join(ROOT, 'benchmarks'))
+    import bench_transfer
+    monkeypatch.setattr(trigger, 'ports', trigger.MidiPortManager('bench out'))
+    monkeypatch.setattr(trigger, 'transfer_worker', None)
+    monkeypatch.setattr(sys, 'argv', ['bench_transfer.py', '--sizes', '10,300', '--repeat', '1'])
+
+    bench_transfer.main()
+    rows = capsys.readouterr().out.splitlines()[2:]
+    assert [row.split()[0] for row in rows] == ['10', '300']
+    assert all(row.split()[-1] == 'yes' for row in rows)
@@ -4,10 +4,184 @@ from mcp.server.fastmcp import FastMCP
 import mido
 from mido import Message
 import time
+import asyncio
+import binascii
+import os
+import random
+import sys
+import threading
+import logging
+import collections
+import math
+import hashlib
+import concurrent.futures
+
+# NumPy is optional. With it, large note blocks are parsed and encoded in bulk;
+# without it everything goes through the plain Python encoders.
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Initialize FastMCP server
 mcp = FastMCP("flstudio")
-output_port = mido.open_output('loopMIDI Port 2') 
+
+# Logging goes to stderr or a file, never stdout, which carries the MCP stdio
+# protocol. Levels: DEBUG, INFO, WARNING (default), ERROR or OFF.
+LOG_LEVEL = os.environ.get('FLSTUDIO_MCP_LOG_LEVEL', 'WARNING').upper()
+LOG_FILE = os.environ.get('FLSTUDIO_MCP_LOG_FILE')
+LOG_RING_SIZE = 1024          # Records buffered between flushes, oldest dropped first
+
+class RingBufferHandler(logging.Handler):
+    """
+    Buffer log records in a bounded ring and write them out in batches
+    
+    Records are only formatted when the ring is flushed: whenever a record at
+    flush_level or above arrives, when a transfer job finishes and at exit.
+    If more than `capacity` records pile up in between, the oldest are
+    dropped and the drop is reported on the next flush.
+    """
+    
+    def __init__(self, target, capacity=LOG_RING_SIZE, flush_level=logging.WARNING):
+        super().__init__()
+        self.target = target
+        self.ring = collections.deque(maxlen=capacity)
+        self.flush_level = flush_level
+        self.dropped = 0
+        self.dropped_total = 0
+    
+    def emit(self, record):
+        if len(self.ring) == self.ring.maxlen:
+            self.dropped += 1
+            self.dropped_total += 1
+        self.ring.append(record)
+        if record.levelno >= self.flush_level:
+            self.flush()
+    
+    def flush(self):
+        self.acquire()
+        try:
+            if self.dropped:
+                self.target.handle(logging.makeLogRecord({
+                    'name': logger.name, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': '%d log records dropped', 'args': (self.dropped,),
+                }))
+                self.dropped = 0
+            while self.ring:
+                self.target.handle(self.ring.popleft())
+            self.target.flush()
+        finally:
+            self.release()
+    
+    def close(self):
+        self.flush()
+        self.target.close()
+        super().close()
+
+def setup_logging():
+    """Configure the module logger from FLSTUDIO_MCP_LOG_LEVEL and FLSTUDIO_MCP_LOG_FILE"""
+    log = logging.getLogger('flstudio_mcp')
+    log.propagate = False
+    if LOG_LEVEL == 'OFF':
+        log.disabled = True
+        return log
+    
+    log.setLevel(getattr(logging, LOG_LEVEL, logging.WARNING))
+    target = logging.FileHandler(LOG_FILE) if LOG_FILE else logging.StreamHandler(sys.stderr)
+    target.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    log.addHandler(RingBufferHandler(target))
+    return log
+
+logger = setup_logging()
+
+def flush_log():
+    """Write out buffered log records"""
+    for handler in logger.handlers:
+        handler.flush()
+
+METRIC_SAMPLES = 1000        # Timings kept per stage, oldest dropped first
+
+class Metrics:
+    """
+    Stage timings and counters for get_metrics
+    
+    Each stage keeps its last METRIC_SAMPLES durations so percentiles
+    reflect recent transfers. Safe to use from the sender thread.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = collections.Counter()
+    
+    def record(self, stage, seconds):
+        """Add one duration to a stage"""
+        with self.lock:
+            samples = self.stages.get(stage)
+            if samples is None:
+                samples = self.stages[stage] = collections.deque(maxlen=METRIC_SAMPLES)
+            samples.append(seconds)
+    
+    def count(self, name, amount=1):
+        """Add to a counter"""
+        with self.lock:
+            self.counters[name] += amount
+    
+    def timer(self, stage):
+        """Context manager recording how long its block takes"""
+        return StageTimer(self, stage)
+    
+    def reset(self):
+        with self.lock:
+            self.stages.clear()
+            self.counters.clear()
+    
+    def summary(self):
+        """
+        Returns:
+            dict: "stages" with count and p50/p95/p99/max in ms per stage, and "counters"
+        """
+        with self.lock:
+            stages = {stage: sorted(samples) for stage, samples in self.stages.items()}
+            counters = dict(self.counters)
+        report = {}
+        for stage, samples in sorted(stages.items()):
+            report[stage] = {"count": len(samples)}
+            for name, fraction in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+                report[stage][name] = round(samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000, 3)
+            report[stage]["max_ms"] = round(samples[-1] * 1000, 3)
+        return {"stages": report, "counters": counters}
+
+class StageTimer:
+    """Times a with block into Metrics.record"""
+    
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+    
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.stage, time.perf_counter() - self.started)
+
+metrics = Metrics()
+
+# MIDI ports, override with environment variables in the MCP server config.
+# The input port is the optional return channel the Test Controller
+# acknowledges frames on; without it transfers fall back to fixed pacing.
+# Stripe ports are extra outputs into the Test Controller that SysEx frames
+# are spread over, round robin with the main output, when the return port
+# is available.
+MIDI_OUTPUT_PORT = os.environ.get('FLSTUDIO_MIDI_OUTPUT', 'loopMIDI Port 2')
+MIDI_INPUT_PORT = os.environ.get('FLSTUDIO_MIDI_INPUT', 'loopMIDI Port 3')
+MIDI_STRIPE_PORTS = [name.strip() for name in os.environ.get('FLSTUDIO_MIDI_STRIPE_PORTS', '').split(',')
+                     if name.strip()]
+PORT_OPEN_RETRIES = 3         # Attempts to (re)open a port before giving up
+PORT_RETRY_DELAY = 0.25       # Seconds between attempts
+INPUT_RETRY_INTERVAL = 5.0    # Seconds before trying a missing input port again
+PORT_NAMES_TTL = 2.0          # Seconds the list of available ports is cached
 
 # MIDI Note mappings for FL Studio commands
 NOTE_PLAY = 60          # C3
@@ -24,6 +198,19 @@ NOTE_ADD_TO_PLAYLIST = 70  # A#3
 NOTE_SET_PATTERN_LEN = 71  # B3
 NOTE_CHANGE_TEMPO = 72   
 
+# Control channel. Messages on it are commands for the Test Controller, never notes.
+CONTROL_CHANNEL = 15         # MIDI channel 16
+CC_TRANSPORT = 20            # Value is one of the TRANSPORT_* commands
+TRANSPORT_STOP = 0
+TRANSPORT_PLAY = 1
+TRANSPORT_RECORD = 2         # Toggle record mode
+TRANSPORT_REWIND = 3         # Back to the start of the song
+
+# Tempo is sent as one 14-bit pitch bend on the control channel
+TEMPO_MIN = 10               # BPM at pitch bend value 0
+TEMPO_STEPS_PER_BPM = 32     # 10-521.97 BPM in steps of 1/32 BPM
+TEMPO_MAX = TEMPO_MIN + 16383 / TEMPO_STEPS_PER_BPM
+
 # Define custom MIDI CC messages for direct step sequencer grid control
 CC_SELECT_CHANNEL = 100  # Select which channel to edit
 CC_SELECT_STEP = 110     # Select which step to edit
@@ -37,38 +224,326 @@ CLAP = 39      # D#1
 CLOSED_HAT = 42  # F#1
 OPEN_HAT = 46  # A#1
 
+# SysEx bulk transfer framing
+# Every frame is F0 <manufacturer> <command> <seq (2 bytes, MSB first)> <payload...> F7
+# Sequence numbers restart at 0 with every SYSEX_MELODY_BEGIN and wrap at 16384
+SYSEX_MANUFACTURER_ID = 0x7D  # Non-commercial / educational ID
+SYSEX_MELODY_BEGIN = 0x01     # Payload: session, flags, note format, PPQ (2 bytes), varint note count, varint chunk total
+SYSEX_MELODY_DATA = 0x02      # Payload: session, varint chunk index, encoded note values
+SYSEX_MELODY_END = 0x03       # Payload: session, device records the collected notes
+SYSEX_GRID = 0x04             # Single frame: varint pattern, varint step count, varint channel count, channel grids
+SYSEX_METRICS_REQUEST = 0x05  # Single frame: reset flag, device answers with SYSEX_METRICS before its ACK
+SYSEX_STATE_REQUEST = 0x06    # Single frame, no payload, device answers with SYSEX_STATE before its ACK
+SYSEX_CHUNK_SIZE = 240        # Note values per data frame
+SYSEX_FRAME_DELAY = 0.002     # Pause between frames when there is no return channel
+SYSEX_ACK = 0x10              # Device -> server, seq is the last frame received in order
+SYSEX_METRICS = 0x11          # Device -> server, counters and timing histograms, see parse_device_metrics
+SYSEX_STATE = 0x12            # Device -> server whenever the project changes, see parse_project_state
+SYSEX_NACK = 0x13             # Device -> server, seq as in SYSEX_ACK, payload the missing seqs (2 values each)
+SYSEX_CRC_SIZE = 3            # CRC-16/CCITT of command, seq and payload, in 3 values before F7
+SYSEX_FRAME_OVERHEAD = 9      # F0, manufacturer, command, 2 seq bytes, CRC and F7 around each payload
+
+# Flow control over the return channel
+ACK_WINDOW_INITIAL = 4        # Unacknowledged frames allowed in flight at the start
+ACK_WINDOW_MAX = 64           # Window grows by one per acknowledged frame up to this, per output
+SYSEX_REORDER_WINDOW = 512    # Frames the device holds after a gap (must match device_test.py)
+ACK_TIMEOUT_MIN = 0.05        # Seconds before unacknowledged frames are resent
+ACK_TIMEOUT_MAX = 2.0         # Longest wait, after doubling for each resend in a row
+ACK_MAX_RETRIES = 8           # Resends in a row without progress before giving up
+SEQ_MODULO = 0x4000           # Sequence numbers are 14 bits
+
+# Flags carried in the SYSEX_MELODY_BEGIN frame
+SYSEX_FLAG_FAST_RECORD = 0x01  # Record at a raised tempo, restoring it afterwards
+
+# Note formats named in the SYSEX_MELODY_BEGIN frame
+NOTE_FORMAT_LEGACY = 0  # 6 values per note, whole beats plus tenths, capped at 127 beats
+NOTE_FORMAT_TICKS = 1   # note, velocity, varint delta ticks from previous note, varint length ticks
+NOTE_FORMAT_COMPRESSED = 2  # NOTE_FORMAT_TICKS with running state and repeat counts, see encode_notes_compressed
+NOTE_FORMAT_PHRASES = 3     # Phrase definitions and replays of cached phrases, see encode_notes_phrases
+NOTE_FORMAT_BATCH = 4       # Not notes but BATCH_* operations, see Batch
+NOTE_FORMAT_CHANNELS = 5    # Notes for several channels recorded in one pass, see encode_channels
+
+# Operations in NOTE_FORMAT_BATCH data. Names are a varint length and ASCII characters.
+BATCH_SELECT_PATTERN = 0x01  # varint pattern number
+BATCH_NAME_PATTERN = 0x02    # varint pattern number, name
+BATCH_SELECT_CHANNEL = 0x03  # varint channel index, notes that follow record into it
+BATCH_NAME_CHANNEL = 0x04    # varint channel index, name
+BATCH_GRID = 0x05            # varint length, SYSEX_GRID payload
+BATCH_NOTES = 0x06           # flags, note format, varint note count, varint value count, encoded notes
+BATCH_TEMPO = 0x07           # tempo as 2 values, like change_tempo's pitch bend
+
+# Flags leading each NOTE_FORMAT_COMPRESSED record
+NOTE_SAME_NOTE = 0x01      # Note number omitted, same as previous
+NOTE_SAME_VELOCITY = 0x02  # Velocity omitted, same as previous
+NOTE_SAME_LENGTH = 0x04    # Length omitted, same as previous
+NOTE_SAME_DELTA = 0x08     # Delta omitted, same spacing as previous
+NOTE_REPEAT = 0x10         # Varint count follows, note repeats that many more times at the same spacing
+
+# Operations in NOTE_FORMAT_PHRASES data
+PHRASE_DEFINE = 0x00  # key (4 values), varint note count, varint value count, NOTE_FORMAT_COMPRESSED values
+PHRASE_PLAY = 0x01    # key (4 values), varint start tick, transpose (added to every note)
+PHRASE_BEATS = 4      # Notes are cut into phrases at bar lines this many beats apart
+PHRASE_CACHE_SIZE = 256  # Phrases the device keeps, least recently used dropped first (must match device)
+
+# Status in the acknowledgement of a SYSEX_MELODY_END frame
+SYSEX_STATUS_OK = 0
+SYSEX_STATUS_PHRASE_MISSING = 1  # A replayed phrase wasn't cached, nothing was recorded
+SYSEX_STATUS_ERROR = 2           # The device failed to apply the frame, see its script log
+
+# Step grids in SYSEX_GRID frames. Each channel is a varint channel index, a
+# bitmap of 7 steps per byte (step 0 in bit 0) and one velocity per set step.
+GRID_VELOCITY = 100          # Velocity of an 'x' step
+GRID_ACCENT = 127            # Velocity of an 'X' step
+GRID_GHOST = 64              # Velocity of an 'o' step
+COMMAND_WAIT = 2.0           # Seconds a command tool waits for its job before returning the job ID
+
+# Flags in SYSEX_STATE payloads
+STATE_PLAYING = 0x01
+STATE_RECORDING = 0x02
+
+# Entries in SYSEX_METRICS payloads
+METRIC_COUNTER = 0
+METRIC_HISTOGRAM = 1
+
+# Ticks per beat used on the wire. 96 divides evenly into 32nd notes and
+# 16th/32nd note triplets; the device rescales to its own PPQ.
+WIRE_PPQ = 96
+
+# Note blocks at least this long use the NumPy encoders when NumPy is installed
+VECTORIZE_MIN_NOTES = 256
+
+# MIDI file imports encode tracks in worker processes once they hold this many notes in total
+POOL_MIN_NOTES = 2000
+
+
+class MidiPortManager:
+    """
+    Lazily opened, shared MIDI ports with transparent reconnect
+    
+    Ports are opened on first use rather than at import, so the MCP server
+    starts even when loopMIDI isn't running. Every tool shares the same
+    handles. A failed send closes the output and reopens it, up to
+    PORT_OPEN_RETRIES attempts, so a loopMIDI restart doesn't need a server
+    restart. An input port left over from a restart stays open but hears
+    nothing, so a transfer that times out reopens it and tries once more.
+    
+    Stripe 0 is the main output. Stripes 1 and up are the extra outputs in
+    stripe_names, which only carry striped SysEx frames.
+    """
+    
+    def __init__(self, output_name, input_name=None, stripe_names=()):
+        self.output_name = output_name
+        self.input_name = input_name
+        self.stripe_names = list(stripe_names)
+        self.output_port = None
+        self.stripe_ports = [None] * len(self.stripe_names)
+        self.input_port = None
+        self.input_failed_at = None
+        self.names = None
+        self.names_at = 0.0
+        self.lock = threading.RLock()
+    
+    def output(self):
+        """
+        Get the output port, opening it if needed
+        
+        Raises:
+            IOError: If the port can't be opened after PORT_OPEN_RETRIES attempts
+        """
+        with self.lock:
+            if self.output_port is None:
+                self.output_port = self.open_with_retry(mido.open_output, self.output_name)
+            return self.output_port
+    
+    def stripe_count(self):
+        """Number of outputs striped frames are spread over, the main output included"""
+        return 1 + len(self.stripe_names)
+    
+    def stripe_output(self, stripe):
+        """
+        Get the output for a stripe, opening it if needed
+        
+        Raises:
+            IOError: If the port can't be opened after PORT_OPEN_RETRIES attempts
+        """
+        if stripe == 0:
+            return self.output()
+        with self.lock:
+            if self.stripe_ports[stripe - 1] is None:
+                self.stripe_ports[stripe - 1] = self.open_with_retry(mido.open_output,
+                                                                     self.stripe_names[stripe - 1])
+            return self.stripe_ports[stripe - 1]
+    
+    def input(self):
+        """
+        Get the return port, or None if it isn't configured or available
+        
+        A missing input port is only looked for again every INPUT_RETRY_INTERVAL
+        seconds so transfers don't pay for it.
+        """
+        with self.lock:
+            if self.input_port is None and self.input_name:
+                now = time.monotonic()
+                if self.input_failed_at is None or now - self.input_failed_at > INPUT_RETRY_INTERVAL:
+                    try:
+                        self.input_port = mido.open_input(self.input_name)
+                        self.input_failed_at = None
+                    except (IOError, OSError):
+                        self.input_failed_at = now
+            return self.input_port
+    
+    def send(self, message, stripe=0):
+        """
+        Send a message, reopening the output port once if the send fails
+        
+        Args:
+            message (mido.Message): Message to send
+            stripe (int): Output to send it on, 0 for the main output
+        
+        Raises:
+            IOError: If the port can't be reopened
+        """
+        metrics.count("midi_messages_sent")
+        with self.lock:
+            try:
+                self.stripe_output(stripe).send(message)
+            except (IOError, OSError) as e:
+                name = self.stripe_names[stripe - 1] if stripe else self.output_name
+                logger.warning("MIDI output '%s' failed (%s), reconnecting", name, e)
+                self.close_output(stripe)
+                self.stripe_output(stripe).send(message)
+    
+    def open_with_retry(self, open_port, name):
+        """Open a port, retrying a few times before giving up"""
+        for attempt in range(PORT_OPEN_RETRIES):
+            try:
+                return open_port(name)
+            except (IOError, OSError) as e:
+                error = e
+                if attempt + 1 < PORT_OPEN_RETRIES:
+                    time.sleep(PORT_RETRY_DELAY)
+        self.names = None
+        raise IOError(f"Could not open MIDI port '{name}': {error}")
+    
+    def output_names(self):
+        """Names of available output ports, cached for PORT_NAMES_TTL seconds"""
+        with self.lock:
+            now = time.monotonic()
+            if self.names is None or now - self.names_at > PORT_NAMES_TTL:
+                self.names = mido.get_output_names()
+                self.names_at = now
+            return list(self.names)
+    
+    def select(self, output_name, input_name=None, stripe_names=None):
+        """Switch to other ports, closing the current ones"""
+        with self.lock:
+            self.close()
+            self.output_name = output_name
+            if input_name is not None:
+                self.input_name = input_name
+            if stripe_names is not None:
+                self.stripe_names = list(stripe_names)
+                self.stripe_ports = [None] * len(self.stripe_names)
+    
+    def close_output(self, stripe=0):
+        """Close an output port, it is reopened on next use"""
+        with self.lock:
+            port = self.stripe_ports[stripe - 1] if stripe else self.output_port
+            if port is not None:
+                try:
+                    port.close()
+                except (IOError, OSError):
+                    pass
+            if stripe:
+                self.stripe_ports[stripe - 1] = None
+            else:
+                self.output_port = None
+    
+    def close(self):
+        """Close all ports, they are reopened on next use"""
+        with self.lock:
+            for stripe in range(self.stripe_count()):
+                self.close_output(stripe)
+            self.close_input()
+    
+    def close_input(self):
+        """Close the return port, it is reopened on next use"""
+        with self.lock:
+            if self.input_port is not None:
+                try:
+                    self.input_port.close()
+                except (IOError, OSError):
+                    pass
+                self.input_port = None
+            self.input_failed_at = None
 
+ports = MidiPortManager(MIDI_OUTPUT_PORT, MIDI_INPUT_PORT, MIDI_STRIPE_PORTS)
 
 @mcp.tool()
 def list_midi_ports():
     """List all available MIDI input ports"""
-    print("\nAvailable MIDI Input Ports:")
-    input_ports = mido.get_output_names()
+    input_ports = ports.output_names()
     if not input_ports:
-        print("  No MIDI input ports found")
+        logger.info("No MIDI input ports found")
     else:
-        for i, port in enumerate(input_ports):
-            print(f"  {i}: {port}")
+        logger.info("Available MIDI input ports: %s", input_ports)
     
     return input_ports
 
+@mcp.tool()
+def select_midi_ports(output_name: str, input_name: str = "", stripe_names: str = ""):
+    """
+    Choose which MIDI ports talk to FL Studio
+    
+    Args:
+        output_name (str): Port the Test Controller listens on, as shown by list_midi_ports
+        input_name (str): Optional return port the Test Controller sends acknowledgements on
+        stripe_names (str): Optional comma separated extra ports into the Test Controller.
+                            Transfers are spread over them and output_name when the
+                            return port is available. "none" to stop striping.
+    """
+    stripes = None
+    if stripe_names.strip():
+        stripes = [name.strip() for name in stripe_names.split(',')
+                   if name.strip() and name.strip().lower() != "none"]
+    ports.select(output_name, input_name or None, stripes)
+    try:
+        for stripe in range(ports.stripe_count()):
+            ports.stripe_output(stripe)
+    except IOError as e:
+        return str(e)
+    reply = f"Using MIDI output '{output_name}'" + (f" and input '{input_name}'" if input_name else "")
+    if ports.stripe_names:
+        reply += f", striping transfers over {ports.stripe_count()} outputs"
+    return reply
+
+def send_transport(command):
+    """Send one of the TRANSPORT_* commands as a single CC on the control channel"""
+    ports.send(mido.Message('control_change', channel=CONTROL_CHANNEL, control=CC_TRANSPORT, value=command))
+
 @mcp.tool()
 def play():
-    """Send MIDI message to start playback in FL Studio"""
-    # Send Note On for C3 (note 60)
-    output_port.send(mido.Message('note_on', note=60, velocity=100))
-    time.sleep(0.1)  # Small delay
-    output_port.send(mido.Message('note_off', note=60, velocity=0))
-    print("Sent Play command")
+    """Start playback in FL Studio"""
+    send_transport(TRANSPORT_PLAY)
+    logger.info("Sent Play command")
 
 @mcp.tool()
 def stop():
-    """Send MIDI message to stop playback in FL Studio"""
-    # Send Note On for C#3 (note 61)
-    output_port.send(mido.Message('note_on', note=61, velocity=100))
-    time.sleep(0.1)  # Small delay
-    output_port.send(mido.Message('note_off', note=61, velocity=0))
-    print("Sent Stop command")
+    """Stop playback in FL Studio, cancelling any recording in progress"""
+    send_transport(TRANSPORT_STOP)
+    logger.info("Sent Stop command")
+
+@mcp.tool()
+def record():
+    """Toggle record mode in FL Studio"""
+    send_transport(TRANSPORT_RECORD)
+    logger.info("Sent Record command")
+
+@mcp.tool()
+def rewind():
+    """Move FL Studio's song position back to the start"""
+    send_transport(TRANSPORT_REWIND)
+    logger.info("Sent Rewind command")
 
 def int_to_midi_bytes(value):
     """
@@ -81,7 +556,7 @@ def int_to_midi_bytes(value):
         list: Array of MIDI bytes (each 0-127)
     """
     if value < 0:
-        print("Warning: Negative values not supported, converting to positive")
+        logger.warning("Negative values not supported, converting to positive")
         value = abs(value)
     
     # Special case for zero
@@ -98,63 +573,314 @@ def int_to_midi_bytes(value):
     
     return midi_bytes
 
-def change_tempo(bpm):
+@mcp.tool()
+def change_tempo(bpm: float):
+    """
+    Change the tempo in FL Studio
+    
+    The tempo is sent as a single 14-bit pitch bend on the control channel,
+    in steps of 1/32 BPM. If a melody is being recorded, FL Studio applies
+    the new tempo once the recording has finished.
+    
+    Args:
+        bpm (float): The desired tempo in beats per minute (10-521.97)
+    """
+    value = tempo_to_value(bpm)
+    ports.send(mido.Message('pitchwheel', channel=CONTROL_CHANNEL, pitch=value - 8192))
+    
+    bpm = TEMPO_MIN + value / TEMPO_STEPS_PER_BPM
+    logger.info("Set tempo to %s BPM", bpm)
+    return f"Tempo set to {bpm:g} BPM"
+
+@mcp.tool()
+async def set_drum_grid(grid: str, pattern: int = 0):
+    """
+    Write step sequencer grids for several channels at once, without recording
+    
+    The whole grid goes to FL Studio in one message and replaces the steps
+    of every listed channel, so a drum pattern lands instantly.
+    
+    Args:
+        grid (str): One line per channel as "channel,steps", for example
+                    "0,x...x...x...x..." for a four on the floor kick on channel 0.
+                    Each character is a step: '.' or '-' off, 'x' on, 'X' accent,
+                    'o' ghost note, or '1'-'9' for a velocity from soft to loud.
+        pattern (int): Pattern number to write to, 0 for the current pattern
+    """
+    try:
+        channel_steps = parse_grid(grid)
+    except ValueError as e:
+        return str(e)
+    if not channel_steps:
+        return "No channels found in grid"
+    
+    job = CommandJob(SYSEX_GRID, encode_grid(channel_steps, pattern))
+    return await submit_command(job, f"grid for {len(channel_steps)} channels")
+
+def tempo_to_value(bpm):
+    """
+    Convert a tempo to its 14-bit control value, clamped to the supported range
+    
+    Returns:
+        int: Steps of 1/TEMPO_STEPS_PER_BPM BPM above TEMPO_MIN (0-16383)
+    """
+    if bpm < TEMPO_MIN or bpm > TEMPO_MAX:
+        logger.warning("BPM value %s is outside the supported range (%d-%.2f)", bpm, TEMPO_MIN, TEMPO_MAX)
+        bpm = max(TEMPO_MIN, min(bpm, TEMPO_MAX))
+    return int(round((bpm - TEMPO_MIN) * TEMPO_STEPS_PER_BPM))
+
+@mcp.tool()
+async def run_batch(operations: list[dict]):
     """
-    Change the tempo in FL Studio using a sequence of MIDI notes
+    Run several project changes in FL Studio as one transaction with a single redraw
+    
+    The whole batch is sent at once and only runs if it arrives intact.
+    Operations run in order; each is a dict with an "op" key:
     
-    This function converts a BPM value to an array of MIDI notes,
-    sends a start marker, the notes, and an end marker to trigger
-    a tempo change in FL Studio.
+        {"op": "tempo", "bpm": 92.5}
+        {"op": "pattern", "number": 2, "name": "Verse"}    (name is optional)
+        {"op": "channel", "index": 0, "name": "Kick"}      (selects it, name is optional)
+        {"op": "grid", "grid": "0,x...x...x...x..."}       (same format as set_drum_grid)
+        {"op": "notes", "notes": "60,100,1,0\n64,100,1,1", "fast_record": false}
+    
+    Notes are recorded into the channel selected by the last "channel"
+    operation before them, or the channel selected in FL Studio.
     
     Args:
-        bpm (float): The desired tempo in beats per minute
+        operations (list): Operations as described above
+    """
+    batch = Batch()
+    try:
+        for operation in operations:
+            kind = operation.get("op")
+            if kind == "tempo":
+                batch.set_tempo(float(operation["bpm"]))
+            elif kind == "pattern":
+                batch.select_pattern(int(operation["number"]), operation.get("name"))
+            elif kind == "channel":
+                batch.select_channel(int(operation["index"]), operation.get("name"))
+            elif kind == "grid":
+                channel_steps = parse_grid(operation["grid"])
+                if not channel_steps:
+                    return f"No channels found in grid of {operation}"
+                batch.write_grid(channel_steps)
+            elif kind == "notes":
+                notes = parse_notes(operation["notes"])
+                if len(notes):
+                    batch.record_notes(notes, bool(operation.get("fast_record", False)))
+            else:
+                return f"Unknown operation {kind!r}, use tempo, pattern, channel, grid or notes"
+    except (KeyError, TypeError, ValueError) as e:
+        return f"Invalid operation {operation}: {e}"
+    if not batch.operation_count:
+        return "No operations to run"
+    
+    job = TransferJob(batch.note_count, batch.values, note_format=NOTE_FORMAT_BATCH)
+    return await submit_command(job, f"batch of {batch.operation_count} operations "
+                                     f"({batch.note_count} notes, {len(batch.values)} MIDI values)")
+
+class Batch:
     """
-    # Ensure BPM is within a reasonable range
-    if bpm < 20 or bpm > 999:
-        print(f"Warning: BPM value {bpm} is outside normal range (20-999)")
-        bpm = max(20, min(bpm, 999))
+    Builds NOTE_FORMAT_BATCH data for a transaction the device runs in one go
+    
+    Example:
+        batch = Batch()
+        batch.select_pattern(2, "Verse")
+        batch.select_channel(0, "Kick")
+        batch.write_grid({0: [100, 0, 0, 0] * 4})
+        batch.set_tempo(95)
+        job = TransferJob(batch.note_count, batch.values, note_format=NOTE_FORMAT_BATCH)
+    """
+    
+    def __init__(self):
+        self.values = []
+        self.note_count = 0
+        self.operation_count = 0
+    
+    def add(self, operation, *fields):
+        self.values.append(operation)
+        for field in fields:
+            self.values.extend(field)
+        self.operation_count += 1
     
-    # Convert BPM to integer
-    bpm_int = int(bpm)
+    def select_pattern(self, number, name=None):
+        """Jump to a pattern, naming it if a name is given"""
+        self.add(BATCH_SELECT_PATTERN, int_to_varint(number))
+        if name:
+            self.add(BATCH_NAME_PATTERN, int_to_varint(number), encode_name(name))
     
-    # Convert to MIDI bytes
-    midi_notes = int_to_midi_bytes(bpm_int)
+    def select_channel(self, index, name=None):
+        """Select a channel for the notes that follow, naming it if a name is given"""
+        self.add(BATCH_SELECT_CHANNEL, int_to_varint(index))
+        if name:
+            self.add(BATCH_NAME_CHANNEL, int_to_varint(index), encode_name(name))
     
-    print(f"Setting tempo to {bpm_int} BPM using note array: {midi_notes}")
+    def write_grid(self, channel_steps, pattern=0):
+        """Write step grids, see encode_grid"""
+        payload = encode_grid(channel_steps, pattern)
+        self.add(BATCH_GRID, int_to_varint(len(payload)), payload)
     
-    # Send start marker (note 72)
-    send_midi_note(72)
-    time.sleep(0.2)
+    def record_notes(self, notes, fast_record=False, encoding="auto"):
+        """Record notes into the selected channel, see submit_notes"""
+        note_format, midi_data = encode_melody(notes, encoding)
+        flags = SYSEX_FLAG_FAST_RECORD if fast_record else 0
+        self.add(BATCH_NOTES, [flags, note_format], int_to_varint(len(notes)),
+                 int_to_varint(len(midi_data)), midi_data)
+        self.note_count += len(notes)
     
-    # Send each note in the array
-    for note in midi_notes:
-        send_midi_note(note)
-        time.sleep(0.1)
+    def set_tempo(self, bpm):
+        """Change the tempo, applied after any recording in progress"""
+        value = tempo_to_value(bpm)
+        self.add(BATCH_TEMPO, [value >> 7, value & 0x7F])
+
+def encode_name(name):
+    """A varint length and the name's characters, non-ASCII ones replaced by '?'"""
+    characters = [ord(c) if ord(c) < 128 else ord('?') for c in name]
+    return int_to_varint(len(characters)) + characters
+
+def parse_grid(grid):
+    """
+    Parse the set_drum_grid text format
+    
+    Returns:
+        dict: Channel index -> list of step velocities, 0 for steps that are off
+        
+    Raises:
+        ValueError: If a line can't be parsed
+    """
+    symbols = {'.': 0, '-': 0, 'x': GRID_VELOCITY, 'X': GRID_ACCENT, 'o': GRID_GHOST}
+    symbols.update((str(level), round(level * 127 / 9)) for level in range(10))
     
-    # Send end marker (note 73)
-    send_midi_note(73)
-    time.sleep(0.2)
+    channel_steps = {}
+    for line in grid.strip().split('\n'):
+        if not line.strip():
+            continue
+        channel, _, steps = line.strip().partition(',')
+        if not channel.strip().isdigit():
+            raise ValueError(f"Invalid grid line: {line}")
+        try:
+            velocities = [symbols[c] for c in steps.strip().replace(' ', '')]
+        except KeyError as e:
+            raise ValueError(f"Unknown step {e} in grid line: {line}")
+        channel_steps[int(channel)] = velocities
+    return channel_steps
+
+def encode_grid(channel_steps, pattern=0):
+    """
+    Encode a SYSEX_GRID payload
     
-    print(f"Tempo change to {bpm_int} BPM sent successfully using {len(midi_notes)} notes")
+    Args:
+        channel_steps (dict): Channel index -> list of step velocities, 0 for
+                              off. Shorter lists are padded with steps that are off.
+        pattern (int): Pattern number, 0 for the current pattern
+        
+    Returns:
+        list: Payload values (each 0-127)
+    """
+    step_count = max(len(steps) for steps in channel_steps.values())
+    payload = int_to_varint(pattern) + int_to_varint(step_count) + int_to_varint(len(channel_steps))
+    for channel, steps in sorted(channel_steps.items()):
+        bitmap = [0] * ((step_count + 6) // 7)
+        for step, velocity in enumerate(steps):
+            if velocity > 0:
+                bitmap[step // 7] |= 1 << (step % 7)
+        payload.extend(int_to_varint(channel))
+        payload.extend(bitmap)
+        payload.extend(min(127, velocity) for velocity in steps if velocity > 0)
+    return payload
 
 @mcp.tool()
-def send_melody(notes_data):
+async def send_melody(notes_data, fast_record=False, encoding="auto"):
     """
     Send a sequence of MIDI notes with timing information to FL Studio for recording
     
+    The transfer runs in the background and this returns a job ID right away.
+    Use job_status or wait_job to follow it.
+    
     Args:
         notes_data (str): String containing note data in format "note,velocity,length,position"
-                         with each note on a new line
+                         with each note on a new line. Add ",channel" to a line to
+                         record that note into another channel rack channel (0 is the
+                         first). All channels are recorded together in one pass,
+                         notes without a channel go to the selected channel.
+        fast_record (bool): Record at a raised project tempo so the part takes less
+                            wall-clock time. The original tempo is restored afterwards.
+        encoding (str): "compressed" to send repeated values and evenly spaced notes
+                        once, "ticks" to send every note in full, "phrases" to
+                        replay bars FL Studio already has cached, or "auto" to
+                        use whichever is smallest
+    """
+    if encoding not in ENCODINGS:
+        return f"Unknown encoding '{encoding}', use 'auto', 'compressed', 'ticks' or 'phrases'"
+    if encoding == "phrases" and not phrases_available():
+        return "The phrases encoding needs the return MIDI port, see select_midi_ports"
+    
+    with metrics.timer("parse"):
+        notes = parse_notes(notes_data)
+    if not len(notes):
+        return "No valid notes found in input data"
+    
+    job = await submit_notes(notes, fast_record, encoding)
+    return (f"Melody transfer queued as job {job.job_id}: {job.note_count} notes "
+            f"({len(job.midi_data)} MIDI values). Use job_status or wait_job to follow it.")
+
+ENCODINGS = ("auto", "compressed", "ticks", "phrases")
+
+async def submit_notes(notes, fast_record=False, encoding="auto"):
+    """
+    Encode notes and queue them as a transfer job
+    
+    This is the entry point for Python callers that already have notes in
+    memory, so they skip the CSV round trip of send_melody.
+    
+    Args:
+        notes: List of (note, velocity, length_beats, position_beats) tuples,
+               optionally with a channel index as a fifth field, or a NumPy
+               array with NOTE_DTYPE fields (or 4 columns in that order)
+        fast_record (bool): Record at a raised project tempo, see send_melody
+        encoding (str): "auto", "compressed", "ticks" or "phrases", see send_melody
+        
+    Returns:
+        TransferJob: The queued job
+    """
+    with metrics.timer("encode"):
+        note_format, midi_data = encode_melody(notes, encoding, phrases=phrases_available())
+    logger.info("Transferring %d notes (%d MIDI values)", len(notes), len(midi_data))
+    
+    flags = SYSEX_FLAG_FAST_RECORD if fast_record else 0
+    job = TransferJob(len(notes), midi_data, flags, note_format, notes=notes, encoding=encoding)
+    await submit_transfer(job)
+    return job
+
+def parse_notes(notes_data):
     """
-    # Parse the notes_data string into a list of note tuples
+    Parse a note block in the send_melody format
+    
+    Large blocks are parsed into a NumPy array in one go when NumPy is
+    installed. If any line doesn't parse, the whole block goes through the
+    line-by-line parser, which skips and logs the bad lines.
+    
+    Args:
+        notes_data (str): Lines of "note,velocity,length,position", optionally
+                          followed by ",channel"
+        
+    Returns:
+        list or numpy.ndarray: Clamped notes, as tuples or a NOTE_DTYPE array.
+                               Lines with a channel become 5-tuples.
+    """
+    lines = [line.strip() for line in notes_data.strip().split('\n')]
+    lines = [line for line in lines if line]
+    
+    if np is not None and len(lines) >= VECTORIZE_MIN_NOTES:
+        notes = parse_notes_array(lines)
+        if notes is not None:
+            return notes
+    
     notes = []
-    for line in notes_data.strip().split('\n'):
-        if not line.strip():
-            continue
-            
-        parts = line.strip().split(',')
-        if len(parts) != 4:
-            print(f"Warning: Skipping invalid line: {line}")
+    for line in lines:
+        parts = line.split(',')
+        if len(parts) not in (4, 5):
+            logger.warning("Skipping invalid line: %s", line)
             continue
             
         try:
@@ -162,74 +888,1524 @@ def send_melody(notes_data):
             velocity = min(127, max(0, int(parts[1])))
             length = max(0, float(parts[2]))
             position = max(0, float(parts[3]))
-            notes.append((note, velocity, length, position))
+            channel = max(0, int(parts[4])) if len(parts) == 5 else None
         except ValueError:
-            print(f"Warning: Skipping line with invalid values: {line}")
+            logger.warning("Skipping line with invalid values: %s", line)
             continue
+        if not (math.isfinite(length) and math.isfinite(position)):
+            logger.warning("Skipping line with invalid values: %s", line)
+            continue
+        if channel is None:
+            notes.append((note, velocity, length, position))
+        else:
+            notes.append((note, velocity, length, position, channel))
     
-    if not notes:
-        return "No valid notes found in input data"
+    return notes
+
+def encode_melody(notes, encoding="auto", ppq=WIRE_PPQ, phrases=False):
+    """
+    Encode notes for send_melody_sysex in the requested format
     
-    # Create the MIDI data array (5 values per note)
-    midi_data = []
-    for note, velocity, length, position in notes:
-        # 1. Note value (0-127)
-        midi_data.append(note)
+    Args:
+        notes: Note tuples or a NumPy note array, see submit_notes
+        encoding (str): "compressed", "ticks", "phrases" or "auto" for the smallest
+        ppq (int): Ticks per beat on the wire
+        phrases (bool): Whether the phrase cache may be used. Only the server
+                        process tracks the device's cache, so encoder worker
+                        processes leave this off.
         
-        # 2. Velocity value (0-127)
-        midi_data.append(velocity)
+    Returns:
+        tuple: (note_format, midi_data) where midi_data is a list of values,
+               or a bytes buffer from the NumPy encoders
+    """
+    parts = split_channels(notes)
+    if parts is not None:
+        return encode_channels(parts, encoding, ppq, phrases)
+    
+    if np is not None and (isinstance(notes, np.ndarray) or len(notes) >= VECTORIZE_MIN_NOTES):
+        notes = as_note_array(notes)
+        encode_ticks, encode_compressed = encode_notes_ticks_array, encode_notes_compressed_array
+    else:
+        encode_ticks, encode_compressed = encode_notes_ticks, encode_notes_compressed
+    
+    note_format = NOTE_FORMAT_TICKS
+    midi_data = None
+    if encoding in ("auto", "ticks"):
+        midi_data = encode_ticks(notes, ppq)
+    if encoding != "ticks":
+        compressed = encode_compressed(notes, ppq)
+        if midi_data is None or len(compressed) < len(midi_data):
+            note_format = NOTE_FORMAT_COMPRESSED
+            midi_data = compressed
+    if phrases:
+        note_format, midi_data = apply_phrases(notes, encoding, note_format, midi_data, ppq)
+    return note_format, midi_data
+
+def split_channels(notes):
+    """
+    Group notes by the channel in their fifth field
+    
+    Returns:
+        list: (channel, notes) in order of first appearance, channel None for
+              notes without one, or None if no note has a channel
+    """
+    if np is not None and isinstance(notes, np.ndarray):
+        return None
+    if not any(len(note) > 4 for note in notes):
+        return None
+    groups = {}
+    for note in notes:
+        channel = note[4] if len(note) > 4 else None
+        groups.setdefault(channel, []).append(tuple(note[:4]))
+    return list(groups.items())
+
+def encode_channels(parts, encoding="auto", ppq=WIRE_PPQ, phrases=False):
+    """
+    Encode notes for several channels as one NOTE_FORMAT_CHANNELS transfer
+    
+    Each channel's notes are encoded on their own with encode_melody, so
+    every part gets whichever format suits it best.
+    
+    Args:
+        parts (list): (channel, notes) pairs, channel None for the channel
+                      the transfer would otherwise record into
+        encoding, ppq, phrases: See encode_melody
+        
+    Returns:
+        tuple: (NOTE_FORMAT_CHANNELS, midi_data)
+    """
+    return NOTE_FORMAT_CHANNELS, pack_channels(
+        (channel, len(notes)) + encode_melody(notes, encoding, ppq, phrases) for channel, notes in parts)
+
+def pack_channels(parts):
+    """
+    Join encoded parts into NOTE_FORMAT_CHANNELS data
+    
+    Each part is a varint channel + 1 (0 for the default channel), its note
+    format, a varint note count, a varint value count and the values.
+    
+    Args:
+        parts: (channel, note_count, note_format, midi_data) tuples
         
-        # 3. Length whole part (0-127)
-        length_whole = min(127, int(length))
-        midi_data.append(length_whole)
+    Returns:
+        list: MIDI values
+    """
+    values = []
+    for channel, note_count, note_format, midi_data in parts:
+        values.extend(int_to_varint(0 if channel is None else channel + 1))
+        values.append(note_format)
+        values.extend(int_to_varint(note_count))
+        values.extend(int_to_varint(len(midi_data)))
+        values.extend(midi_data)
+    return values
+
+def phrases_available():
+    """The phrase cache needs the return port to hear about phrases the device lost"""
+    return ports.input() is not None
+
+def apply_phrases(notes, encoding, note_format, midi_data, ppq=WIRE_PPQ):
+    """
+    Switch to NOTE_FORMAT_PHRASES if asked to, or if it is smaller in "auto"
+    
+    The cache mirror is only updated when the phrase encoding is used.
+    
+    Returns:
+        tuple: (note_format, midi_data)
+    """
+    if encoding not in ("auto", "phrases"):
+        return note_format, midi_data
+    with phrase_lock:
+        trial = phrase_cache.copy()
+        phrased = encode_notes_phrases(notes, ppq, trial)
+        if encoding == "phrases" or len(phrased) < len(midi_data):
+            phrase_cache.clear()
+            phrase_cache.update(trial)
+            return NOTE_FORMAT_PHRASES, phrased
+    return note_format, midi_data
+
+@mcp.tool()
+def describe_midi_file(path: str):
+    """
+    List the tracks of a Standard MIDI File without sending anything to FL Studio
+    
+    Use this to pick tracks for import_midi_file.
+    
+    Args:
+        path (str): Path to a .mid file
+    """
+    try:
+        midi_file, tracks = read_midi_file(path)
+    except (OSError, ValueError, EOFError) as e:
+        return f"Could not read {path}: {e}"
+    
+    lines = [f"{path}: type {midi_file.type}, {midi_file.ticks_per_beat} PPQ, {len(tracks)} tracks"]
+    for index, (name, notes) in enumerate(tracks):
+        if notes:
+            end = max(position + length for _, _, length, position in notes)
+            low = min(n[0] for n in notes)
+            high = max(n[0] for n in notes)
+            lines.append(f"  {index}: '{name}' {len(notes)} notes, {end:g} beats, notes {low}-{high}")
+        else:
+            lines.append(f"  {index}: '{name}' no notes")
+    return '\n'.join(lines)
+
+@mcp.tool()
+async def import_midi_file(path: str, tracks: str = "", fast_record: bool = False, encoding: str = "auto",
+                           channels: str = ""):
+    """
+    Record the notes of a Standard MIDI File into FL Studio
+    
+    The file is read on this machine, so the notes never pass through the
+    conversation. Without channels, each chosen track becomes its own
+    transfer job and is recorded into the channel selected in FL Studio when
+    the job runs. With channels, every track goes to its own channel and all
+    of them are recorded together in one pass.
+    
+    Args:
+        path (str): Path to a .mid file
+        tracks (str): Comma separated track numbers or names from describe_midi_file.
+                      Empty for every track that has notes.
+        fast_record (bool): Record at a raised project tempo, see send_melody
+        encoding (str): "auto", "compressed", "ticks" or "phrases", see send_melody
+        channels (str): Comma separated channel rack indexes (0 is the first),
+                        one per chosen track in the same order
+    """
+    if encoding not in ENCODINGS:
+        return f"Unknown encoding '{encoding}', use 'auto', 'compressed', 'ticks' or 'phrases'"
+    if encoding == "phrases" and not phrases_available():
+        return "The phrases encoding needs the return MIDI port, see select_midi_ports"
+    try:
+        midi_file, all_tracks = read_midi_file(path)
+    except (OSError, ValueError, EOFError) as e:
+        return f"Could not read {path}: {e}"
+    
+    chosen = []
+    for item in (t.strip() for t in tracks.split(',') if t.strip()):
+        if item.isdigit() and int(item) < len(all_tracks):
+            chosen.append(int(item))
+            continue
+        matches = [i for i, (name, _) in enumerate(all_tracks) if name.lower() == item.lower()]
+        if not matches:
+            return f"No track '{item}' in {path}, use describe_midi_file to list them"
+        chosen.extend(matches)
+    if not tracks.strip():
+        chosen = [i for i, (_, notes) in enumerate(all_tracks) if notes]
+    chosen = [i for i in dict.fromkeys(chosen) if all_tracks[i][1]]
+    if not chosen:
+        return f"No notes found in the chosen tracks of {path}"
+    
+    targets = [c.strip() for c in channels.split(',') if c.strip()]
+    if targets and (len(targets) != len(chosen) or not all(c.isdigit() for c in targets)):
+        return (f"Give one channel index per track: {len(chosen)} tracks "
+                f"({', '.join(str(i) for i in chosen)}) but channels was '{channels}'")
+    
+    encoded = await encode_tracks([all_tracks[i][1] for i in chosen], encoding)
+    
+    flags = SYSEX_FLAG_FAST_RECORD if fast_record else 0
+    if targets:
+        targets = [int(c) for c in targets]
+        parts = []
+        notes = []
+        for index, channel, (note_format, midi_data) in zip(chosen, targets, encoded):
+            track_notes = all_tracks[index][1]
+            parts.append((channel, len(track_notes), note_format, midi_data))
+            notes.extend(tuple(note) + (channel,) for note in track_notes)
+        job = TransferJob(len(notes), pack_channels(parts), flags, NOTE_FORMAT_CHANNELS, notes=notes,
+                          encoding=encoding)
+        await submit_transfer(job)
+        lines = [f"  track {index} '{all_tracks[index][0]}' -> channel {channel}"
+                 for index, channel in zip(chosen, targets)]
+        return (f"Queued {len(chosen)} tracks from {path} as job {job.job_id}, recorded in one pass: "
+                f"{len(notes)} notes ({len(job.midi_data)} MIDI values)\n" + '\n'.join(lines)
+                + "\nUse job_status or wait_job to follow it.")
+    
+    lines = []
+    for index, (note_format, midi_data) in zip(chosen, encoded):
+        name, notes = all_tracks[index]
+        job = TransferJob(len(notes), midi_data, flags, note_format, notes=notes, encoding=encoding)
+        await submit_transfer(job)
+        lines.append(f"  track {index} '{name}': job {job.job_id}, {len(notes)} notes "
+                     f"({len(midi_data)} MIDI values)")
+    
+    return (f"Queued {len(chosen)} tracks from {path}:\n" + '\n'.join(lines)
+            + "\nUse job_status or wait_job to follow them.")
+
+def read_midi_file(path):
+    """
+    Read the notes of a Standard MIDI File, track by track
+    
+    Note ons are paired with the next note off (or zero velocity note on) of
+    the same channel and note. Notes still held at the end of the track end
+    there. A type 0 file keeps all its channels in one track, so it is split
+    into one track per MIDI channel instead.
+    
+    Args:
+        path (str): Path to a .mid file
         
-        # 4. Length decimal part (0-9)
-        length_decimal = int(round((length - length_whole) * 10)) % 10
-        midi_data.append(length_decimal)
+    Returns:
+        tuple: (mido.MidiFile, tracks) where tracks is a list of
+               (name, notes) and notes are tuples of
+               (note, velocity, length_beats, position_beats) sorted by position
+    """
+    midi_file = mido.MidiFile(path)
+    ppq = midi_file.ticks_per_beat
+    
+    tracks = []
+    for index, track in enumerate(midi_file.tracks):
+        name = track.name or f"Track {index}"
+        by_channel = collections.defaultdict(list)
+        held = collections.defaultdict(collections.deque)  # (channel, note) -> deque of (tick, velocity)
+        tick = 0
+        for message in track:
+            tick += message.time
+            if message.type == 'note_on' and message.velocity > 0:
+                held[(message.channel, message.note)].append((tick, message.velocity))
+            elif message.type in ('note_on', 'note_off'):
+                starts = held.get((message.channel, message.note))
+                if starts:
+                    start, velocity = starts.popleft()
+                    by_channel[message.channel].append((message.note, velocity, start, tick))
+        for (channel, note), starts in held.items():
+            for start, velocity in starts:
+                by_channel[channel].append((note, velocity, start, tick))
         
-        # 5. Position whole part (0-127)
-        position_whole = min(127, int(position))
-        midi_data.append(position_whole)
+        if midi_file.type == 0 and len(by_channel) > 1:
+            for channel in sorted(by_channel):
+                tracks.append((f"{name} channel {channel + 1}", ticks_to_beats(by_channel[channel], ppq)))
+        else:
+            notes = [n for channel in sorted(by_channel) for n in by_channel[channel]]
+            tracks.append((name, ticks_to_beats(notes, ppq)))
+    
+    return midi_file, tracks
+
+def ticks_to_beats(notes, ppq):
+    """
+    Convert (note, velocity, start_tick, end_tick) in file ticks to note tuples in beats
+    
+    Lengths are kept to at least one wire tick so very short notes still get
+    a note off after their note on.
+    
+    Returns:
+        list: Tuples of (note, velocity, length_beats, position_beats), sorted by position
+    """
+    shortest = 1 / WIRE_PPQ
+    return sorted(((note, velocity, max(shortest, (end - start) / ppq), start / ppq)
+                   for note, velocity, start, end in notes), key=lambda n: n[3])
+
+encode_pool = None
+
+async def encode_tracks(track_notes, encoding):
+    """
+    Encode several note lists, in worker processes when there is enough work
+    
+    The phrase encoding depends on the server's mirror of the device cache,
+    so it is tried afterwards in this process, in track order.
+    
+    Args:
+        track_notes (list): One list of note tuples per track
+        encoding (str): "auto", "compressed", "ticks" or "phrases"
         
-        # 6. Position decimal part (0-9)
-        position_decimal = int(round((position - position_whole) * 10)) % 10
-        midi_data.append(position_decimal)
+    Returns:
+        list: (note_format, midi_data) per track, in the same order
+    """
+    encoded = await encode_tracks_pooled(track_notes, encoding)
+    if phrases_available():
+        encoded = [apply_phrases(notes, encoding, note_format, midi_data)
+                   for notes, (note_format, midi_data) in zip(track_notes, encoded)]
+    return encoded
+
+async def encode_tracks_pooled(track_notes, encoding):
+    """encode_tracks without the phrase encoding"""
+    global encode_pool
+    if len(track_notes) < 2 or sum(len(notes) for notes in track_notes) < POOL_MIN_NOTES:
+        return [encode_melody(notes, encoding) for notes in track_notes]
     
-    # Start MIDI transfer
-    print(f"Transferring {len(notes)} notes ({len(midi_data)} MIDI values)...")
+    if encode_pool is None:
+        encode_pool = concurrent.futures.ProcessPoolExecutor()
+    loop = asyncio.get_running_loop()
+    try:
+        return await asyncio.gather(*(loop.run_in_executor(encode_pool, encode_melody, notes, encoding)
+                                      for notes in track_notes))
+    except concurrent.futures.process.BrokenProcessPool as e:
+        logger.warning("Encoder processes failed (%s), encoding in the server process", e)
+        encode_pool = None
+        return [encode_melody(notes, encoding) for notes in track_notes]
+
+def int_to_varint(value):
+    """
+    Convert a non-negative integer into a variable-length array of MIDI bytes
     
-    # Initial toggle signal (note 0)
-    send_midi_note(0)
-    time.sleep(0.01)
+    Like int_to_midi_bytes the value is split MSB first, but each byte carries
+    6 bits and bit 6 (0x40) marks that more bytes follow. Values below 64
+    take one byte, values below 4096 take two.
     
-    # Send total count of notes
-    send_midi_note(min(127, len(notes)))
-    time.sleep(0.01)
+    Args:
+        value (int): The integer value to convert
+        
+    Returns:
+        list: Array of MIDI bytes (each 0-127)
+    """
+    if value < 0:
+        logger.warning("Negative values not supported, converting to positive")
+        value = abs(value)
     
-    # Send all MIDI data values
-    for i, value in enumerate(midi_data):
-        send_midi_note(value)
-        #time.sleep(0.1)
-        #print(f"Sent MIDI value {i+1}/{len(midi_data)}: {value}")
+    midi_bytes = [value & 0x3F]
+    value >>= 6
+    while value > 0:
+        midi_bytes.insert(0, 0x40 | (value & 0x3F))
+        value >>= 6
     
-    send_midi_note(127)
+    return midi_bytes
 
-    #print(f"Melody transfer complete: {len(notes)} notes sent")
-    return f"Melody successfully transferred: {len(notes)} notes ({len(midi_data)} MIDI values) sent to FL Studio"
+def encode_notes_ticks(notes, ppq=WIRE_PPQ):
+    """
+    Encode notes in NOTE_FORMAT_TICKS
+    
+    Notes are sorted by position and each one is sent as note, velocity, the
+    distance in ticks from the previous note's start and its length in ticks,
+    both as varints. Timing is exact to 1/ppq of a beat and song length is
+    unlimited.
+    
+    Args:
+        notes (list): Tuples of (note, velocity, length_beats, position_beats)
+        ppq (int): Ticks per beat on the wire
+        
+    Returns:
+        list: Encoded note values (each 0-127)
+    """
+    midi_data = []
+    previous_tick = 0
+    for note, velocity, length_tick, position_tick in notes_to_ticks(notes, ppq):
+        midi_data.append(note)
+        midi_data.append(velocity)
+        midi_data.extend(int_to_varint(position_tick - previous_tick))
+        midi_data.extend(int_to_varint(length_tick))
+        previous_tick = position_tick
+    
+    return midi_data
+
+def encode_notes_compressed(notes, ppq=WIRE_PPQ):
+    """
+    Encode notes in NOTE_FORMAT_COMPRESSED
+    
+    Each record starts with a NOTE_* flags byte followed by only the fields
+    that changed since the previous note, in the order note, velocity, varint
+    delta ticks, varint length ticks. A run of identical notes at an even
+    spacing collapses into one record with NOTE_REPEAT and a varint count,
+    so a steady hi-hat or arpeggio line costs a few bytes in total.
+    
+    Args:
+        notes (list): Tuples of (note, velocity, length_beats, position_beats)
+        ppq (int): Ticks per beat on the wire
+        
+    Returns:
+        list: Encoded note values (each 0-127)
+    """
+    return compress_ticks(notes_to_ticks(notes, ppq))
+
+def compress_ticks(ticks):
+    """
+    encode_notes_compressed for notes already in ticks
+    
+    Args:
+        ticks (list): Tuples of (note, velocity, length_ticks, position_ticks), sorted by position
+        
+    Returns:
+        list: Encoded note values (each 0-127)
+    """
+    midi_data = []
+    previous = (-1, -1, -1)  # note, velocity, length_tick
+    previous_tick = 0
+    previous_delta = -1
+    
+    i = 0
+    while i < len(ticks):
+        note, velocity, length_tick, position_tick = ticks[i]
+        delta = position_tick - previous_tick
+        
+        # Count following notes that repeat this one at the same spacing
+        repeats = 0
+        if delta > 0:
+            while (i + repeats + 1 < len(ticks)
+                   and ticks[i + repeats + 1][:3] == ticks[i][:3]
+                   and ticks[i + repeats + 1][3] - ticks[i + repeats][3] == delta):
+                repeats += 1
+        
+        flags = 0
+        fields = []
+        if note == previous[0]:
+            flags |= NOTE_SAME_NOTE
+        else:
+            fields.append(note)
+        if velocity == previous[1]:
+            flags |= NOTE_SAME_VELOCITY
+        else:
+            fields.append(velocity)
+        if delta == previous_delta:
+            flags |= NOTE_SAME_DELTA
+        else:
+            fields.extend(int_to_varint(delta))
+        if length_tick == previous[2]:
+            flags |= NOTE_SAME_LENGTH
+        else:
+            fields.extend(int_to_varint(length_tick))
+        if repeats:
+            flags |= NOTE_REPEAT
+            fields.extend(int_to_varint(repeats))
+        
+        midi_data.append(flags)
+        midi_data.extend(fields)
+        
+        previous = (note, velocity, length_tick)
+        previous_tick = position_tick + repeats * delta
+        previous_delta = delta
+        i += repeats + 1
+    
+    return midi_data
+
+def notes_to_ticks(notes, ppq=WIRE_PPQ):
+    """
+    Convert notes to integer ticks, sorted by position
+    
+    Args:
+        notes (list): Tuples of (note, velocity, length_beats, position_beats)
+        ppq (int): Ticks per beat
+        
+    Returns:
+        list: Tuples of (note, velocity, length_ticks, position_ticks)
+    """
+    return sorted(
+        ((note, velocity, int(round(length * ppq)), int(round(position * ppq)))
+         for note, velocity, length, position in notes),
+        key=lambda n: n[3]
+    )
+
+phrase_cache = collections.OrderedDict()  # Keys the device should have cached, least recently used first
+phrase_lock = threading.Lock()
+
+def encode_notes_phrases(notes, ppq=WIRE_PPQ, cache=None):
+    """
+    Encode notes in NOTE_FORMAT_PHRASES
+    
+    Notes are cut into phrases at every PHRASE_BEATS bar line. A phrase is
+    keyed by a hash of its notes relative to the bar start and its lowest
+    note, so a bar played again later or transposed has the same key. The
+    first time a key is seen it is defined, after that only
+    "play phrase K at tick T transposed by N" is sent.
+    
+    The device keeps phrases in an LRU cache of PHRASE_CACHE_SIZE. `cache`
+    mirrors it and is updated the same way the device will update its own.
+    
+    Args:
+        notes: Note tuples or a NumPy note array
+        ppq (int): Ticks per beat on the wire
+        cache (OrderedDict): Mirror of the device cache, updated in place
+        
+    Returns:
+        list: Encoded operations (each 0-127)
+    """
+    if cache is None:
+        cache = collections.OrderedDict()
+    if np is not None and isinstance(notes, np.ndarray):
+        ticks = list(zip(*(column.tolist() for column in note_array_to_ticks(as_note_array(notes), ppq))))
+    else:
+        ticks = notes_to_ticks(notes, ppq)
+    bar_ticks = PHRASE_BEATS * ppq
+    
+    midi_data = []
+    start = 0
+    while start < len(ticks):
+        bar = ticks[start][3] // bar_ticks
+        end = start
+        while end < len(ticks) and ticks[end][3] // bar_ticks == bar:
+            end += 1
+        
+        low = min(n[0] for n in ticks[start:end])
+        phrase = compress_ticks([(note - low, velocity, length, position - bar * bar_ticks)
+                                 for note, velocity, length, position in ticks[start:end]])
+        key = phrase_key(phrase)
+        key_values = [(key >> 21) & 0x7F, (key >> 14) & 0x7F, (key >> 7) & 0x7F, key & 0x7F]
+        
+        if key in cache:
+            cache.move_to_end(key)
+        else:
+            midi_data.append(PHRASE_DEFINE)
+            midi_data.extend(key_values)
+            midi_data.extend(int_to_varint(end - start))
+            midi_data.extend(int_to_varint(len(phrase)))
+            midi_data.extend(phrase)
+            cache[key] = True
+            while len(cache) > PHRASE_CACHE_SIZE:
+                cache.popitem(last=False)
+        
+        midi_data.append(PHRASE_PLAY)
+        midi_data.extend(key_values)
+        midi_data.extend(int_to_varint(bar * bar_ticks))
+        midi_data.append(low)
+        start = end
+    
+    return midi_data
+
+def phrase_key(values):
+    """28-bit content hash of a phrase's encoded values"""
+    digest = hashlib.blake2b(bytes(values), digest_size=4).digest()
+    return int.from_bytes(digest, 'big') >> 4
+
+# Fields of a NumPy note array
+NOTE_DTYPE = [('note', 'u1'), ('velocity', 'u1'), ('length', 'f8'), ('position', 'f8')]
+
+def parse_notes_array(lines):
+    """
+    Parse note lines into a NOTE_DTYPE array in bulk
+    
+    Args:
+        lines (list): Non-empty "note,velocity,length,position" lines
+        
+    Returns:
+        numpy.ndarray: Clamped notes, or None if any line is malformed
+    """
+    # Every line must have exactly four fields, or a short line next to a
+    # long one would pass the total count and shift every later column
+    if not all(line.count(',') == 3 for line in lines):
+        return None
+    fields = ','.join(lines).split(',')
+    try:
+        note = np.array(fields[0::4], dtype=np.int64)
+        velocity = np.array(fields[1::4], dtype=np.int64)
+        length = np.array(fields[2::4], dtype=np.float64)
+        position = np.array(fields[3::4], dtype=np.float64)
+    except (ValueError, OverflowError):
+        return None
+    if not (np.isfinite(length).all() and np.isfinite(position).all()):
+        return None
+    return make_note_array(note, velocity, length, position)
+
+def make_note_array(note, velocity, length, position):
+    """Build a NOTE_DTYPE array from columns, clamped like parse_notes"""
+    notes = np.empty(len(note), dtype=NOTE_DTYPE)
+    notes['note'] = np.clip(note, 0, 127)
+    notes['velocity'] = np.clip(velocity, 0, 127)
+    notes['length'] = np.maximum(length, 0)
+    notes['position'] = np.maximum(position, 0)
+    return notes
+
+def as_note_array(notes):
+    """
+    Convert notes to a NOTE_DTYPE array
+    
+    Args:
+        notes: Note tuples, a NOTE_DTYPE array, or any array with 4 columns
+               in the order note, velocity, length, position
+               
+    Returns:
+        numpy.ndarray: Clamped NOTE_DTYPE array
+    """
+    if isinstance(notes, np.ndarray) and notes.dtype.names:
+        return make_note_array(notes['note'], notes['velocity'], notes['length'], notes['position'])
+    columns = np.asarray(notes, dtype=np.float64).reshape(-1, 4).T
+    return make_note_array(columns[0].astype(np.int64), columns[1].astype(np.int64),
+                           columns[2], columns[3])
+
+def note_array_to_ticks(notes, ppq=WIRE_PPQ):
+    """
+    Vectorized notes_to_ticks
+    
+    Returns:
+        tuple: Arrays (note, velocity, length_ticks, position_ticks), sorted by position
+    """
+    position = np.rint(notes['position'] * ppq).astype(np.int64)
+    order = np.argsort(position, kind='stable')
+    length = np.rint(notes['length'] * ppq).astype(np.int64)
+    return (notes['note'][order].astype(np.int64), notes['velocity'][order].astype(np.int64),
+            length[order], position[order])
+
+def varint_sizes(values):
+    """Number of int_to_varint bytes for each value"""
+    sizes = np.ones(len(values), dtype=np.int64)
+    remaining = values >> 6
+    while remaining.any():
+        sizes += remaining > 0
+        remaining >>= 6
+    return sizes
+
+def pack_records(fields):
+    """
+    Lay out variable-length records in one contiguous buffer
+    
+    Args:
+        fields (list): Per-field tuples of (values, sizes, varint) in record
+                       order. sizes is how many bytes each record spends on
+                       the field: 0 leaves it out, and plain fields use 1.
+                       
+    Returns:
+        bytes: All records back to back
+    """
+    record_sizes = sum(sizes for _, sizes, _ in fields)
+    offsets = np.cumsum(record_sizes) - record_sizes
+    buffer = np.zeros(int(record_sizes.sum()), dtype=np.uint8)
+    
+    for values, sizes, varint in fields:
+        if varint:
+            # MSB first, 0x40 on every byte but the last
+            for k in range(int(sizes.max(initial=0))):
+                present = sizes > k
+                shift = 6 * (sizes[present] - 1 - k)
+                more = np.where(k < sizes[present] - 1, 0x40, 0)
+                buffer[offsets[present] + k] = ((values[present] >> shift) & 0x3F) | more
+        else:
+            present = sizes > 0
+            buffer[offsets[present]] = values[present]
+        offsets = offsets + sizes
+    
+    return buffer.tobytes()
+
+def encode_notes_ticks_array(notes, ppq=WIRE_PPQ):
+    """
+    Vectorized encode_notes_ticks, byte for byte the same output
+    
+    Args:
+        notes (numpy.ndarray): NOTE_DTYPE array
+        ppq (int): Ticks per beat on the wire
+        
+    Returns:
+        bytes: Encoded note values (each 0-127)
+    """
+    note, velocity, length, position = note_array_to_ticks(notes, ppq)
+    delta = np.diff(position, prepend=0)
+    ones = np.ones(len(note), dtype=np.int64)
+    return pack_records([
+        (note, ones, False),
+        (velocity, ones, False),
+        (delta, varint_sizes(delta), True),
+        (length, varint_sizes(length), True),
+    ])
+
+def encode_notes_compressed_array(notes, ppq=WIRE_PPQ):
+    """
+    Vectorized encode_notes_compressed, byte for byte the same output
+    
+    A note joins the repeat run of the note before it when note, velocity
+    and length match and it keeps the same non-zero spacing, which is how
+    the sequential encoder groups them.
+    
+    Args:
+        notes (numpy.ndarray): NOTE_DTYPE array
+        ppq (int): Ticks per beat on the wire
+        
+    Returns:
+        bytes: Encoded note values (each 0-127)
+    """
+    note, velocity, length, position = note_array_to_ticks(notes, ppq)
+    if not len(note):
+        return b''
+    spacing = np.diff(position, prepend=0)
+    
+    joins = np.zeros(len(note), dtype=bool)
+    joins[1:] = ((note[1:] == note[:-1]) & (velocity[1:] == velocity[:-1])
+                 & (length[1:] == length[:-1]) & (spacing[1:] == spacing[:-1]) & (spacing[1:] > 0))
+    starts = np.flatnonzero(~joins)
+    repeats = np.diff(starts, append=len(note)) - 1
+    
+    note, velocity, length, delta = note[starts], velocity[starts], length[starts], spacing[starts]
+    # The running state is the previous record's, starting from nothing
+    same_note = note == np.concatenate(([-1], note[:-1]))
+    same_velocity = velocity == np.concatenate(([-1], velocity[:-1]))
+    same_delta = delta == np.concatenate(([-1], delta[:-1]))
+    same_length = length == np.concatenate(([-1], length[:-1]))
+    
+    flags = (same_note * NOTE_SAME_NOTE | same_velocity * NOTE_SAME_VELOCITY
+             | same_delta * NOTE_SAME_DELTA | same_length * NOTE_SAME_LENGTH
+             | (repeats > 0) * NOTE_REPEAT)
+    ones = np.ones(len(starts), dtype=np.int64)
+    return pack_records([
+        (flags, ones, False),
+        (note, ~same_note * 1, False),
+        (velocity, ~same_velocity * 1, False),
+        (delta, varint_sizes(delta) * ~same_delta, True),
+        (length, varint_sizes(length) * ~same_length, True),
+        (repeats, varint_sizes(repeats) * (repeats > 0), True),
+    ])
+
+def send_sysex(command, payload=(), seq=0, stripe=0):
+    """
+    Send a single SysEx frame to FL Studio
+    
+    Args:
+        command (int): One of the SYSEX_* command bytes
+        payload (list): Data bytes for the frame (each 0-127)
+        seq (int): Sequence number of the frame
+        stripe (int): Output to send it on, see MidiPortManager.send
+    """
+    seq %= SEQ_MODULO
+    data = [SYSEX_MANUFACTURER_ID, command, seq >> 7, seq & 0x7F]
+    data.extend(payload)
+    data.extend(frame_crc(data[1:]))
+    ports.send(Message('sysex', data=data), stripe)
+
+def frame_crc(values):
+    """
+    Checksum a frame's command, seq and payload
+    
+    Returns:
+        list: CRC-16/CCITT (initial value 0xFFFF) as 3 values, top bits first
+    """
+    crc = binascii.crc_hqx(bytes(values), 0xFFFF)
+    return [crc >> 14, (crc >> 7) & 0x7F, crc & 0x7F]
+
+def parse_sysex_reply(message):
+    """
+    Split a SysEx message from the Test Controller into its parts
+    
+    Args:
+        message (mido.Message): Message read from the input port
+        
+    Returns:
+        tuple: (command, seq, payload), or None if it isn't one of our frames
+               or its checksum doesn't match
+    """
+    if message.type != 'sysex':
+        return None
+    data = message.data
+    if len(data) < 4 + SYSEX_CRC_SIZE or data[0] != SYSEX_MANUFACTURER_ID:
+        return None
+    if frame_crc(data[1:-SYSEX_CRC_SIZE]) != list(data[-SYSEX_CRC_SIZE:]):
+        metrics.count("sysex_replies_corrupt")
+        logger.debug("Dropping a damaged frame from FL Studio")
+        return None
+    return data[1], (data[2] << 7) | data[3], list(data[4:-SYSEX_CRC_SIZE])
+
+class FrameSender:
+    """
+    Sliding-window sender for SysEx frames acknowledged by the Test Controller
+    
+    Up to `window` frames are in flight at once. Every acknowledgement that
+    moves the window forward lets it grow by one frame, so a responsive FL
+    runs at full port speed. When acknowledgements stop arriving the window
+    is halved and everything after the last acknowledged frame is resent, so
+    a busy FL slows the transfer down instead of losing data.
+    
+    With stripe ports configured, frame n goes out on output n % stripes and
+    the device puts them back in order. Frames on different ports can
+    overtake each other, so the first frame, which starts a new sequence on
+    the device, is sent alone and the rest follow once it is acknowledged.
+    
+    Every frame carries a CRC. The device drops damaged frames and answers
+    gaps with a NACK listing the frames it is missing, and only those are
+    resent from the window of unacknowledged frames. The timeout is the
+    fallback for when nothing comes back at all.
+    
+    Sequence numbers carry on from one transfer to the next, so the device
+    can tell a first frame resent after a lost acknowledgement from a new
+    transfer that looks the same.
+    """
+    
+    def __init__(self):
+        self.window = ACK_WINDOW_INITIAL
+        self.round_trip = ACK_TIMEOUT_MIN / 4
+        self.first_seq = random.randrange(SEQ_MODULO)  # Sequence number of the next transfer's first frame
+        self.last_ack_payload = []
+        self.replies = []   # Other frames the device sent during the last transfer
+        self.nacked = set() # Frames the device reported missing since the last check
+        self.lock = threading.Lock()  # Held while a transfer reads the return port
+    
+    def timeout(self, retries=0):
+        """
+        Seconds to wait for an acknowledgement before resending
+        
+        The wait doubles with every resend in a row that brought nothing
+        back (Karn's backoff), so a stalled FL gets several seconds to
+        recover before the transfer gives up.
+        """
+        return min(ACK_TIMEOUT_MAX, max(ACK_TIMEOUT_MIN, 4 * self.round_trip) * 2 ** retries)
+    
+    def send_frames(self, frames, progress=None):
+        """
+        Send a transfer's frames, numbered from first_seq, and wait until all are acknowledged
+        
+        Args:
+            frames (list): Tuples of (command, payload)
+            progress (callable): Called as progress(frames_total, frames_sent,
+                                 frames_acked, bytes_sent) whenever these change
+            
+        Returns:
+            list: Payload of the last frame's acknowledgement, which carries
+                  its status, or empty without the return port
+            
+        Raises:
+            TimeoutError: If the device stops acknowledging frames, even
+                          after the return port was reopened
+        """
+        with self.lock:
+            try:
+                return self.send_frames_locked(frames, progress)
+            except TimeoutError as e:
+                logger.warning("%s, reopening MIDI input '%s' and trying once more", e, ports.input_name)
+                ports.close_input()
+                if ports.input() is None:
+                    raise
+                # Same sequence numbers, so the device only acknowledges
+                # what it already handled
+                return self.send_frames_locked(frames, progress)
+            finally:
+                self.first_seq = (self.first_seq + len(frames)) % SEQ_MODULO
+    
+    def send_frames_locked(self, frames, progress):
+        """send_frames, with the lock held"""
+        bytes_sent = 0
+        input_port = ports.input()
+        self.last_ack_payload = []
+        self.replies = []
+        self.nacked.clear()
+        metrics.count("sysex_frames", len(frames))
+        
+        if input_port is None:
+            for seq, (command, payload) in enumerate(frames):
+                if seq:
+                    time.sleep(SYSEX_FRAME_DELAY)
+                send_sysex(command, payload, self.first_seq + seq)
+                bytes_sent += len(payload) + SYSEX_FRAME_OVERHEAD
+                if progress is not None:
+                    progress(len(frames), seq + 1, seq + 1, bytes_sent)
+            return []
+        
+        # Drop stale acknowledgements from an earlier transfer
+        read_device_frames(input_port)
+        
+        base = 0            # Oldest unacknowledged frame
+        next_seq = 0        # Next frame to send
+        sent_end = 0        # Frame after the newest one sent so far, even before a resend rewound next_seq
+        sent_at = {}        # seq -> time it was (last) sent
+        resent = set()      # Frames sent more than once, which give no round trip sample
+        retries = 0
+        
+        stripes = ports.stripe_count()
+        while base < len(frames):
+            window = self.window if base or stripes == 1 else 1
+            while next_seq < len(frames) and next_seq - base < window:
+                command, payload = frames[next_seq]
+                send_sysex(command, payload, self.first_seq + next_seq, next_seq % stripes)
+                if next_seq in sent_at:
+                    resent.add(next_seq)
+                sent_at[next_seq] = time.perf_counter()
+                bytes_sent += len(payload) + SYSEX_FRAME_OVERHEAD
+                next_seq += 1
+                sent_end = max(sent_end, next_seq)
+                if progress is not None:
+                    progress(len(frames), next_seq, base, bytes_sent)
+            
+            # Frames sent before a timeout rewound next_seq, or by the try
+            # before the input was reopened, may be acknowledged ahead of the
+            # frames sent since. Sequence numbers are unique to this transfer,
+            # so any ACK within it counts.
+            acked = self.read_acks(input_port, base, len(frames))
+            now = time.perf_counter()
+            if acked == len(frames) - 1 and not self.last_ack_payload:
+                # The last frame is only done once an ACK brings its status.
+                # A NACK, or the plain ACK of an older device for a duplicate,
+                # leaves it unknown, so keep waiting and resend it on timeout;
+                # the device answers the duplicate with the status it cached.
+                acked -= 1
+            
+            # Resend frames the device reported missing, unless they were
+            # (re)sent too recently to have arrived yet
+            for seq in sorted(self.nacked):
+                if acked < seq < sent_end and now - sent_at[seq] > self.round_trip:
+                    command, payload = frames[seq]
+                    send_sysex(command, payload, self.first_seq + seq, seq % stripes)
+                    sent_at[seq] = now
+                    resent.add(seq)
+                    bytes_sent += len(payload) + SYSEX_FRAME_OVERHEAD
+                    metrics.count("sysex_frames_resent")
+                    metrics.count("sysex_frames_nacked")
+            self.nacked.clear()
+            
+            if acked >= base:
+                if progress is not None:
+                    progress(len(frames), next_seq, acked + 1, bytes_sent)
+                # Smooth the round trip over recent frames. A resent frame's
+                # ACK may answer any of its sends, so it isn't sampled (Karn's
+                # rule); pairing it with the last send would shrink the timeout
+                # just when the link is losing frames.
+                if acked < sent_end and acked not in resent:
+                    metrics.record("ack_round_trip", now - sent_at[acked])
+                    self.round_trip += (now - sent_at[acked] - self.round_trip) / 8
+                self.window = min(ACK_WINDOW_MAX * stripes, SYSEX_REORDER_WINDOW,
+                                  self.window + (acked + 1 - base))
+                for seq in range(base, acked + 1):
+                    sent_at.pop(seq, None)
+                    resent.discard(seq)
+                base = acked + 1
+                next_seq = max(next_seq, base)
+                retries = 0
+            elif now - sent_at[base] > self.timeout(retries):
+                retries += 1
+                if retries > ACK_MAX_RETRIES:
+                    raise TimeoutError(f"FL Studio stopped acknowledging frames at {base}/{len(frames)}")
+                self.window = max(1, self.window // 2)
+                logger.info("No acknowledgement for frame %d, resending with window %d", base, self.window)
+                metrics.count("ack_timeouts")
+                metrics.count("sysex_frames_resent", next_seq - base)
+                next_seq = base
+            else:
+                time.sleep(0.0005)
+        
+        return self.last_ack_payload
+    
+    def read_acks(self, input_port, base, next_seq):
+        """
+        Drain pending acknowledgements
+        
+        Args:
+            input_port: Port the device sends acknowledgements on
+            base (int): Oldest unacknowledged frame
+            next_seq (int): Frame after the newest one sent
+            
+        Returns:
+            int: Newest frame acknowledged, or base - 1 if there are none.
+                 Its payload is kept in last_ack_payload, frames listed in
+                 NACKs are added to nacked and other frames from the device
+                 to replies.
+        """
+        acked = base - 1
+        for message in input_port.iter_pending():
+            reply = parse_sysex_reply(message)
+            if reply is None:
+                continue
+            if reply[0] == SYSEX_STATE:
+                update_project_state(reply[2])
+                continue
+            if reply[0] not in (SYSEX_ACK, SYSEX_NACK):
+                self.replies.append(reply)
+                continue
+            # Map the 14-bit sequence numbers back into the frames in flight.
+            # A NACK also acknowledges everything before the first gap.
+            seq = base + (reply[1] - self.first_seq - base) % SEQ_MODULO
+            if seq < next_seq and seq > acked:
+                acked = seq
+                if reply[0] == SYSEX_ACK:
+                    self.last_ack_payload = reply[2]
+            if reply[0] == SYSEX_NACK:
+                payload = reply[2]
+                for index in range(0, len(payload) - 1, 2):
+                    missing = (payload[index] << 7) | payload[index + 1]
+                    missing = base + (missing - self.first_seq - base) % SEQ_MODULO
+                    if missing < next_seq:
+                        self.nacked.add(missing)
+        return acked
+
+frame_sender = FrameSender()
+
+# Mirror of the project state the device sends in SYSEX_STATE frames
+project_state = {}
+project_state_at = None   # time.time() of the last update
+project_state_lock = threading.Lock()
+
+def read_device_frames(input_port):
+    """
+    Drain the return port outside a transfer, keeping state updates
+    
+    Acknowledgements read here are stale and dropped.
+    """
+    for message in input_port.iter_pending():
+        reply = parse_sysex_reply(message)
+        if reply is not None and reply[0] == SYSEX_STATE:
+            update_project_state(reply[2])
+
+def poll_device_frames():
+    """
+    Pick up state updates waiting on the return port
+    
+    While a transfer is running it reads the port itself, so this doesn't wait for it.
+    """
+    input_port = ports.input()
+    if input_port is None or not frame_sender.lock.acquire(blocking=False):
+        return
+    try:
+        read_device_frames(input_port)
+    finally:
+        frame_sender.lock.release()
+
+def parse_project_state(values):
+    """
+    Decode a SYSEX_STATE payload
+    
+    Args:
+        values (list): Tempo as 2 values (14 bits in TEMPO_STEPS_PER_BPM
+                       steps from TEMPO_MIN), PPQ as 2 values, varint pattern,
+                       varint pattern count, varint channel, varint channel
+                       count, STATE_* flags
+        
+    Returns:
+        dict: tempo, ppq, pattern, pattern_count, channel, channel_count,
+              playing and recording
+    """
+    tempo = (values[0] << 7) | values[1]
+    state = {
+        "tempo": TEMPO_MIN + tempo / TEMPO_STEPS_PER_BPM,
+        "ppq": (values[2] << 7) | values[3],
+    }
+    index = 4
+    for name in ("pattern", "pattern_count", "channel", "channel_count"):
+        state[name], index = read_varint(values, index)
+    flags = values[index]
+    state["playing"] = bool(flags & STATE_PLAYING)
+    state["recording"] = bool(flags & STATE_RECORDING)
+    return state
+
+def update_project_state(values):
+    """Replace the mirror with a SYSEX_STATE payload, ignoring damaged ones"""
+    global project_state_at
+    try:
+        state = parse_project_state(values)
+    except IndexError:
+        logger.warning("Ignoring a damaged project state from FL Studio")
+        return
+    with project_state_lock:
+        project_state.clear()
+        project_state.update(state)
+        project_state_at = time.time()
+    logger.debug("FL Studio state: %s", state)
+
+@mcp.tool()
+async def get_project_state(refresh: bool = False):
+    """
+    Get FL Studio's tempo, PPQ, selected pattern and channel and transport state
+    
+    FL Studio sends these whenever they change, so this normally answers
+    instantly from the copy kept here. Needs the return MIDI port.
+    
+    Args:
+        refresh (bool): Ask FL Studio for the state again instead of using the copy
+    """
+    if ports.input() is None:
+        return "The project state needs the return MIDI port, see select_midi_ports"
+    poll_device_frames()
+    if refresh or project_state_at is None:
+        job = CommandJob(SYSEX_STATE_REQUEST, [])
+        await submit_transfer(job)
+        try:
+            await asyncio.wait_for(job.done.wait(), COMMAND_WAIT)
+        except asyncio.TimeoutError:
+            pass
+    with project_state_lock:
+        if project_state_at is None:
+            return "FL Studio hasn't sent its state, is the Test Controller script loaded?"
+        report = dict(project_state)
+        report["age_seconds"] = round(time.time() - project_state_at, 3)
+    return report
+
+def new_session_id():
+    """
+    Get the ID for the next transfer session
+    
+    The device ignores data and end frames whose session doesn't match the
+    last begin frame, so leftovers from an abandoned transfer can't end up
+    in the next one.
+    
+    Returns:
+        int: Session ID (0-127)
+    """
+    global next_session_id
+    session_id = next_session_id
+    next_session_id = (next_session_id + 1) % 128
+    return session_id
+
+next_session_id = 0
+
+def send_melody_sysex(note_count, midi_data, flags=0, note_format=NOTE_FORMAT_TICKS, ppq=WIRE_PPQ,
+                      progress=None):
+    """
+    Send encoded melody values to FL Studio as one chunked transfer session
+    
+    A begin frame carries the session ID, how the notes are encoded, the note
+    count and the number of chunks. The values follow in numbered data frames
+    of SYSEX_CHUNK_SIZE values each, and an end frame tells the device to
+    record everything it collected. There is no limit on the number of notes.
+    
+    Args:
+        note_count (int): Number of notes encoded in midi_data
+        midi_data (list or bytes): Encoded note values (each 0-127)
+        flags (int): SYSEX_FLAG_* bits for the device
+        note_format (int): NOTE_FORMAT_* used to encode midi_data
+        ppq (int): Ticks per beat used by tick-based formats (at most 16383)
+        progress (callable): Passed on to FrameSender.send_frames
+        
+    Returns:
+        int: SYSEX_STATUS_* the device acknowledged the end frame with, or
+             SYSEX_STATUS_OK without the return port, where nothing comes back
+        
+    Raises:
+        TimeoutError: If the device stops acknowledging frames
+    """
+    session_id = new_session_id()
+    chunk_total = (len(midi_data) + SYSEX_CHUNK_SIZE - 1) // SYSEX_CHUNK_SIZE
+    
+    begin = [session_id, flags & 0x7F, note_format, (ppq >> 7) & 0x7F, ppq & 0x7F]
+    begin.extend(int_to_varint(note_count))
+    begin.extend(int_to_varint(chunk_total))
+    frames = [(SYSEX_MELODY_BEGIN, begin)]
+    
+    for index in range(chunk_total):
+        chunk = [session_id]
+        chunk.extend(int_to_varint(index))
+        chunk.extend(midi_data[index * SYSEX_CHUNK_SIZE:(index + 1) * SYSEX_CHUNK_SIZE])
+        frames.append((SYSEX_MELODY_DATA, chunk))
+    
+    frames.append((SYSEX_MELODY_END, [session_id]))
+    payload = frame_sender.send_frames(frames, progress)
+    return payload[0] if payload else SYSEX_STATUS_OK
+
+class TransferJob:
+    """
+    A melody transfer handled by the background sender
+    
+    The sender thread updates the progress counters while the transfer runs,
+    and `done` is set once it has finished or failed.
+    """
+    
+    def __init__(self, note_count, midi_data, flags=0, note_format=NOTE_FORMAT_TICKS, ppq=WIRE_PPQ,
+                 notes=None, encoding="auto"):
+        global next_job_id
+        self.job_id = next_job_id
+        next_job_id += 1
+        
+        self.note_count = note_count
+        self.midi_data = midi_data
+        self.flags = flags
+        self.note_format = note_format
+        self.ppq = ppq
+        # Kept to re-encode a phrase transfer if the device lost its cache
+        self.notes = notes if note_format in (NOTE_FORMAT_PHRASES, NOTE_FORMAT_CHANNELS) else None
+        self.encoding = encoding
+        
+        self.status = "queued"
+        self.error = None
+        self.frames_total = 0
+        self.frames_sent = 0
+        self.frames_acked = 0
+        self.bytes_sent = 0
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.done = asyncio.Event()
+        
+        jobs[self.job_id] = self
+        while len(jobs) > JOB_HISTORY:
+            del jobs[next(iter(jobs))]
+    
+    def update(self, frames_total, frames_sent, frames_acked, bytes_sent):
+        """Progress callback for FrameSender.send_frames"""
+        self.frames_total = frames_total
+        self.frames_sent = frames_sent
+        self.frames_acked = frames_acked
+        self.bytes_sent = bytes_sent
+    
+    def send(self):
+        """
+        Send the frames for this job
+        
+        Returns:
+            int: SYSEX_STATUS_* the device reported
+        """
+        status = send_melody_sysex(self.note_count, self.midi_data, self.flags,
+                                   self.note_format, self.ppq, progress=self.update)
+        if status == SYSEX_STATUS_PHRASE_MISSING:
+            # The device was reloaded or lost a phrase we thought it had.
+            # Forget what it has and send every phrase in full.
+            logger.info("Job %d replayed phrases FL Studio doesn't have, resending them", self.job_id)
+            if self.note_format == NOTE_FORMAT_CHANNELS:
+                with phrase_lock:
+                    phrase_cache.clear()
+                # Each part as it was chosen, only without phrase replays
+                _, self.midi_data = encode_melody(self.notes, self.encoding, self.ppq, phrases=True)
+            else:
+                with phrase_lock:
+                    phrase_cache.clear()
+                    self.midi_data = encode_notes_phrases(self.notes, self.ppq, phrase_cache)
+            status = send_melody_sysex(self.note_count, self.midi_data, self.flags,
+                                       self.note_format, self.ppq, progress=self.update)
+        return status
+    
+    def run(self):
+        """Send the transfer, blocking until it is acknowledged or fails"""
+        self.status = "sending"
+        self.started_at = time.time()
+        metrics.record("queue_wait", self.started_at - self.queued_at)
+        try:
+            with metrics.timer("transfer"):
+                status = self.send()
+            if status != SYSEX_STATUS_OK:
+                raise RuntimeError(f"FL Studio rejected the transfer with status {status}")
+            self.status = "done"
+        except Exception as e:
+            self.status = "failed"
+            self.error = str(e)
+            metrics.count("jobs_failed")
+            logger.error("Job %d failed: %s", self.job_id, e)
+        finally:
+            self.finished_at = time.time()
+            logger.info("Job %d %s after %.3f s", self.job_id, self.status,
+                        self.finished_at - self.started_at)
+            flush_log()
+            # The encoded values are no longer needed once the job is over
+            self.midi_data = []
+            self.notes = None
+    
+    def to_dict(self):
+        """Progress report returned by job_status and wait_job"""
+        report = {
+            "job_id": self.job_id,
+            "status": self.status,
+            "notes": self.note_count,
+            "frames_total": self.frames_total,
+            "frames_sent": self.frames_sent,
+            "frames_acked": self.frames_acked,
+            "bytes_sent": self.bytes_sent,
+            "notes_acked": 0,
+            "elapsed_seconds": 0.0,
+            "estimated_seconds_left": None,
+        }
+        if self.frames_total:
+            report["notes_acked"] = self.note_count * self.frames_acked // self.frames_total
+        if self.started_at is not None:
+            elapsed = (self.finished_at or time.time()) - self.started_at
+            report["elapsed_seconds"] = round(elapsed, 3)
+            if self.status == "sending" and self.frames_acked:
+                frames_left = self.frames_total - self.frames_acked
+                report["estimated_seconds_left"] = round(elapsed / self.frames_acked * frames_left, 3)
+        if self.status == "done":
+            report["estimated_seconds_left"] = 0.0
+        if self.error:
+            report["error"] = self.error
+        return report
+
+class CommandJob(TransferJob):
+    """
+    A single-frame command, like a grid write, queued with the melody transfers
+    
+    Going through the same queue keeps it from interleaving with a transfer
+    on the port, and the device acknowledges it with a status once applied.
+    """
+    
+    def __init__(self, command, payload):
+        super().__init__(0, payload)
+        self.command = command
+    
+    def send(self):
+        payload = frame_sender.send_frames([(self.command, self.midi_data)], progress=self.update)
+        return payload[0] if payload else SYSEX_STATUS_OK
+
+async def submit_command(job, description):
+    """
+    Queue a job and wait briefly for FL Studio to acknowledge it
+    
+    Args:
+        job (TransferJob): Job to queue
+        description (str): What the job sends, for the reply
+        
+    Returns:
+        str: Outcome, or the job ID if it is still waiting behind other transfers
+    """
+    await submit_transfer(job)
+    try:
+        await asyncio.wait_for(job.done.wait(), COMMAND_WAIT)
+    except asyncio.TimeoutError:
+        return f"Sending {description} as job {job.job_id}. Use job_status or wait_job to follow it."
+    if job.status == "done":
+        return f"Sent {description}"
+    return f"Failed to send {description}: {job.error}"
+
+class MetricsJob(CommandJob):
+    """Asks the device for its metrics, which arrive just before the acknowledgement"""
+    
+    def __init__(self, reset=False):
+        super().__init__(SYSEX_METRICS_REQUEST, [1 if reset else 0])
+        self.result = None
+    
+    def send(self):
+        status = super().send()
+        # A resent request is answered again, by an older device with an
+        # empty snapshot after a reset, so the first answer is the one that counts
+        for command, _, payload in frame_sender.replies:
+            if command == SYSEX_METRICS:
+                self.result = parse_device_metrics(payload)
+                break
+        return status
+
+def parse_device_metrics(values):
+    """
+    Decode a SYSEX_METRICS payload
+    
+    The payload is a series of entries: METRIC_COUNTER, name, varint value,
+    or METRIC_HISTOGRAM, name, varint bucket count, varint counts. Bucket i
+    counts durations below 2**i microseconds. Names are a varint length and
+    ASCII characters.
+    
+    Returns:
+        dict: "stages" with count and p50/p95/p99 in ms per stage (the upper
+              edge of the bucket each falls in), and "counters"
+    """
+    stages = {}
+    counters = {}
+    index = 0
+    while index < len(values):
+        kind = values[index]
+        length, index = read_varint(values, index + 1)
+        name = ''.join(chr(v) for v in values[index:index + length])
+        index += length
+        if kind == METRIC_COUNTER:
+            counters[name], index = read_varint(values, index)
+            continue
+        bucket_count, index = read_varint(values, index)
+        buckets = []
+        for _ in range(bucket_count):
+            count, index = read_varint(values, index)
+            buckets.append(count)
+        total = sum(buckets)
+        if not total:
+            continue
+        stages[name] = {"count": total}
+        for label, fraction in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+            running = 0
+            for bucket, count in enumerate(buckets):
+                running += count
+                if running >= fraction * total:
+                    stages[name][label] = (1 << bucket) / 1000
+                    break
+    return {"stages": stages, "counters": counters}
+
+def read_varint(values, index):
+    """
+    Read one varint written by int_to_varint
+    
+    Returns:
+        tuple: (value, index of the value after it)
+    """
+    result = 0
+    while True:
+        byte = values[index]
+        index += 1
+        result = (result << 6) | (byte & 0x3F)
+        if not byte & 0x40:
+            return result, index
+
+@mcp.tool()
+async def get_metrics(reset: bool = False):
+    """
+    Report where time goes in transfers, on this server and in FL Studio
+    
+    Server stages: parse and encode (send_melody), queue_wait (job waiting
+    for the port), transfer (sending a job until acknowledged),
+    ack_round_trip (per acknowledgement) and send_midi_note. FL Studio
+    stages: sysex_frame (handling one frame), midi_transfer (a melody sent
+    as notes, first note to last), decode, idle (one OnIdle), record (a
+    whole recording pass) and note_lateness (how late each recorded note
+    fired). Each stage has p50/p95/p99 in ms,
+    and both sides report message, drop and error counters.
+    
+    Args:
+        reset (bool): Clear the metrics on both sides after reporting them
+    """
+    report = {"server": metrics.summary()}
+    report["server"]["counters"]["log_records_dropped"] = sum(
+        getattr(handler, "dropped_total", 0) for handler in logger.handlers)
+    
+    if ports.input() is None:
+        report["fl_studio"] = "Needs the return MIDI port, see select_midi_ports"
+    else:
+        job = MetricsJob(reset)
+        await submit_transfer(job)
+        try:
+            await asyncio.wait_for(job.done.wait(), COMMAND_WAIT)
+        except asyncio.TimeoutError:
+            pass
+        report["fl_studio"] = job.result or f"No answer from FL Studio ({job.status})"
+    
+    if reset:
+        metrics.reset()
+    return report
+
+# Transfer jobs by ID, oldest first, trimmed to JOB_HISTORY entries
+JOB_HISTORY = 100
+jobs = {}
+next_job_id = 1
+
+# Queue feeding the single background sender task
+transfer_queue = None
+transfer_worker = None
+
+async def submit_transfer(job):
+    """Queue a job for the background sender, starting the sender if needed"""
+    global transfer_queue, transfer_worker
+    if transfer_worker is None or transfer_worker.done():
+        transfer_queue = asyncio.Queue()
+        transfer_worker = asyncio.create_task(run_transfer_worker(transfer_queue))
+    await transfer_queue.put(job)
+
+async def run_transfer_worker(queue):
+    """Send queued jobs one at a time so transfers never interleave on the port"""
+    while True:
+        job = await queue.get()
+        try:
+            await asyncio.to_thread(job.run)
+        finally:
+            job.done.set()
+            queue.task_done()
+
+@mcp.tool()
+def job_status(job_id: int):
+    """
+    Report the progress of a melody transfer job
+    
+    Args:
+        job_id (int): ID returned by send_melody
+        
+    Returns:
+        dict: Status, frames and bytes sent, notes acknowledged and estimated time left
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return {"job_id": job_id, "status": "unknown"}
+    return job.to_dict()
+
+@mcp.tool()
+async def wait_job(job_id: int, timeout: float = 60):
+    """
+    Wait for a melody transfer job to finish
+    
+    Args:
+        job_id (int): ID returned by send_melody
+        timeout (float): Seconds to wait before returning the current progress
+        
+    Returns:
+        dict: The same report as job_status
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return {"job_id": job_id, "status": "unknown"}
+    try:
+        await asyncio.wait_for(job.done.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    return job.to_dict()
 
 # Send a MIDI note message
 @mcp.tool()
 def send_midi_note(note, velocity=1, duration=0.01):
     """Send a MIDI note on/off message with specified duration"""
-    note_on = Message('note_on', note=note, velocity=velocity)
-    output_port.send(note_on)
-    #print(f"Sent MIDI note {note} (on), velocity {velocity}")
-    time.sleep(duration)
-    note_off = Message('note_off', note=note, velocity=0)
-    output_port.send(note_off)
-    print(f"Sent MIDI note {note} (off)")
+    with metrics.timer("send_midi_note"):
+        note_on = Message('note_on', note=note, velocity=velocity)
+        ports.send(note_on)
+        time.sleep(duration)
+        note_off = Message('note_off', note=note, velocity=0)
+        ports.send(note_off)
+    logger.debug("Sent MIDI note %d", note)
     #time.sleep(0.1)  # Small pause between messages
     
 if __name__ == "__main__":
     # Initialize and run the server
-    mcp.run(transport='stdio')
+    try:
+        mcp.run(transport='stdio')
+    finally:
+        if encode_pool is not None:
+            encode_pool.shutdown()